@@ -0,0 +1,481 @@
+# Bots module: headless load generator running a swarm of bot players against a local cluster
+# Every bot speaks the player protocol like player.py: logs in with FRONT?, fetches its section
+# with GET /map, sends sequenced commands and resends them until acknowledged, acknowledges
+# updates and answers pings. All bots run on one event loop, each with a socket of its own, and
+# move in scripted patterns that take them across section edges and so from front to front.
+# At the end the swarm reports latency percentiles, resend rates and handoff times.
+# The cluster must be started with BOTS in settings.py at least the number of bots run.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import codec
+import rtt
+import connpool
+
+import sys
+import time
+import random
+import string
+import struct
+import pickle
+import resource
+import asyncio
+import concurrent.futures
+
+NEIGHBORS = ("e-neighbor", "s-neighbor", "w-neighbor", "n-neighbor")
+
+# Direction to head in to reach the neighbor across each edge
+HEADINGS = { "e-neighbor": 0, "n-neighbor": 90, "w-neighbor": 180, "s-neighbor": 270 }
+
+# Movement patterns: circle heads on to a neighbor other than the one it came from, patrol goes back
+# and forth between two sections, wander turns and changes speed at random and idle only sends NOPs
+PATTERNS = ("circle", "patrol", "wander", "idle")
+
+REPORT_INTERVAL = 5 # Seconds between progress lines
+
+# Measurements of the whole swarm
+stats = {
+    "login": [], # Seconds from the first FRONT? to having the section
+    "ack": [], # Seconds from sending a command to its ACK, of commands sent once
+    "effect": [], # Seconds from sending a SPEED or DIR command to the first update of our ship showing it
+    "handoff": [], # Seconds from our ship crossing an edge to having the section on the other side
+    "commands": 0, # Commands sent, not counting resends
+    "resends": 0, # Commands resent after their timeout ran out
+    "updates": 0, # Object updates received
+    "duplicates": 0, # Object updates received again after the front resent them
+    "dropped": 0, # Update datagrams dropped for a missing baseline of our ship's delta
+    "lost_effects": 0, # SPEED and DIR commands never seen in effect
+    "failed_handoffs": 0, # Crossings let go at the edge instead
+    "relogins": 0, # Logins again after the front told us to find another or went silent
+    "malformed": 0 # Datagrams we couldn't decode
+}
+
+# Attempt to send, generate packet loss for testing
+def try_send(transport, packet, addr):
+    if random.randint(1, 100) > settings.PACKET_LOSS:
+        transport.sendto(packet, addr)
+
+# Fetch a bot's section from its front, returns status and the section
+def get_section(front, path):
+    try:
+        status, data = connpool.fetch(front, "GET", path)
+    except OSError:
+        return None, None
+
+    return status, pickle.loads(data) if status == 200 else None
+
+# Datagram protocol of a bot's socket, passes datagrams to the bot
+class Bot_protocol(asyncio.DatagramProtocol):
+    def __init__(self, bot):
+        self.bot = bot
+
+    def datagram_received(self, data, addr):
+        try:
+            self.bot.datagram(data, addr)
+        except (ValueError, struct.error):
+            stats["malformed"] += 1
+
+# Bot player: runs the player's side of the protocol and moves its ship by a pattern
+class Bot:
+    def __init__(self, id, pattern, end):
+        self.id = id
+        self.pattern = pattern
+        self.end = end # Time to quit
+        self.session = "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+        self.transport = None
+        self.wakeup = asyncio.Event() # Set when we lose our front or section
+        self.login_reply = None # Future of the front the login server gives us
+        self.login_started = None # Time of our first login attempt until we have a section
+        self.crossing = None # Time our ship was first seen past an edge, until we have the next section
+        self.came_from = None # Neighbor key of the section we were in before this one
+        self.section_id = None
+        self.ship = None # Latest state of our ship
+        self.ship_version = -1
+        self.estimator = rtt.Rtt_estimator()
+        self.front = None
+        self.reset()
+
+    # Forget the section and commands of our previous front
+    def reset(self):
+        self.section = None # Id, version and neighbors of our section once we have it
+        self.fetch_failures = 0
+        self.seq = 0
+        self.last_ack = -1
+        self.outbound = {} # Commands still to be acked by seq
+        self.send_times = {} # Send and resend times of each command still to be acked
+        self.effects = {} # Value and send time of the latest SPEED and DIR command not yet seen in effect by field
+        self.last_acked_version = -1
+        self.recvd = set() # Versions received after last_acked_version
+        self.history = {} # Recent states of our ship by version, baselines of its deltas
+        self.last_front_msg = time.time()
+
+    # Start over with a new front
+    def change_front(self, front):
+        self.front = front
+        self.reset()
+        self.wakeup.set()
+
+    # Handle a datagram to our socket
+    def datagram(self, data, addr):
+        if data[:6] == b"FRONT:" and addr == settings.LOGIN_ADDRPORT:
+            if self.login_reply is not None and not self.login_reply.done():
+                self.login_reply.set_result(codec.decode_address(data[6:]))
+            return
+
+        if addr != self.front:
+            return
+
+        self.last_front_msg = time.time()
+
+        if data == b"FRONT!": # We're talking to the wrong front
+            stats["relogins"] += 1
+            self.change_front(None)
+        elif data[:6] == b"FRONT:": # Our ship was handed to another section
+            self.change_front(codec.decode_address(data[6:]))
+        elif self.section is None: # The front only talks with players that have fetched their section
+            return
+        elif data[:4] == b"PING":
+            front_rtt, timestamp = struct.unpack("!dd", data[4:])
+
+            if self.estimator.samples == 0 and front_rtt > 0:
+                self.estimator.sample(front_rtt)
+
+            try_send(self.transport, b"PONG" + struct.pack("!d", timestamp), addr)
+        elif data[:3] == b"ACK":
+            self.acknowledged(*codec.decode_ack(data[3:]))
+        elif data[:6] == b"UPDATE":
+            self.updates(data, addr)
+
+    # Remove acked commands from outbound, taking samples of those sent once
+    def acknowledged(self, seq, sacked):
+        now = time.time()
+        seq = min(seq, self.seq - 1)
+
+        for acked in list(range(self.last_ack + 1, seq + 1)) + sacked:
+            if self.outbound.pop(acked, None) is not None:
+                sent = self.send_times.pop(acked)
+
+                if sent["resent"] is None:
+                    self.estimator.sample(now - sent["time"])
+                    stats["ack"].append(now - sent["time"])
+                else:
+                    self.estimator.resend_acked(now - sent["resent"])
+
+        self.last_ack = max(self.last_ack, seq)
+
+    # Acknowledge an update datagram and follow our own ship in it, other objects are only counted
+    def updates(self, data, addr):
+        first, last, entries = codec.decode_updates(data)
+        ours = []
+
+        for version, (obj, state) in enumerate(entries, first):
+            if obj != self.id:
+                continue
+
+            if state is not None and "base" in state:
+                base = self.history.get(state["base"])
+
+                if base is None: # Repeating our last ACK gets it resent with full states
+                    stats["dropped"] += 1
+                    try_send(self.transport, b"ACK" + codec.encode_ack(self.last_acked_version, self.recvd), addr)
+                    return
+
+                state = codec.apply_delta(base, state)
+
+            ours.append((version, state))
+
+        for version in range(first, last + 1):
+            if version > self.last_acked_version and version not in self.recvd:
+                self.recvd.add(version)
+                stats["updates"] += 1
+            else:
+                stats["duplicates"] += 1
+
+        while self.last_acked_version + 1 in self.recvd:
+            self.recvd.remove(self.last_acked_version + 1)
+            self.last_acked_version += 1
+
+        try_send(self.transport, b"ACK" + codec.encode_ack(self.last_acked_version, self.recvd), addr)
+
+        for version, state in ours:
+            if state is not None and version > self.ship_version:
+                self.ship_moved(version, state)
+
+    # Follow a new state of our ship: edge crossings and commands taking effect
+    def ship_moved(self, version, state):
+        now = time.time()
+
+        self.ship = state
+        self.ship_version = version
+        self.history[version] = state
+
+        if len(self.history) > settings.DELTA_HISTORY:
+            del self.history[min(self.history)]
+
+        x, y = state["loc"]
+        past_edge = abs(x) > settings.SECTION_XSIZE / 2 or abs(y) > settings.SECTION_YSIZE / 2
+
+        if past_edge and self.crossing is None:
+            self.crossing = now
+        elif not past_edge and self.crossing is not None: # Let go at the edge
+            stats["failed_handoffs"] += 1
+            self.crossing = None
+
+        for field, (value, sent) in list(self.effects.items()):
+            if state.get(field) == value:
+                stats["effect"].append(now - sent)
+                del self.effects[field]
+
+    # Send a command, resent until acked
+    def command(self, data, field=None, value=None):
+        packet = struct.pack("!l", self.seq) + data
+
+        self.outbound[self.seq] = packet
+        self.send_times[self.seq] = { "time": time.time(), "resent": None }
+        try_send(self.transport, packet, self.front)
+        asyncio.get_running_loop().call_later(self.estimator.rto, self.resend, self.seq, packet)
+
+        if field is not None:
+            if field in self.effects: # The previous one never showed
+                stats["lost_effects"] += 1
+            self.effects[field] = (value, time.time())
+
+        self.seq += 1
+        stats["commands"] += 1
+
+    # Resend a command if it is still waiting for its ACK, the same packet to the same front
+    def resend(self, seq, packet):
+        if self.outbound.get(seq) is not packet or self.transport.is_closing():
+            return
+
+        try_send(self.transport, packet, self.front)
+        self.send_times[seq]["resent"] = time.time()
+        self.estimator.backoff()
+        stats["resends"] += 1
+
+        asyncio.get_running_loop().call_later(self.estimator.rto, self.resend, seq, packet)
+
+    # Neighbor key to head for by our pattern
+    def heading(self):
+        neighbors = [key for key in NEIGHBORS if key in self.section]
+
+        if self.pattern == "patrol" and self.came_from in neighbors:
+            return self.came_from
+
+        for key in neighbors:
+            if key != self.came_from:
+                return key
+
+        return neighbors[0] if neighbors else None
+
+    # Next command of our pattern, each changes the ship so that its effect shows in an update
+    def act(self):
+        now = time.time()
+
+        for field, (value, sent) in list(self.effects.items()):
+            if now - sent > settings.FRONT_TIMEOUT:
+                stats["lost_effects"] += 1
+                del self.effects[field]
+
+        if self.pattern == "idle" or self.ship is None:
+            self.command(b"NOP")
+        elif self.pattern == "wander":
+            if random.random() < 0.5:
+                direction = random.choice([d for d in range(0, 360, 15) if d != self.ship.get("direction")])
+                self.command(b"DIR" + struct.pack("!h", direction), "direction", direction)
+            else:
+                speed = random.choice([s for s in range(1, 11) if s != self.ship["speed"]])
+                self.command(b"SPEED" + struct.pack("!h", speed), "speed", speed)
+        else:
+            key = self.heading()
+
+            if key is not None and self.ship.get("direction") != HEADINGS[key]:
+                self.command(b"DIR" + struct.pack("!h", HEADINGS[key]), "direction", HEADINGS[key])
+
+            speed = 9 if self.ship["speed"] == 10 else 10
+            self.command(b"SPEED" + struct.pack("!h", speed), "speed", speed)
+
+    # Get a front from the login server, trying until we have one or it is time to quit
+    async def log_in(self):
+        if self.login_started is None:
+            self.login_started = time.time()
+
+        packet = b"FRONT?" + codec.encode_front_request(self.id, self.session)
+
+        while time.time() < self.end:
+            self.login_reply = asyncio.get_running_loop().create_future()
+            try_send(self.transport, packet, settings.LOGIN_ADDRPORT)
+
+            try:
+                self.change_front(await asyncio.wait_for(self.login_reply, settings.PLAYER_TIMEOUT))
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    # Fetch our section from our front, keeping only what we need of it
+    async def fetch_section(self):
+        front = self.front
+        path = "/map?player=" + str(self.id) + "&session=" + self.session
+        status, section = await asyncio.get_running_loop().run_in_executor(None, get_section, front, path)
+
+        if front != self.front: # Moved on while fetching
+            return
+
+        if status != 200:
+            self.fetch_failures += 1
+
+            if self.fetch_failures >= 5:
+                stats["relogins"] += 1
+                self.change_front(None)
+            else:
+                await asyncio.sleep(settings.HANDOFF_RETRY)
+            return
+
+        now = time.time()
+
+        if self.section_id is not None and section["id"] != self.section_id:
+            self.came_from = next((key for key in NEIGHBORS if section.get(key, (None, None))[1] == self.section_id), None)
+
+        self.section_id = section["id"]
+        self.section = { key: section[key] for key in NEIGHBORS if key in section }
+        self.last_acked_version = section["version"]
+        self.ship = section["objects"].get(self.id)
+        self.ship_version = section["version"]
+        self.history = { section["version"]: self.ship } if self.ship is not None else {}
+
+        if self.crossing is not None:
+            stats["handoff"].append(now - self.crossing)
+            self.crossing = None
+
+        if self.login_started is not None:
+            stats["login"].append(now - self.login_started)
+            self.login_started = None
+
+    # Play until it is time to quit
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(lambda: Bot_protocol(self), local_addr=("127.0.0.1", 0))
+        next_command = time.time() + random.uniform(0, settings.BOT_COMMAND_INTERVAL)
+
+        while time.time() < self.end:
+            self.wakeup.clear()
+
+            if self.front is None:
+                await self.log_in()
+            elif self.section is None:
+                await self.fetch_section()
+            elif time.time() - self.last_front_msg > settings.FRONT_TIMEOUT:
+                stats["relogins"] += 1
+                self.change_front(None)
+            else:
+                if time.time() >= next_command:
+                    self.act()
+                    next_command = max(next_command + settings.BOT_COMMAND_INTERVAL, time.time())
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(next_command, self.end) - time.time())
+                except asyncio.TimeoutError:
+                    pass
+
+        if self.front is not None:
+            try_send(self.transport, b"QUIT", self.front)
+
+        self.transport.close()
+
+# Forget the measurements of a previous swarm
+def clear_stats():
+    for name in stats:
+        stats[name] = [] if isinstance(stats[name], list) else 0
+
+# The p:th percentile of samples in milliseconds, None without samples
+def percentile(samples, p):
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+# Latency percentiles of samples as a report line
+def percentiles(name, samples):
+    if not samples:
+        return "%-18s no samples" % name
+
+    return "%-18s %7d  p50 %7.1f  p90 %7.1f  p99 %7.1f  max %7.1f ms" % (name, len(samples),
+        percentile(samples, 50), percentile(samples, 90), percentile(samples, 99), max(samples) * 1000)
+
+# Print the final report of the swarm
+def report(bots, seconds):
+    commands = stats["commands"]
+    updates = stats["updates"] + stats["duplicates"]
+
+    print()
+    print(len(bots), "bots,", sum(bot.section is not None for bot in bots), "with a section at the end, ran", seconds, "s")
+    print(percentiles("Login", stats["login"]))
+    print(percentiles("Command to ACK", stats["ack"]))
+    print(percentiles("Command to UPDATE", stats["effect"]))
+    print(percentiles("Handoff", stats["handoff"]))
+    print("Commands sent", commands, "resent", stats["resends"], "(%.1f %%)" % (100 * stats["resends"] / max(commands, 1)))
+    print("Updates received", updates, "duplicates", stats["duplicates"], "(%.1f %%)" % (100 * stats["duplicates"] / max(updates, 1)),
+        "dropped datagrams", stats["dropped"])
+    print("Commands never seen in effect", stats["lost_effects"], "failed handoffs", stats["failed_handoffs"],
+        "relogins", stats["relogins"], "malformed datagrams", stats["malformed"])
+
+# Print a progress line every REPORT_INTERVAL until the end
+async def progress(bots, start, end):
+    while time.time() + REPORT_INTERVAL < end:
+        await asyncio.sleep(REPORT_INTERVAL)
+
+        print("%4.0f s: %d/%d bots in, %d commands, %d resends, %d updates, %d handoffs" % (time.time() - start,
+            sum(bot.section is not None for bot in bots), len(bots), stats["commands"], stats["resends"], stats["updates"], len(stats["handoff"])))
+
+# Run count bots moving by pattern for seconds, starting BOT_LOGIN_RATE of them per second
+async def swarm(count, seconds, pattern):
+    start = time.time()
+    end = start + seconds
+    bots = [Bot(settings.BOT_FIRST_ID + bot, pattern, end) for bot in range(count)]
+    tasks = [asyncio.create_task(progress(bots, start, end))]
+
+    # Sections are fetched in threads, as many at once as a front serves
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(settings.HTTP_WORKERS))
+
+    for bot in bots:
+        tasks.append(asyncio.create_task(bot.run()))
+        await asyncio.sleep(1 / settings.BOT_LOGIN_RATE)
+
+    await asyncio.gather(*tasks)
+
+    report(bots, seconds)
+
+# Allow a socket for each of count bots
+def raise_file_limit(count):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft < count + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, count + 100) if hard != resource.RLIM_INFINITY else count + 100, hard))
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<bots> [<seconds> [<pattern>]]")
+        print("Patterns:", ", ".join(PATTERNS))
+        exit()
+
+    count = int(sys.argv[1])
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    pattern = sys.argv[3] if len(sys.argv) > 3 else PATTERNS[0]
+
+    if pattern not in PATTERNS:
+        print("Unknown pattern", pattern)
+        exit()
+
+    if count > settings.BOTS:
+        print("The cluster only knows", settings.BOTS, "bots, raise BOTS in settings.py and restart it")
+        exit()
+
+    raise_file_limit(count)
+    print("Starting", count, "bots moving by pattern", pattern, "for", seconds, "s")
+
+    asyncio.run(swarm(count, seconds, pattern))
+
+if __name__ == "__main__":
+    main()
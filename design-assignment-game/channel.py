@@ -0,0 +1,115 @@
+# Channel module: requests between the processes of a multi-process front over a pipe
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import sys
+import itertools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Both ends of a multiprocessing pipe can make requests of the other and serve the other's requests
+# A request is (method, path, body) like an HTTP request and is answered with (status, data), so
+# the same handlers serve HTTP and the channel. Requests are served concurrently by a thread pool,
+# notices need no answer and are handled one at a time in the order they were sent.
+class Channel:
+    def __init__(self, connection, handler, threads=None):
+        self.connection = connection
+        self.handler = handler # Function taking a request, returns (status, data)
+        self.pool = ThreadPoolExecutor(threads or settings.HTTP_WORKERS)
+
+        self.send_lock = threading.Lock()
+        self.waiting = {} # Event and answer slot of each request we are waiting on, by request id
+        self.waiting_lock = threading.Lock()
+        self.ids = itertools.count()
+        self.closed = False
+
+        self.reader_thread = threading.Thread(target=self.reader, daemon=True)
+
+    # Start serving the other end
+    def start(self):
+        self.reader_thread.start()
+        return self
+
+    # Wait until the other end has gone away
+    def join(self):
+        self.reader_thread.join()
+
+    # Send a message, raises OSError if the other end is gone
+    def send(self, message):
+        if self.closed:
+            raise OSError("Channel closed")
+
+        with self.send_lock:
+            self.connection.send(message)
+
+    # Make a request and wait for its answer, raises OSError on timeout or if the other end is gone
+    def request(self, method, path, body=b"", timeout=None):
+        id = next(self.ids)
+        slot = [threading.Event(), None]
+
+        with self.waiting_lock:
+            self.waiting[id] = slot
+
+        try:
+            self.send((id, "request", (method, path, body)))
+
+            if not slot[0].wait(timeout or settings.HTTP_TIMEOUT):
+                raise OSError("Channel request timed out")
+        finally:
+            with self.waiting_lock:
+                self.waiting.pop(id, None)
+
+        if slot[1] is None:
+            raise OSError("Channel closed")
+
+        return slot[1]
+
+    # Send a request that is not answered
+    def notice(self, method, path, body=b""):
+        self.send((None, "notice", (method, path, body)))
+
+    # Thread reading messages from the other end until it closes
+    def reader(self):
+        while True:
+            try:
+                id, kind, payload = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "answer":
+                with self.waiting_lock:
+                    slot = self.waiting.get(id)
+
+                if slot is not None:
+                    slot[1] = payload
+                    slot[0].set()
+            elif kind == "request":
+                self.pool.submit(self.serve, id, payload)
+            else:
+                self.handle(payload)
+
+        # Wake up everyone waiting, they get no answer
+        self.closed = True
+
+        with self.waiting_lock:
+            for slot in self.waiting.values():
+                slot[0].set()
+
+    # Run the handler on a request, a failing handler answers 500
+    def handle(self, request):
+        try:
+            return self.handler(*request)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            return 500, b""
+
+    # Serve a request and send its answer
+    def serve(self, id, request):
+        answer = self.handle(request)
+
+        try:
+            self.send((id, "answer", answer))
+        except OSError:
+            pass
@@ -0,0 +1,367 @@
+# Codec module: compact binary encoding for game messages sent over UDP
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import socket
+import struct
+
+CODEC_VERSION = 3 # Bumped whenever a layout below changes
+
+OBJECT_REMOVED = 0x01 # Object left the section, no state follows
+OBJECT_HAS_DIRECTION = 0x02 # Object has a heading
+OBJECT_DELTA = 0x04 # Only fields changed since a baseline state the player has acknowledged follow
+
+# Changed fields of a delta, in the same flags
+DELTA_LOC = 0x08 # Location moved by a small step
+DELTA_LOC_ABS = 0x10 # Location moved too far for a step, absolute location follows
+DELTA_SPEED = 0x20 # Speed changed
+DELTA_DIRECTION = 0x40 # Heading changed
+DELTA_NAME = 0x80 # Name changed
+
+OBJECT_HEADER = struct.Struct("!LB") # id, flags
+OBJECT = struct.Struct("!LBllhhB") # id, flags, x, y, speed, direction, name length
+NAME_REFERENCE = 255 # Name length of a state sent without its name, the receiver keeps the name it has for the object
+LOC_SCALE = 1000 # Locations are sent as integer thousandths, the precision fronts round to
+DELTA = struct.Struct("!LBL") # id, flags, baseline version
+LOC_STEP = struct.Struct("!hh") # x and y change in thousandths
+LOC = struct.Struct("!ll") # x, y in thousandths
+FIELD = struct.Struct("!h") # speed or direction
+UPDATE_HEADER = struct.Struct("!BL") # codec version, version
+UPDATES_HEADER = struct.Struct("!BLL") # codec version, first version, last version
+STORE_UPDATE_HEADER = struct.Struct("!BlL") # codec version, section, version
+STORE_UPDATES_HEADER = struct.Struct("!BlLL") # codec version, section, first version, last version
+ADDRESS = struct.Struct("!B4sH") # codec version, IPv4 address, port
+FRONT_REQUEST = struct.Struct("!BlB") # codec version, player id, session length
+ACK = struct.Struct("!lL") # last consecutively received sequence number, bitmap of the ones received after it
+SACK_BITS = 32 # Sequence numbers after the consecutive one covered by the bitmap
+STORE_ACK = struct.Struct("!ll") # section, last version the store has applied in order
+
+# Largest header in front of the objects of an update datagram, including the message type
+UPDATES_HEADER_SIZE = len(b"UPDATES") + STORE_UPDATES_HEADER.size
+
+# Message types by their leading bytes, longest first where one starts another
+MESSAGE_TYPES = (b"UPDATES", b"UPDATE", b"ACK", b"PING", b"PONG", b"FRONT?", b"FRONT:", b"FRONT!", b"QUIT")
+
+# Type of a message for counting, None for messages without a type such as player commands
+def message_type(data):
+    for kind in MESSAGE_TYPES:
+        if data.startswith(kind):
+            return kind.decode()
+
+    return None
+
+# Check codec version of a received message
+def check_version(version):
+    if version != CODEC_VERSION:
+        raise ValueError("Unsupported codec version " + str(version))
+
+# Encode a name, cut on a character boundary to fit below NAME_REFERENCE
+def encode_name(name):
+    data = name.encode()
+
+    if len(data) >= NAME_REFERENCE:
+        data = data[:NAME_REFERENCE - 1].decode(errors="ignore").encode()
+
+    return data
+
+# Encode an object state, None means the object was removed
+def encode_object(id, obj):
+    if obj is None:
+        return OBJECT_HEADER.pack(id, OBJECT_REMOVED)
+
+    name = encode_name(obj["name"])
+    x, y = obj["loc"]
+    direction = obj.get("direction")
+
+    if direction is None:
+        return OBJECT.pack(id, 0, round(x * LOC_SCALE), round(y * LOC_SCALE), obj["speed"], 0, len(name)) + name
+
+    return OBJECT.pack(id, OBJECT_HAS_DIRECTION, round(x * LOC_SCALE), round(y * LOC_SCALE), obj["speed"], direction, len(name)) + name
+
+# An encoded object state with its name left out, for a receiver that already has the name
+# Removals and deltas are returned as they are
+def name_reference(encoded):
+    if len(encoded) <= OBJECT.size or encoded[4] & (OBJECT_REMOVED | OBJECT_DELTA):
+        return encoded
+
+    return encoded[:OBJECT.size - 1] + bytes((NAME_REFERENCE,))
+
+# Encode the changes from a baseline state to an object state
+# Returns None if the change can't be given as a delta
+def encode_delta(id, base_version, base, obj):
+    if obj.keys() != base.keys():
+        return None
+
+    fields = OBJECT_DELTA
+    parts = []
+
+    x, y = round(obj["loc"][0] * LOC_SCALE), round(obj["loc"][1] * LOC_SCALE)
+    base_x, base_y = round(base["loc"][0] * LOC_SCALE), round(base["loc"][1] * LOC_SCALE)
+
+    if (x, y) != (base_x, base_y):
+        if -32768 <= x - base_x <= 32767 and -32768 <= y - base_y <= 32767:
+            fields |= DELTA_LOC
+            parts.append(LOC_STEP.pack(x - base_x, y - base_y))
+        else:
+            fields |= DELTA_LOC_ABS
+            parts.append(LOC.pack(x, y))
+
+    if obj["speed"] != base["speed"]:
+        fields |= DELTA_SPEED
+        parts.append(FIELD.pack(obj["speed"]))
+
+    if obj.get("direction") != base.get("direction"):
+        fields |= DELTA_DIRECTION
+        parts.append(FIELD.pack(obj["direction"]))
+
+    if obj["name"] != base["name"]:
+        name = encode_name(obj["name"])
+        fields |= DELTA_NAME
+        parts.append(bytes((len(name),)) + name)
+
+    return DELTA.pack(id, fields, base_version) + b"".join(parts)
+
+# Decode a delta at offset, return id, delta and offset after it
+# The delta is a dict of changed fields and the baseline version, see apply_delta
+def decode_delta(data, offset):
+    id, fields, base_version = DELTA.unpack_from(data, offset)
+    offset += DELTA.size
+
+    delta = { "base": base_version }
+
+    if fields & DELTA_LOC:
+        delta["loc_step"] = LOC_STEP.unpack_from(data, offset)
+        offset += LOC_STEP.size
+    elif fields & DELTA_LOC_ABS:
+        x, y = LOC.unpack_from(data, offset)
+        delta["loc"] = (x / LOC_SCALE, y / LOC_SCALE)
+        offset += LOC.size
+
+    if fields & DELTA_SPEED:
+        delta["speed"] = FIELD.unpack_from(data, offset)[0]
+        offset += FIELD.size
+
+    if fields & DELTA_DIRECTION:
+        delta["direction"] = FIELD.unpack_from(data, offset)[0]
+        offset += FIELD.size
+
+    if fields & DELTA_NAME:
+        name_len = data[offset]
+        delta["name"] = data[offset + 1:offset + 1 + name_len].decode()
+        offset += 1 + name_len
+
+    return id, delta, offset
+
+# Object state from a baseline state and a decoded delta
+def apply_delta(base, delta):
+    obj = base.copy()
+
+    for field in delta:
+        if field == "loc_step":
+            obj["loc"] = ((round(base["loc"][0] * LOC_SCALE) + delta[field][0]) / LOC_SCALE,
+                    (round(base["loc"][1] * LOC_SCALE) + delta[field][1]) / LOC_SCALE)
+        elif field != "base":
+            obj[field] = delta[field]
+
+    return obj
+
+# Decode an object state at offset, return id, object and offset after it
+# Deltas are returned undecoded against their baseline, they have a "base" key
+# A state sent as a name reference has no "name" key
+def decode_object(data, offset):
+    flags = data[offset + 4]
+
+    if flags & OBJECT_REMOVED:
+        return OBJECT_HEADER.unpack_from(data, offset)[0], None, offset + OBJECT_HEADER.size
+
+    if flags & OBJECT_DELTA:
+        return decode_delta(data, offset)
+
+    id, flags, x, y, speed, direction, name_len = OBJECT.unpack_from(data, offset)
+    offset += OBJECT.size
+
+    if name_len == NAME_REFERENCE:
+        obj = { "loc": (x / LOC_SCALE, y / LOC_SCALE), "speed": speed }
+    else:
+        obj = { "name": data[offset:offset + name_len].decode(), "loc": (x / LOC_SCALE, y / LOC_SCALE), "speed": speed }
+        offset += name_len
+
+    if flags & OBJECT_HAS_DIRECTION:
+        obj["direction"] = direction
+
+    return id, obj, offset
+
+# Decode a run of consecutive objects that fill the rest of the message
+def decode_objects(data, offset):
+    entries = []
+    end = len(data)
+
+    while offset < end:
+        id, obj, offset = decode_object(data, offset)
+        entries.append((id, obj))
+
+    return entries
+
+# Build an update message to a player from encoded objects with consecutive versions
+def pack_updates(first, objects):
+    if len(objects) == 1:
+        return b"UPDATE" + UPDATE_HEADER.pack(CODEC_VERSION, first) + objects[0]
+    else:
+        return b"UPDATES" + UPDATES_HEADER.pack(CODEC_VERSION, first, first + len(objects) - 1) + b"".join(objects)
+
+# Decode an UPDATE or UPDATES message to a player
+# Returns first version, last version and list of (id, object)
+def decode_updates(data):
+    try:
+        if data[:7] == b"UPDATES":
+            codec_version, first, last = UPDATES_HEADER.unpack_from(data, 7)
+            offset = 7 + UPDATES_HEADER.size
+        else:
+            codec_version, first = UPDATE_HEADER.unpack_from(data, 6)
+            last = first
+            offset = 6 + UPDATE_HEADER.size
+
+        if codec_version != CODEC_VERSION:
+            check_version(codec_version)
+
+        entries = decode_objects(data, offset)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("Malformed update") from e
+
+    if len(entries) != last - first + 1:
+        raise ValueError("Update carries wrong number of objects")
+
+    return first, last, entries
+
+# Build an update message to the store from encoded objects with consecutive versions
+def pack_store_updates(section, first, objects):
+    if len(objects) == 1:
+        return b"UPDATE" + STORE_UPDATE_HEADER.pack(CODEC_VERSION, section, first) + objects[0]
+    else:
+        return b"UPDATES" + STORE_UPDATES_HEADER.pack(CODEC_VERSION, section, first, first + len(objects) - 1) + b"".join(objects)
+
+# Decode an UPDATE or UPDATES message to the store
+# Returns section, first version, last version and list of (id, object)
+def decode_store_updates(data):
+    try:
+        if data[:7] == b"UPDATES":
+            codec_version, section, first, last = STORE_UPDATES_HEADER.unpack_from(data, 7)
+            offset = 7 + STORE_UPDATES_HEADER.size
+        else:
+            codec_version, section, first = STORE_UPDATE_HEADER.unpack_from(data, 6)
+            last = first
+            offset = 6 + STORE_UPDATE_HEADER.size
+
+        if codec_version != CODEC_VERSION:
+            check_version(codec_version)
+
+        entries = decode_objects(data, offset)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("Malformed update") from e
+
+    if len(entries) != last - first + 1:
+        raise ValueError("Update carries wrong number of objects")
+
+    return section, first, last, entries
+
+# Encode an (address, port) pair, used in FRONT: messages
+def encode_address(addrport):
+    return ADDRESS.pack(CODEC_VERSION, socket.inet_aton(addrport[0]), addrport[1])
+
+# Decode an (address, port) pair
+def decode_address(data):
+    try:
+        codec_version, addr, port = ADDRESS.unpack_from(data)
+        check_version(codec_version)
+
+        return (socket.inet_ntoa(addr), port)
+    except (struct.error, OSError) as e:
+        raise ValueError("Malformed address") from e
+
+# Encode a datagram passed on to a worker of a multi-process front, prefixed with its sender
+def encode_forwarded(addrport, data):
+    return encode_address(addrport) + data
+
+# Decode a datagram passed on to a worker, returns the datagram and its sender
+def decode_forwarded(data):
+    return data[ADDRESS.size:], decode_address(data)
+
+# Encode a player's request for a front, used in FRONT? messages
+def encode_front_request(id, session):
+    session = encode_name(session)
+
+    return FRONT_REQUEST.pack(CODEC_VERSION, id, len(session)) + session
+
+# Decode a player's request for a front
+def decode_front_request(data):
+    try:
+        codec_version, id, session_len = FRONT_REQUEST.unpack_from(data)
+        check_version(codec_version)
+        session = data[FRONT_REQUEST.size:FRONT_REQUEST.size + session_len].decode()
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError("Malformed front request") from e
+
+    return { "id": id, "session": session }
+
+# Encode an acknowledgement of sequence numbers up to cumulative and those in received after it
+def encode_ack(cumulative, received):
+    bitmap = 0
+
+    for bit in range(SACK_BITS):
+        if cumulative + 1 + bit in received:
+            bitmap |= 1 << bit
+
+    return ACK.pack(cumulative, bitmap)
+
+# Decode an acknowledgement, return the cumulative sequence number and list of the ones received after it
+def decode_ack(data):
+    try:
+        cumulative, bitmap = ACK.unpack_from(data)
+    except struct.error as e:
+        raise ValueError("Malformed ACK") from e
+
+    return cumulative, [cumulative + 1 + bit for bit in range(SACK_BITS) if bitmap >> bit & 1]
+
+# Encode the store's acknowledgement of all versions of a section up to version
+def encode_store_ack(section, version):
+    return STORE_ACK.pack(section, version)
+
+# Decode a store acknowledgement, return section and version
+def decode_store_ack(data):
+    try:
+        return STORE_ACK.unpack_from(data)
+    except struct.error as e:
+        raise ValueError("Malformed ACK") from e
+
+# Compare encoding speed and size against pickle for a typical ship update
+# Times are the best of several rounds, as the fastest round is the one least disturbed by the rest of the system
+def main():
+    import pickle
+    import timeit
+
+    version = 1234
+    id = 1
+    obj = { "name": "Player #1 ship", "loc": (12.345, -6.789), "speed": 5, "direction": 90 }
+    count = 100000
+    best = lambda f: min(timeit.repeat(f, number=count, repeat=7)) / count * 1e6
+
+    pickled = b"UPDATE" + pickle.dumps((version, id, obj))
+    encoded = pack_updates(version, [encode_object(id, obj)])
+    full = encode_object(id, obj)
+    reference = pack_store_updates(1, version, [name_reference(full)])
+    moved = dict(obj, loc=(12.845, -6.789))
+    delta = pack_updates(version + 1, [encode_delta(id, version, obj, moved)])
+
+    print("           bytes  encode us  decode us")
+    print("pickle    %6d %10.2f %10.2f" % (len(pickled), best(lambda: b"UPDATE" + pickle.dumps((version, id, obj))),
+        best(lambda: pickle.loads(pickled[6:]))))
+    print("codec     %6d %10.2f %10.2f" % (len(encoded), best(lambda: pack_updates(version, [encode_object(id, obj)])),
+        best(lambda: decode_updates(encoded))))
+    # A name reference is made from the state already encoded for players
+    print("reference %6d %10.2f %10.2f" % (len(reference), best(lambda: pack_store_updates(1, version, [name_reference(full)])),
+        best(lambda: decode_store_updates(reference))))
+    print("delta     %6d" % len(delta))
+    print("Object bytes: %d full, %d name reference, %d delta for a moving ship" % (len(encode_object(id, obj)),
+        len(name_reference(encode_object(id, obj))), len(encode_delta(id, version, obj, moved))))
+
+if __name__ == "__main__":
+    main()
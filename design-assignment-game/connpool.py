@@ -0,0 +1,134 @@
+# Connection pool module: keep-alive HTTP connections between components
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import time
+import select
+import threading
+import http.client
+
+# Pool of idle HTTP connections for each address
+# A connection is taken out of the pool for one request at a time and put back if the server
+# kept it open, so concurrent requests to the same address each get their own connection
+class Connection_pool:
+    def __init__(self, size=None, idle_timeout=None, timeout=None):
+        self.size = size or settings.POOL_SIZE
+        self.idle_timeout = idle_timeout or settings.POOL_IDLE_TIMEOUT
+        self.timeout = timeout or settings.HTTP_TIMEOUT
+        self.lock = threading.Lock() # Protects idle
+
+        self.idle = {} # Idle connections and the time they were last used for each address
+
+        self.connects = 0 # New connections made
+        self.reuses = 0 # Requests sent over a pooled connection
+        self.retries = 0 # Requests retried because a pooled connection had gone stale
+
+    # Check that an idle connection can still be used: not idle too long and not closed by the server
+    # A closed connection has its socket readable with nothing to read, a live one isn't readable at all
+    def healthy(self, conn, last_used):
+        if time.time() - last_used > self.idle_timeout or conn.sock is None:
+            return False
+
+        try:
+            readable, writable, failed = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+
+        return not readable
+
+    # Take a healthy idle connection to address, or make a new one
+    # Returns the connection and whether it was reused
+    def get(self, address):
+        while True:
+            with self.lock:
+                if not self.idle.get(address):
+                    break
+
+                conn, last_used = self.idle[address].pop()
+
+            if self.healthy(conn, last_used):
+                return conn, True
+
+            conn.close()
+
+        self.connects += 1
+
+        return http.client.HTTPConnection(address[0], address[1], timeout=self.timeout), False
+
+    # Put a connection back after a complete response, closing it if the pool for its address is full
+    def put(self, address, conn):
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    # Send a request and read the response, returns status and body
+    # A request failing on a pooled connection is retried on a new connection, as the server may have
+    # closed it just as we sent. Only a GET or a request that couldn't be written is retried, the
+    # server may already have carried out a POST whose response we lost. Raises OSError if the request fails.
+    def request(self, address, method, path, body=None):
+        while True:
+            conn, reused = self.get(address)
+            written = False
+
+            try:
+                conn.request(method, path, body)
+                written = True
+
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+
+                if reused and isinstance(e, (ConnectionError, http.client.RemoteDisconnected)) and (method == "GET" or not written):
+                    self.retries += 1
+                    continue
+
+                raise OSError("Request to " + str(address) + " failed") from e
+
+            if reused:
+                self.reuses += 1
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.put(address, conn)
+
+            return response.status, data
+
+    # Close all idle connections
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+pool = Connection_pool() # Pool shared by everything in this process
+
+# Send a request over the shared pool, see Connection_pool.request
+def request(address, method, path, body=None):
+    return pool.request(address, method, path, body)
+
+# Send one request on a connection of its own, closed after the response, returns status and body
+# For clients that only fetch now and then, whose idle connections would just tie up the server
+# Raises OSError if the request fails
+def fetch(address, method, path, body=None):
+    conn = http.client.HTTPConnection(address[0], address[1], timeout=settings.HTTP_TIMEOUT)
+
+    try:
+        conn.request(method, path, body, { "Connection": "close" })
+        response = conn.getresponse()
+
+        return response.status, response.read()
+    except (OSError, http.client.HTTPException) as e:
+        raise OSError("Request to " + str(address) + " failed") from e
+    finally:
+        conn.close()
@@ -0,0 +1,65 @@
+# Dispatch benchmark module: cost of finding the player a datagram came from
+# Compares the linear scan over all players the front listener used to do against the front's
+# players_by_addr index, both under players_lock, as the number of players on a front grows.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import front
+import frontplayer
+
+import sys
+import random
+import timeit
+
+COUNTS = (10, 100, 1000, 5000) # Players on the front by default
+LOOKUPS = 1000 # Datagrams dispatched per round, from random players
+
+# Fill the front with count subscribed players, returns their addresses
+def fill_front(count):
+    front.players.clear()
+    front.players_by_addr.clear()
+
+    for id in range(count):
+        player = frontplayer.Front_player("Player #" + str(id), id, 1, 1, ("127.0.0.1", 20000 + id), "ABCDEFGHIJ")
+        player.send_buffer = {}
+        front.add_player(id, player)
+
+    return [front.players[id].addr for id in front.players]
+
+# Find the player by walking all players, as the front listener used to
+def scan_dispatch(addr):
+    with front.players_lock:
+        for p in front.players:
+            if front.players[p].addr == addr and front.players[p].send_buffer is not None:
+                return front.players[p]
+
+    return None
+
+# Find the player by the address index, as the front's handle_datagram does
+def index_dispatch(addr):
+    with front.players_lock:
+        id = front.players_by_addr.get(addr)
+
+    if id is not None and front.players[id].addr == addr and front.players[id].send_buffer is not None:
+        return front.players[id]
+
+    return None
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or COUNTS
+
+    print("%8s %14s %14s" % ("Players", "Scan ns/pkt", "Index ns/pkt"))
+    for count in counts:
+        addrs = fill_front(count)
+        packets = [random.choice(addrs) for i in range(LOOKUPS)]
+
+        results = []
+        for dispatch in (scan_dispatch, index_dispatch):
+            assert all(dispatch(addr).addr == addr for addr in packets)
+            rounds = max(1, 200000 // (LOOKUPS * (count if dispatch is scan_dispatch else 1)))
+            best = min(timeit.repeat(lambda: [dispatch(addr) for addr in packets], number=rounds, repeat=5))
+            results.append(best / rounds / LOOKUPS * 1e9)
+
+        print("%8d %14.0f %14.0f" % (count, results[0], results[1]))
+
+if __name__ == "__main__":
+    main()
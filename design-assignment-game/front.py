@@ -2,6 +2,20 @@
 # Jarkko Kovala <jarkko.kovala@iki.fi>
 
 import settings
+import codec
+import movement
+import ticker
+import interest
+import timers
+import rtt
+import ratelimit
+import connpool
+import httpserver
+import metrics
+import gameobject
+import frontplayer
+import ghosts
+from movement import move_object
 
 import sys
 import socket
@@ -9,61 +23,105 @@ import struct
 import time
 import threading
 import random
-import queue
-import math
 import pickle
-import urllib
-import http.client
+import contextlib
+import select
+import queue
 from urllib.parse import urlparse, parse_qs
-from http.server import BaseHTTPRequestHandler, HTTPServer
 
-if len(sys.argv) < 2:
-    print("Usage:", sys.argv[0], "<front #>")
-    exit()
+FRONT = None # Our front number and address, set in main
+addrport = None
 
-FRONT = int(sys.argv[1])
-addrport = settings.INITIAL_FRONTS[FRONT]["address"]
+inbox = None # In a worker of a multi-process front, socket the dispatcher passes our datagrams to
+dispatcher = None # and channel to the dispatcher, through which we reach the sections of other workers
 
+# Locking: each section has its own lock in section_locks, which protects the section,
+# its pending updates, subscribers and interest grid, and the connection state of players in it.
+# sections_lock only protects the sections and section_locks dicts themselves and
+# players_lock the players and players_by_addr dicts and keepalive counters.
+# Section locks are taken in ascending section id order and before players_lock or
+# sections_lock, which are never held while waiting for a section lock.
 sections = {} # Map sections we handle
-sections_lock = threading.Lock()
+section_locks = {} # Lock for each section
+sections_lock = metrics.lock("sections")
 
 players = {} # Players currently connected
-players_lock = threading.Lock()
-
-print("Starting front #", FRONT, addrport)
+players_by_addr = {} # Index from player address to player id
+subscribers = {} # Players receiving updates for each section
+interest_grids = {} # Area of interest grid for each section, built when first needed
+players_lock = metrics.lock("players")
 
 s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 s_lock = threading.Lock()
+outbox = threading.local() # Datagrams queued by a thread sending them in a batch
+
+resend_timers = timers.Timer_wheel() # Resends to players by (player, version), cancelled when acked
+store_resend_timers = timers.Timer_wheel() # Resends to store by (section, version), cancelled when acked
+
+handoff_queue = queue.Queue() # Handoff steps to run by (section, object id)
+handoff_timers = timers.Timer_wheel() # Retries of failed handoff steps by (section, object id)
+
+pending_updates = {} # Updates made during current tick, not yet sent, for each section
+commanded = {} # Ships whose players sent commands during current tick, for each section
+
+ghost_outbox = ghosts.Ghost_outbox() # Ghost messages to neighbors not yet sent
+ghost_ready = threading.Condition() # Guards ghost_outbox, notified when messages are put in it
+ghost_timers = timers.Timer_wheel() # Resyncs of neighbors we failed to send ghosts to by (section, key)
 
-resend_queue = queue.PriorityQueue() # Queue for resends to players
-store_resend_queue = queue.PriorityQueue() # Queue for resends to store
+metrics.histogram("recv_batch_datagrams", [2 ** x for x in range(settings.RECV_BATCH.bit_length())],
+    "Datagrams read from the socket in one round of the listener")
 
 # Attempt to send, generate packet loss for testing
+# A datagram that doesn't fit in a full send buffer is dropped too, resends make up for it
 # Caller must have s_lock
 def try_send(s, packet, addr):
-    if(random.randint(1, 100) > settings.PACKET_LOSS):
-        s.sendto(packet, addr)
+    kind = codec.message_type(packet) or "command"
 
-# Clean internal data from object for transfer
-# Caller must have sections_lock
+    try:
+        if(random.randint(1, 100) > settings.PACKET_LOSS):
+            s.sendto(packet, addr)
+            metrics.count_packet("out", kind)
+        else:
+            metrics.count_packet("dropped", kind)
+    except BlockingIOError:
+        metrics.count_packet("dropped", kind)
+
+# Send a datagram, or queue it if the thread is sending a batch of datagrams together
+def send(packet, addr):
+    batch = getattr(outbox, "batch", None)
+
+    if batch is None:
+        with s_lock:
+            try_send(s, packet, addr)
+    else:
+        batch.append((packet, addr))
+
+# Start queuing the datagrams this thread sends
+def start_batch():
+    outbox.batch = []
+
+# Send the datagrams queued since start_batch, all under one acquisition of s_lock
+def flush_batch():
+    batch, outbox.batch = outbox.batch, None
+
+    if batch:
+        with s_lock:
+            for packet, addr in batch:
+                try_send(s, packet, addr)
+
+# Wire fields of object for transfer
+# Caller must have the lock of the object's section
 def clean_object(obj):
-    if obj is None:
-        return None
-        
-    obj = obj.copy()
-
-    if "last_move" in obj:
-        del obj["last_move"]
-    
-    return obj
+    return None if obj is None else obj.wire()
 
 # Clean internal data rom section for transfer
-# Caller must have sections_lock
+# Caller must have the section's lock
 def clean_section(section):
     section = section.copy()
 
-    if "store_buffer" in section:
-        del section["store_buffer"]
+    for x in ("store_buffer", "store_names", "view_version", "movement", "handoffs", "snapshots", "ghosts", "ghosted", "ghost_resync", "ghost_changes"):
+        if x in section:
+            del section[x]
 
     section["objects"] = section["objects"].copy()
 
@@ -75,190 +133,780 @@ def clean_section(section):
 
     return section
 
-# Clean internal data from player for sending
-# Caller must have players_lock
+# Wire fields of player for sending
+# Caller must have the lock of the player's section
 def clean_player(player):
-    player = player.copy()
+    return player.wire()
+
+# Lock the given sections in ascending id order, ignoring sections we don't have
+@contextlib.contextmanager
+def locked_sections(*section_ids):
+    locks = [section_locks[id] for id in sorted(set(section_ids) - {None}) if id in section_locks]
+
+    for lock in locks:
+        lock.acquire()
+
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+# Lock the section a player is in, together with any other given sections
+# Yields the player's section, or None if the player is not connected
+@contextlib.contextmanager
+def locked_player(id, *section_ids):
+    while True:
+        with players_lock:
+            section = players[id].section if id in players else None
+
+        with locked_sections(section, *section_ids):
+            # Retry if the player moved or left while we were waiting for the locks
+            if (players[id].section if id in players else None) == section:
+                yield section
+                return
+
+# Add a player and index them by address, replacing any earlier connection
+# Caller must have players_lock and locks of the player's old and new section
+def add_player(id, player):
+    if id in players:
+        remove_player(id)
+
+    players[id] = player
+    players_by_addr[player.addr] = id
+    announce("/route", id, player.addr)
+
+# Remove a player and their address from the index
+# Caller must have players_lock and the lock of the player's section
+def remove_player(id):
+    unsubscribe_player(id)
+    player = players.pop(id)
+
+    if players_by_addr.get(player.addr) == id:
+        del players_by_addr[player.addr]
+
+    announce("/unroute", id, player.addr)
+
+# Tell the dispatcher of a multi-process front to route a player's datagrams and requests to us or not
+def announce(path, id, addr):
+    if dispatcher is not None:
+        try:
+            dispatcher.notice("POST", path, pickle.dumps((id, addr)))
+        except OSError: # Dispatcher is gone and we'll be too
+            pass
+
+# Receive a datagram from sock, our socket or the one the dispatcher passes datagrams on to with their sender
+def receive(sock):
+    if sock is not inbox:
+        return sock.recvfrom(settings.MAX_DATAGRAM)
+
+    return codec.decode_forwarded(sock.recv(settings.MAX_DATAGRAM))
+
+# Whether a neighbor section is simulated in this process, the sections of other workers of
+# a multi-process front share our address
+def is_local(neighbor):
+    return neighbor[0] == addrport and (dispatcher is None or neighbor[1] in sections)
+
+# Make a request of another component, requests to our own address from a worker of a multi-process
+# front go to the dispatcher as it knows which worker has the section
+def request(address, method, path, body=b""):
+    if address == addrport and dispatcher is not None:
+        return dispatcher.request(method, path, body)
+
+    return connpool.request(address, method, path, body)
+
+# Start sending section updates to a player that has fetched the section
+# Updates to the player are numbered from the section's current view version
+# Caller must have the lock of the player's section
+def subscribe_player(id):
+    section = players[id].section
 
-    for x in ("pingcount", "rtt", "last_sent_ack", "recv_buffer", "send_buffer", "last_recvd_ack"):
-        if x in player:
-            del player[x]
+    players[id].send_buffer = {}
+    players[id].sent_states = {} # Object state behind each update not yet acknowledged
+    players[id].baselines = {} # Last acknowledged state and its sequence number for each object
+    players[id].hole_resends = {} # Time of the last resend of each update the player reported missing
+    players[id].send_times = {} # Send and resend times of each update, shared by updates sent together
+    players[id].seq = sections[section]["view_version"]
+    players[id].last_recvd_ack = sections[section]["view_version"]
+    subscribers.setdefault(section, set()).add(id)
 
-    return player
+    if settings.AOI_RADIUS is not None:
+        watch_ship(section, id)
 
-# Up version number for object and send updates to everyone
-# Caller must have sections_lock, players_lock
-def update_object(section_id, id):
-    global s, s_lock, resend_queue, store_resend_queue
+# Stop sending section updates to a player
+# Caller must have the lock of the player's section
+def unsubscribe_player(id):
+    for version in players[id].send_buffer or ():
+        resend_timers.cancel((id, version))
 
+    for x in ("send_buffer", "sent_states", "baselines", "hole_resends", "send_times"):
+        setattr(players[id], x, None)
+
+    if players[id].section in subscribers:
+        subscribers[players[id].section].discard(id)
+
+    if players[id].section in interest_grids:
+        interest_grids[players[id].section].unwatch(id)
+
+# Interest grid of a section, placing all objects and subscribers if it has not been built yet
+# Caller must have the section's lock
+def get_interest(section_id):
+    if section_id not in interest_grids:
+        grid = interest_grids[section_id] = interest.Interest_grid()
+
+        for id, obj in sections[section_id]["objects"].items():
+            if obj is not None:
+                grid.place(id, obj.loc)
+
+        for id, obj in ghosts.visible_ghosts(sections[section_id]).items():
+            grid.place(id, obj.loc)
+
+        for id in subscribers.get(section_id, ()):
+            watch_ship(section_id, id)
+
+    return interest_grids[section_id]
+
+# Make a player watch the cells around their ship
+# Returns cells the player started and stopped watching
+# Caller must have the section's lock
+def watch_ship(section_id, id):
+    ship = sections[section_id]["objects"].get(id)
+
+    if ship is None: # No ship here, the player sees nothing until it arrives
+        get_interest(section_id).unwatch(id)
+        return set(), set()
+
+    return get_interest(section_id).watch(id, ship.loc)
+
+# Section data as seen by a player, with ghosts, only objects in their area of interest are included
+# Caller must have the section's lock
+def player_view(section_id, id):
+    section = clean_section(sections[section_id])
+    section["id"] = section_id
+    section["version"] = sections[section_id]["view_version"]
+
+    for obj, ghost in ghosts.visible_ghosts(sections[section_id]).items():
+        section["objects"][obj] = ghost.wire()
+
+    if settings.AOI_RADIUS is not None:
+        visible = get_interest(section_id).visible_to(id)
+        section["objects"] = { obj: section["objects"][obj] for obj in section["objects"] if obj in visible }
+
+    return section
+
+# Section as a player sees it and pickled, both cached until the section changes
+# Players share one snapshot, or with area of interest one for each set of grid cells they watch
+# Caller must have the section's lock
+def section_snapshot(section_id, id):
+    key = frozenset(get_interest(section_id).player_cells.get(id, ())) if settings.AOI_RADIUS is not None else None
+    snapshots = sections[section_id].setdefault("snapshots", {})
+
+    if key not in snapshots:
+        view = player_view(section_id, id)
+        snapshots[key] = (view, pickle.dumps(view))
+
+    return snapshots[key]
+
+# Reset connection state of a player that is new to us or to a section
+def reset_player(player):
+    player.pingcount = 0
+    player.rtt = rtt.Rtt_estimator()
+    player.last_sent_ack = -1 # last consecutively acked packet
+    player.recv_buffer = {} # list of received packet id's after last_sent_ack
+    player.command_bucket = ratelimit.Token_bucket() # Limits how fast commands are carried out
+
+# Up version numbers for object and queue an update for everyone
+# Players see everything in the section, counted by its view version, the store only keeps our own
+# objects, counted by its version. An object that isn't ours is sent to players as its ghost if we
+# have one and to the store as removed, unless store is False, as for ghosts that merely moved
+# Updates are sent right away unless flush is False, in which case the caller must flush_updates
+# Caller must have the section's lock
+def update_object(section_id, id, flush=True, store=True):
     section = sections[section_id]
-    obj = clean_object(section["objects"][id])
+    owned = section["objects"].get(id) is not None
+    obj = clean_object(ghosts.visible_object(section, id))
+    version = None
+
+    if store:
+        section["version"] += 1
+        version = section["version"]
+
+    section["view_version"] += 1
+    section.pop("snapshots", None)
+
+    pending_updates.setdefault(section_id, []).append((section["view_version"], version, id, obj, owned))
+
+    # Neighbors are told about our objects that changed with the next tick
+    if settings.GHOST_ZONE is not None and id in section["objects"]:
+        section.setdefault("ghost_changes", set()).add(id)
+
+    if flush:
+        flush_updates(section_id)
+
+# Split encoded updates into runs whose batched message fits in one datagram
+def batch_updates(updates):
+    batches = []
+    batch = []
+    size = codec.UPDATES_HEADER_SIZE
+
+    for update in updates:
+        if batch and size + len(update[1]) > settings.UPDATE_MTU:
+            batches.append(batch)
+            batch = []
+            size = codec.UPDATES_HEADER_SIZE
+
+        batch.append(update)
+        size += len(update[1])
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+# Send a batch of encoded updates with consecutive versions to the store and keep it until acknowledged
+# Caller must have the section's lock
+def send_to_store(section_id, batch):
+    last = batch[-1][0]
+    store_packet = codec.pack_store_updates(section_id, batch[0][0], [encoded for version, encoded in batch])
+
+    send(store_packet, settings.STORE_ADDRPORT)
+    sections[section_id]["store_buffer"][last] = (store_packet, time.time())
+    store_resend_timers.schedule((section_id, last), time.time() + settings.STORE_RESEND_TIMEOUT)
+
+# Release batches the store has acknowledged, it acknowledges all versions it has applied in order
+# Caller must have the section's lock
+def store_ack(section_id, version):
+    buffer = sections[section_id]["store_buffer"]
+
+    for last in [last for last in buffer if last <= version]:
+        packet, sent = buffer.pop(last)
+        store_resend_timers.cancel((section_id, last))
+
+        if sent is not None: # Not resent
+            metrics.observe("ack_latency_seconds", time.time() - sent, 'from="store"')
+
+# Send queued updates of a section to store and subscribed players
+# Caller must have the section's lock
+def flush_updates(section_id):
+    updates = []
+    store_updates = []
+
+    # Encode each object state once, it is shared by the store and all players
+    # The store only keeps our own objects, to it a ghost is an object that isn't there
+    # It applies updates in order, so once it has an object's name it gets only a reference to it
+    store_names = sections[section_id].setdefault("store_names", {})
+
+    for view_version, version, id, obj, owned in pending_updates.pop(section_id, []):
+        encoded = codec.encode_object(id, obj)
+        updates.append((view_version, id, obj, encoded))
+
+        if version is None:
+            continue
+
+        if not owned:
+            store_names.pop(id, None)
+            store_updates.append((version, encoded if obj is None else codec.encode_object(id, None)))
+        elif store_names.get(id) == obj["name"]:
+            store_updates.append((version, codec.name_reference(encoded)))
+        else:
+            store_names[id] = obj["name"]
+            store_updates.append((version, encoded))
+
+    # First update store, always in batches as it has no use for single updates
+    for batch in batch_updates(store_updates):
+        send_to_store(section_id, batch)
+
+    if settings.BATCH_UPDATES:
+        batches = batch_updates([(version, encoded) for version, id, obj, encoded in updates])
+    else:
+        batches = [[(version, encoded)] for version, id, obj, encoded in updates]
+
+    for batch in batches:
+        first = batch[0][0]
+        last = batch[-1][0]
+        objects = [encoded for version, encoded in batch]
+
+        # Without area of interest or deltas every subscriber gets every update, sharing one encoded packet
+        if settings.AOI_RADIUS is None and not settings.DELTA_UPDATES:
+            packet = codec.pack_updates(first, objects)
+
+            for p in subscribers.get(section_id, ()):
+                players[p].seq = last
+                buffer_update(p, first, last, packet)
+
+                send(packet, players[p].addr)
+
+    if settings.AOI_RADIUS is not None:
+        outgoing = interest_updates(section_id, updates)
+    elif settings.DELTA_UPDATES:
+        outgoing = { p: updates for p in subscribers.get(section_id, ()) }
+    else:
+        return
+
+    # Players with the same baseline for an object share its delta
+    deltas = {}
+
+    for p, entries in outgoing.items():
+        send_to_player(p, entries, deltas)
+
+# Work out which subscribers get which of the updates of a section by their area of interest
+# Players near an object get its updates, players it moves away from get it removed and players
+# it moves closer to, or whose ship moves closer to it, get its full state
+# Returns updates to send to each player as (version, object id, object, encoded object)
+# Caller must have the section's lock
+def interest_updates(section_id, updates):
+    grid = get_interest(section_id)
+    section_subscribers = subscribers.get(section_id, ())
+    section = sections[section_id]
+    outgoing = {}
 
-    section["version"] += 1
-    version = section["version"]
+    for version, id, obj, encoded in updates:
+        old_cell, new_cell = grid.place(id, obj["loc"] if obj is not None else None)
 
-    # First update store
-    store_packet = b"UPDATE" + pickle.dumps((section_id, version, id, obj))
-    with s_lock:
-        try_send(s, store_packet, settings.STORE_ADDRPORT)
-    sections[section_id]["store_buffer"][version] = store_packet
-    store_resend_queue.put((time.time(), (section_id, version)))
+        # A player's ship changed cells, tell them about objects entering and leaving their view
+        if id in section_subscribers and old_cell != new_cell:
+            entered, left = watch_ship(section_id, id)
+
+            for other in grid.objects_in(entered) - {id}:
+                state = clean_object(ghosts.visible_object(section, other))
+                outgoing.setdefault(id, []).append((None, other, state, codec.encode_object(other, state)))
+            for other in grid.objects_in(left) - {id}:
+                outgoing.setdefault(id, []).append((None, other, None, codec.encode_object(other, None)))
+
+        new_watchers = grid.watchers_of(new_cell)
+
+        for p in new_watchers:
+            outgoing.setdefault(p, []).append((version, id, obj, encoded))
+
+        if old_cell != new_cell: # Object left the view of players not watching its new cell
+            removed = (None, id, None, codec.encode_object(id, None))
+
+            for p in grid.watchers_of(old_cell) - new_watchers:
+                outgoing.setdefault(p, []).append(removed)
+
+    return outgoing
+
+# Encode an update for a player as a delta from the last state of the object they acknowledged
+# Falls back to the full state if they have no baseline for the object
+# deltas caches encoded deltas by update and baseline
+# Caller must have the lock of the player's section
+def encode_for_player(player, update, deltas):
+    version, obj_id, obj, encoded = update
 
-    # Update all players
-    for p in players:
-        if players[p]["section"] == section_id and "send_buffer" in players[p]:
-            packet = b"UPDATE" + pickle.dumps((version, id, obj))
-            players[p]["send_buffer"][version] = packet
+    if not settings.DELTA_UPDATES or obj is None or obj_id not in player.baselines:
+        return encoded
 
-            with s_lock:
-                try_send(s, packet, players[p]["addr"])
-                resend_queue.put((time.time(), (p, version)))
+    base_seq, base = player.baselines[obj_id]
+    key = (version, base_seq, id(base))
 
-# Update object location based, direction, speed, and time since last update
-# Caller must have sections_lock
-def move_object(obj):
-    dir = math.radians(obj["direction"])
-    cur_loc = obj["loc"]
+    if version is None or key not in deltas:
+        deltas[key] = codec.encode_delta(obj_id, base_seq, base, obj)
 
-    interval = time.time() - obj["last_move"]
+    return deltas[key] or encoded
 
-    xloc = round(cur_loc[0] + interval * obj["speed"] * math.cos(dir), 3)
-    yloc = round(cur_loc[1] + interval * obj["speed"] * math.sin(dir), 3)
+# Send updates to a player, numbered in the player's own sequence
+# Caller must have the lock of the player's section
+def send_to_player(p, updates, deltas):
+    player = players[p]
+    objects = [(update, encode_for_player(player, update, deltas)) for update in updates]
 
-    obj["loc"] = (xloc, yloc)
-    obj["last_move"] = time.time()
+    if settings.BATCH_UPDATES:
+        batches = batch_updates(objects)
+    else:
+        batches = [[entry] for entry in objects]
+
+    for batch in batches:
+        first = player.seq + 1
+        player.seq += len(batch)
+        packet = codec.pack_updates(first, [encoded for update, encoded in batch])
+
+        # Deltas are only sent once, resends carry full states as the player may have dropped the
+        # baselines by then, so they can be larger than UPDATE_MTU
+        if settings.DELTA_UPDATES:
+            full_packet = codec.pack_updates(first, [update[3] for update, encoded in batch])
+
+            for seq, (update, encoded) in enumerate(batch, first):
+                player.sent_states[seq] = (update[1], update[2])
+        else:
+            full_packet = packet
+
+        buffer_update(p, first, player.seq, full_packet)
+
+        send(packet, player.addr)
+
+# Keep updates first to last sent to a player for resending until they are acknowledged
+# Caller must have the lock of the player's section
+def buffer_update(p, first, last, packet):
+    player = players[p]
+    sent = { "time": time.time(), "resent": None, "acked": False }
+
+    for seq in range(first, last + 1):
+        player.send_buffer[seq] = packet
+        player.send_times[seq] = sent
+
+    resend_timers.schedule((p, last), sent["time"] + player.rtt.rto)
+
+# Resend updates to a player, marking them resent so their ACKs give no RTT samples
+# Caller must have the lock of the player's section
+def resend_update(player, seq):
+    player.send_times[seq]["resent"] = time.time()
+    send(player.send_buffer[seq], player.addr)
+    metrics.count("resends_total", 'to="player"')
+
+# Forget an update the player has received and measure the round trip from its ACK
+# Caller must have the lock of the player's section
+def release_update(player, seq):
+    if player.send_buffer.pop(seq, None) is not None:
+        resend_timers.cancel((player.id, seq))
+        sent = player.send_times.pop(seq)
+
+        # One sample for updates sent together, none for resent ones (Karn's rule)
+        if not sent["acked"]:
+            sent["acked"] = True
+
+            if sent["resent"] is None:
+                player.rtt.sample(time.time() - sent["time"])
+                metrics.observe("ack_latency_seconds", time.time() - sent["time"], 'from="player"')
+            else:
+                player.rtt.resend_acked(time.time() - sent["resent"])
+
+# Make an acknowledged object state the baseline for deltas to a player
+# Caller must have the lock of the player's section
+def acknowledge_state(player, seq):
+    if seq in player.sent_states:
+        id, state = player.sent_states.pop(seq)
+
+        if state is None:
+            player.baselines.pop(id, None)
+        else:
+            player.baselines[id] = (seq, state)
+
+# Process an ACK from a player: release everything acknowledged and resend the holes it reports
+# Caller must have the lock of the player's section
+def player_ack(player, version, sacked):
+    version = min(version, player.seq)
+    duplicate = version <= player.last_recvd_ack
+
+    # Each sequence number is released once as the cumulative ACK moves past it
+    for seq in range(player.last_recvd_ack + 1, version + 1):
+        release_update(player, seq)
+        acknowledge_state(player, seq)
+        player.hole_resends.pop(seq, None)
+
+    player.last_recvd_ack = max(player.last_recvd_ack, version)
+
+    # Selectively acknowledged updates need no resends, but only become baselines in order
+    for seq in sacked:
+        release_update(player, seq)
+
+    # Resend every update missing below the highest one received, or on a repeated ACK the next one
+    if sacked:
+        holes = range(player.last_recvd_ack + 1, max(sacked))
+    elif duplicate:
+        holes = [player.last_recvd_ack + 1]
+    else:
+        holes = []
+
+    now = time.time()
+    packets = {}
+
+    for seq in holes:
+        if seq in player.send_buffer and now - player.hole_resends.get(seq, 0) > player.rtt.rtt():
+            player.hole_resends[seq] = now
+            packets.setdefault(id(player.send_buffer[seq]), seq)
+
+    # Updates batched together share a packet, send it once
+    for seq in packets.values():
+        resend_update(player, seq)
+        player.rtt.fast_resend()
 
 # Notify quorum that player has moved sections/neighbors
-# Caller must have sections_lock
 def notify_quorum_of_move(obj, next_neighbor):
-    quorum_conn = http.client.HTTPConnection(settings.QUORUM_ADDRPORT[0], settings.QUORUM_ADDRPORT[1])
-
     try:
-        quorum_conn.request("POST", "/move", pickle.dumps((obj, next_neighbor)))
+        status, data = connpool.request(settings.QUORUM_ADDRPORT, "POST", "/move", pickle.dumps((obj, next_neighbor)))
 
-        response = quorum_conn.getresponse()
-        quorum_conn.close()
-
-        if response.status == 200:
+        if status == 200:
             return True
     except OSError:
         pass
 
     return False
 
-# Transfer player to another front
-# Caller must have sections_lock, players_lock
-def send_player_to_front(neighbor, section, id, ship):
-    front_conn = http.client.HTTPConnection(neighbor[0], neighbor[1])
-
-    player = clean_player(players[id])
+# Transfer player to another front, player is a clean copy of the connected player
+def send_player_to_front(neighbor, section, player, ship):
+    player = player.copy()
     player["section"] = section
 
     try:
-        front_conn.request("POST", "/move", pickle.dumps((player, ship)))
+        status, data = request(neighbor, "POST", "/move", pickle.dumps((player, ship)))
 
-        response = front_conn.getresponse()
-        front_conn.close()
-
-        if response.status == 200:
+        if status == 200:
             return True
     except OSError:
         pass
 
     return False
 
-# Update movement for all objects in section
-# Caller must have sections_lock, players_lock
-def move_all_in_section(section):
-    for obj in sections[section]["objects"]:
-        if sections[section]["objects"][obj] is not None and sections[section]["objects"][obj]["speed"] > 0:
-            move_object(sections[section]["objects"][obj])
-
-            xloc, yloc = sections[section]["objects"][obj]["loc"]
-            next_neighbor = None
-
-            # Check if player is outside section boundary and find possible neighbor
-            if xloc > settings.SECTION_XSIZE/2:
-                if "e-neighbor" in sections[section]:
-                    next_neighbor = sections[section]["e-neighbor"]
-                    xloc -= settings.SECTION_XSIZE
-                else:
-                    sections[section]["objects"][obj]["loc"] = (settings.SECTION_XSIZE/2, yloc)
-            elif xloc < -settings.SECTION_XSIZE/2:
-                if "w-neighbor" in sections[section]:
-                    next_neighbor = sections[section]["w-neighbor"]
-                    xloc += settings.SECTION_XSIZE
-                else:
-                    sections[section]["objects"][obj]["loc"] = (-settings.SECTION_XSIZE/2, yloc)
-            elif yloc > settings.SECTION_YSIZE/2:
-                if "n-neighbor" in sections[section]:
-                    next_neighbor = sections[section]["n-neighbor"]
-                    yloc -= settings.SECTION_YSIZE
-                else:
-                    sections[section]["objects"][obj]["loc"] = (xloc, settings.SECTION_YSIZE/2)
-            elif yloc < -settings.SECTION_YSIZE/2:
-                if "s-neighbor" in sections[section]:
-                    next_neighbor = sections[section]["s-neighbor"]
-                    yloc += settings.SECTION_YSIZE
-                else:
-                    sections[section]["objects"][obj]["loc"] = (xloc, -settings.SECTION_YSIZE/2)
-            
-            # If there is a neighbor, send player there
-            if next_neighbor is not None:
-                print("Next neighbor", next_neighbor, addrport)
-                new_obj = clean_object(sections[section]["objects"][obj])
-                new_obj["loc"] = (xloc, yloc)
-                new_obj["last_move"] = time.time()
-
-                if next_neighbor[0] == addrport: # Neighbor is us, just move sections
-                        print("Moving player to another section")
-                        if notify_quorum_of_move(obj, next_neighbor):
-                            sections[section]["objects"][obj] = None
-                            sections[next_neighbor[1]]["objects"][obj] = new_obj
-                            update_object(next_neighbor[1], obj)
-
-                            # If player is logged in, clean connection
-                            if obj in players:
-                                players[obj]["section"] = next_neighbor[1]
-
-                                with s_lock:
-                                    s.sendto(b"FRONT:" + pickle.dumps(addrport), players[obj]["addr"])
-                                players[obj]["pingcount"] = 0
-                                players[obj]["rtt"] = settings.PLAYER_INITIAL_RTT
-                                players[obj]["last_sent_ack"] = -1 # last consecutively acked packet
-                                players[obj]["recv_buffer"] = {}
-                                if "send_buffer" in players[obj]:
-                                    del players[obj]["send_buffer"]
-                        else:
-                            print("Quorum failed")
-                else: # Send player to another front
-                    print("Transferring player to front", next_neighbor[0], "section", next_neighbor[1])
-                    
-                    if send_player_to_front(next_neighbor[0], next_neighbor[1], obj, new_obj):
-                        sections[section]["objects"][obj] = None
-                        if obj in players:
-                            with s_lock:
-                                s.sendto(b"FRONT:" + pickle.dumps(next_neighbor[0]), players[obj]["addr"])
-                            del players[obj]
-                    else:
-                        print("Transfer failed")
-
-            update_object(section, obj)
+# Move all objects in section, clamp them at edges without a neighbor and send updates as one batch
+# Objects that crossed into a neighbor are handed off to it
+# Caller must have the section's lock
+def advance_section(section, now):
+    moved, crossings = movement.move_section(sections[section], now)
+    changed = commanded.pop(section, set())
+
+    for obj in moved:
+        update_object(section, obj, flush=False)
+        changed.discard(obj)
+
+    # Ships changed by commands but not moving, such as those just stopped, and not since gone elsewhere
+    for obj in changed:
+        if sections[section]["objects"].get(obj) is not None:
+            update_object(section, obj, flush=False)
+
+    # Send everything that moved during this tick together
+    flush_updates(section)
+    publish_ghosts(section)
+
+    for obj, next_neighbor, loc in crossings:
+        start_handoff(section, obj, next_neighbor, loc)
+
+# Start handing an object that crossed the section edge over to its neighbor
+# The object stays frozen where it crossed, still visible to players, until the handoff is done or given up
+# Caller must have the section's lock
+def start_handoff(section, obj, next_neighbor, loc):
+    print("Next neighbor", next_neighbor, addrport)
+
+    sections[section].setdefault("handoffs", {})[obj] = { "state": "pending", "neighbor": next_neighbor, "loc": loc, "started": time.time() }
+    movement.invalidate(sections[section])
+
+    handoff_queue.put((section, obj))
+
+# Take one step of a handoff: pending -> accepted by the target -> quorum notified -> released by us
+# A move within this front needs nothing accepted, a front we send the player to notifies the quorum
+# before accepting. The calls to other components are made without holding any locks.
+def run_handoff(section, obj):
+    with locked_sections(section):
+        job = sections[section].get("handoffs", {}).get(obj) if section in sections else None
+
+        if job is None: # Section or object went away meanwhile
+            return
+
+        state, next_neighbor = job["state"], job["neighbor"]
+
+        if state == "pending" and not is_local(next_neighbor):
+            ship = clean_object(sections[section]["objects"][obj])
+            ship["loc"] = job["loc"]
+
+            # Only connected players can be sent to another front
+            player = clean_player(players[obj]) if obj in players else None
+
+    if state == "pending":
+        if is_local(next_neighbor): # Neighbor is us
+            state = "accepted"
+        elif player is None:
+            state = "failed"
+        else:
+            print("Transferring player to front", next_neighbor[0], "section", next_neighbor[1])
+
+            if send_player_to_front(next_neighbor[0], next_neighbor[1], player, ship):
+                state = "notified"
+
+    if state == "accepted":
+        print("Moving player to another section")
+
+        if notify_quorum_of_move(obj, next_neighbor):
+            state = "notified"
+
+    finish_handoff(section, obj, next_neighbor, state)
+
+# Record the outcome of a handoff step: release the object once the quorum knows where it went,
+# otherwise retry the step after HANDOFF_RETRY or give up after HANDOFF_TIMEOUT
+def finish_handoff(section, obj, next_neighbor, state):
+    with locked_sections(section, next_neighbor[1] if is_local(next_neighbor) else None):
+        job = sections[section].get("handoffs", {}).get(obj) if section in sections else None
+
+        if job is None:
+            return
+
+        job["state"] = state
+
+        if state == "notified" and sections[section]["objects"].get(obj) is not None:
+            if not is_local(next_neighbor):
+                release_to_front(section, obj, next_neighbor)
+            elif next_neighbor[1] in sections:
+                release_to_section(section, obj, next_neighbor, job["loc"])
+            else:
+                state = "failed"
+
+            if state == "notified":
+                del sections[section]["handoffs"][obj]
+                return
+
+        if state == "failed" or time.time() > job["started"] + settings.HANDOFF_TIMEOUT:
+            print("Handoff of", obj, "to", next_neighbor, "failed")
+
+            # Let the object go at the edge, it is handed off again if it keeps going
+            del sections[section]["handoffs"][obj]
+            ship = sections[section]["objects"].get(obj)
+
+            if ship is not None:
+                movement.clamp(ship)
+                ship.last_move = time.time()
+                movement.invalidate(sections[section])
+                update_object(section, obj)
+        else:
+            handoff_timers.schedule((section, obj), time.time() + settings.HANDOFF_RETRY)
+
+# Move an object to another section of ours after the quorum was notified
+# Caller must have the locks of both sections
+def release_to_section(section, obj, next_neighbor, loc):
+    new_obj = sections[section]["objects"][obj]
+    ghosts.hand_over(sections[section], next_neighbor[1], obj, new_obj)
+    new_obj.loc = loc
+    new_obj.last_move = time.time()
+
+    sections[section]["objects"][obj] = None
+    sections[next_neighbor[1]]["objects"][obj] = new_obj
+    movement.invalidate(sections[section])
+    movement.invalidate(sections[next_neighbor[1]])
+    update_object(next_neighbor[1], obj)
+
+    # If player is logged in, clean connection
+    with players_lock:
+        if obj in players:
+            unsubscribe_player(obj)
+            players[obj].section = next_neighbor[1]
+
+            send(b"FRONT:" + codec.encode_address(addrport), players[obj].addr)
+            reset_player(players[obj])
+
+    update_object(section, obj)
+
+# Drop an object another front has accepted and send its player there
+# Caller must have the section's lock
+def release_to_front(section, obj, next_neighbor):
+    ghosts.hand_over(sections[section], next_neighbor[1], obj, sections[section]["objects"][obj])
+    sections[section]["objects"][obj] = None
+    movement.invalidate(sections[section])
+
+    with players_lock:
+        if obj in players:
+            send(b"FRONT:" + codec.encode_address(next_neighbor[0]), players[obj].addr)
+            remove_player(obj)
+
+    update_object(section, obj)
+
+# Handoff thread: run handoff steps as they are started or come up for retry
+def front_handoffs():
+    print("Starting front handoffs")
+    while True:
+        section, obj = handoff_queue.get()
+
+        run_handoff(section, obj)
+
+# Queue ghost messages to the neighbors of a section about its objects that changed since the last ones
+# Caller must have the section's lock
+def publish_ghosts(section_id):
+    if settings.GHOST_ZONE is None:
+        return
+
+    messages = ghosts.publish(sections[section_id], sections[section_id].pop("ghost_changes", set()))
+
+    if messages:
+        with ghost_ready:
+            for key, neighbor, full, states in messages:
+                ghost_outbox.put(section_id, key, neighbor, full, states)
+
+            ghost_ready.notify()
+
+# Send a ghost message to the section whose key neighbor source is, returns whether it was taken
+def send_ghosts(source, key, neighbor, full, states):
+    if is_local(neighbor):
+        return receive_ghosts(source, neighbor[1], key, full, states)
+
+    try:
+        status, data = request(neighbor[0], "POST", "/ghosts", pickle.dumps((source, neighbor[1], key, full, states)))
+
+        return status == 200
+    except OSError:
+        return False
+
+# Apply a ghost message from the neighbor source of our section target and update our players
+# Returns whether the message was taken, not if we don't have the section or it has no such neighbor
+# Takes the section's lock, caller must not hold any section locks
+def receive_ghosts(source, target, key, full, states):
+    with locked_sections(target):
+        changed = ghosts.apply(sections[target], source, key, full, states) if target in sections else None
+
+        if changed is None:
+            return False
+
+        # Objects that are ours already don't change for players, the store never hears of ghosts
+        for id in changed:
+            if sections[target]["objects"].get(id) is None:
+                update_object(target, id, flush=False, store=False)
+
+        flush_updates(target)
+
+    return True
+
+# Forget what a neighbor we failed to send ghosts to has, it is sent everything after GHOST_RETRY
+# Takes the section's lock, caller must not hold any section locks
+def ghost_failed(section, key, neighbor):
+    with locked_sections(section):
+        if section in sections and sections[section].get(key) == neighbor:
+            sections[section].get("ghosted", {}).pop(key, None)
+            ghost_timers.schedule((section, key), time.time() + settings.GHOST_RETRY)
+
+# Send ghost messages taken from ghost_outbox, those that fail are resynced after GHOST_RETRY
+# Takes section locks, caller must not hold any section locks
+def send_ghost_messages(messages):
+    for section, key, neighbor, full, states in messages:
+        if send_ghosts(section, key, neighbor, full, states):
+            metrics.count("ghost_messages_total", 'result="sent"')
+        else:
+            metrics.count("ghost_messages_total", 'result="failed"')
+            ghost_failed(section, key, neighbor)
+
+# Take the ghost messages waiting in ghost_outbox, an empty list if there are none
+def take_ghost_messages():
+    with ghost_ready:
+        return ghost_outbox.take()
+
+# Ghost thread: send ghost messages as they are queued, messages queued while we wait on
+# a neighbor are merged and go out together next round
+def front_ghosts():
+    print("Starting front ghosts")
+    while True:
+        with ghost_ready:
+            while not ghost_outbox:
+                ghost_ready.wait()
+
+            messages = ghost_outbox.take()
+
+        send_ghost_messages(messages)
+
+# Update movement for all objects in section to simulation time now and start handoffs of those that left it
+# Takes the section's lock, caller must not hold any section locks
+def move_all_in_section(section, now):
+    with locked_sections(section):
+        advance_section(section, now)
 
 # Transfer section data to store
-# Caller must have sections_lock
+# Caller must have the section's lock
 def store_section(section_id):
-    store_conn = http.client.HTTPConnection(settings.STORE_ADDRPORT[0], settings.STORE_ADDRPORT[1])
     data = pickle.dumps((section_id, clean_section(sections[section_id]), FRONT, addrport))
 
     try:
-        store_conn.request("POST", "/map", data)
+        status, response = connpool.request(settings.STORE_ADDRPORT, "POST", "/map", data)
 
-        response = store_conn.getresponse()
-        store_conn.close()
+        if status == 200:
+            # The store has everything now
+            for version in sections[section_id].get("store_buffer", ()):
+                store_resend_timers.cancel((section_id, version))
 
-        if response.status == 200:
             sections[section_id]["store_buffer"] = {}
+            sections[section_id]["store_names"] = { id: obj.name for id, obj in sections[section_id]["objects"].items() if obj is not None }
             return True
     except OSError:
         pass
@@ -266,333 +914,445 @@ def store_section(section_id):
     return False
 
 # Process a command from a player
-# Caller must have sections_lock, players_lock
+# Caller must have the lock of the player's section
 def player_command(player, cmd):
-    id = player["id"]
-    ship = sections[player["section"]]["objects"][id]
+    id = player.id
+    ship = sections[player.section]["objects"][id]
+
+    # Update player's movement first if their ship is moving and not frozen for a handoff
+    if ship.speed > 0 and id not in sections[player.section].get("handoffs", ()):
+        move_object(ship, time.time())
 
-    # Update player's movement first if their ship is moving
-    if ship["speed"] > 0:
-        move_object(ship)
+    # Speed and direction of the ship change outside the tick
+    movement.invalidate(sections[player.section])
 
     if cmd == b"NOP": # Do nothing
-        print("NOP from", player["name"])
+        print("NOP from", player.name)
     if cmd[:5] == b"SPEED": # Change speed
         speed = struct.unpack_from("!h", cmd[5:])[0]
 
-        if ship["speed"] == 0 and speed > 0:
-            ship["last_move"] = time.time()
+        if ship.speed == 0 and speed > 0:
+            ship.last_move = time.time()
 
-        ship["speed"] = speed
+        ship.speed = speed
 
         if speed == 0:
-            print(player["name"], "stopped")
-            if "last_move" in ship:
-                del ship["last_move"]
+            print(player.name, "stopped")
+            ship.last_move = None
         else:
-            print(player["name"], "changed speed to", speed)
+            print(player.name, "changed speed to", speed)
     if cmd[:3] == b"DIR": # Change direction
         dir = struct.unpack_from("!h", cmd[3:])[0]
 
-        ship["direction"] = dir
-        print(player["name"], "changed direction to", dir)
+        ship.direction = dir
+        print(player.name, "changed direction to", dir)
+
+    # The ship's new state goes out with the tick, however many commands came before it
+    commanded.setdefault(player.section, set()).add(id)
+
+# Handle a datagram from a player
+# Caller must have the lock of the player's section
+def player_datagram(player, data, addr):
+    if data[:4] == b"PONG": # Player keepalive reply
+        with players_lock:
+            player.pingcount = 0
+            player.rtt.sample(time.time() - struct.unpack("!d", data[4:])[0])
+    elif data[:3] == b"ACK": # Player packet acknowledgement
+        try:
+            version, sacked = codec.decode_ack(data[3:])
+        except ValueError:
+            print("Malformed ACK from", player.name)
+            return
+
+        player_ack(player, version, sacked)
+    elif data[:4] == b"QUIT": # Player quit
+        print("Player", player.id, "quit")
+        with players_lock:
+            remove_player(player.id)
+    else: # All else is player commands
+        seq = struct.unpack_from("!l", data)[0]
+        payload = data[4:]
+
+        # Insert command to buffer
+        if seq > player.last_sent_ack and seq not in player.recv_buffer:
+            player.recv_buffer[seq] = payload
+        
+        # Execute consecutive commands from buffer
+        while player.last_sent_ack+1 in player.recv_buffer:
+            command = player.recv_buffer.pop(player.last_sent_ack+1)
+            player.last_sent_ack += 1
+
+            # A flood is acknowledged like any commands so the player stops resending, but ignored
+            if player.command_bucket.take():
+                player_command(player, command)
+            else:
+                metrics.count("commands_rejected_total")
+
+        send(b"ACK" + codec.encode_ack(player.last_sent_ack, player.recv_buffer), addr) # ACK the commands executed and those waiting for an earlier one
+
+# Read the datagrams waiting on sock, at most RECV_BATCH of them
+# Caller must have made sock non-blocking
+def receive_batch(sock):
+    batch = []
+
+    while len(batch) < settings.RECV_BATCH:
+        try:
+            batch.append(receive(sock))
+        except BlockingIOError:
+            break
+
+    return batch
+
+# Handle a datagram from the quorum, the store or a player
+# Returns the time of the quorum's keepalive if it was one
+def handle_datagram(data, addr):
+    metrics.count_packet("in", codec.message_type(data) or "command")
+
+    if addr == settings.QUORUM_ADDRPORT:
+        if data == b"PING": # Keepalive from quorum
+            send(b"PONG", addr)
+            return time.time()
+    elif addr == settings.STORE_ADDRPORT:
+        if data[:3] == b"ACK": # ACK from store
+            try:
+                section, version = codec.decode_store_ack(data[3:])
+            except ValueError:
+                print("Malformed ACK from store")
+                section = None
+
+            with locked_sections(section):
+                if section in sections:
+                    store_ack(section, version)
+    else: # Other packets will be player messages
+        with players_lock:
+            id = players_by_addr.get(addr)
+
+        known = False
 
-    # Update map version and send updates
-    update_object(player["section"], id)
+        if id is not None:
+            with locked_player(id) as section:
+                # Only players that have fetched their section can talk to us
+                if section in sections and players[id].addr == addr and players[id].send_buffer is not None:
+                    player_datagram(players[id], data, addr)
+                    known = True
+
+        if not known: # Unknown player, tell them to find another front
+            send(b"FRONT!", addr)
+
+    return None
+
+# Resend everything that is due at now, acknowledged updates have had their timers cancelled
+# Takes section locks, caller must not hold any section locks
+def resend_due(now):
+    for player, version in resend_timers.expired(now):
+        with locked_player(player) as section:
+            if section is not None and version in (players[player].send_buffer or ()):
+                resend_update(players[player], version)
+
+                players[player].rtt.backoff()
+                resend_timers.schedule((player, version), time.time() + players[player].rtt.rto)
+
+    for section_id, version in store_resend_timers.expired(now):
+        with locked_sections(section_id):
+            if section_id in sections and version in sections[section_id]["store_buffer"]:
+                packet, sent = sections[section_id]["store_buffer"][version]
+                sections[section_id]["store_buffer"][version] = (packet, None)
+
+                send(packet, settings.STORE_ADDRPORT)
+                metrics.count("resends_total", 'to="store"')
+                store_resend_timers.schedule((section_id, version), time.time() + settings.STORE_RESEND_TIMEOUT)
 
 # UDP listener thread for front
+# Each round drains the datagrams waiting, handles them all, runs the resends that are due and only
+# then sends out the replies and resends, so a burst costs one round and one s_lock acquisition
 def front_listener():
-    global s, s_lock, resend_queue, store_resend_queue
-
     last_quorum_ping = time.time()
-    last_move = time.time()
-    next_timeout = 1
+    sock = inbox or s
+    timeout = settings.FRONT_TIMEOUT
+
+    # Only we read from the socket, sending never waits as a full send buffer drops the datagram
+    sock.setblocking(False)
 
     while True:
-        try:
-            data, addr = s.recvfrom(1024)
+        readable, writable, failed = select.select([sock], [], [], max(timeout, settings.TIMER_RESOLUTION))
+        batch = receive_batch(sock) if readable else []
 
-            if addr == settings.QUORUM_ADDRPORT:
-                if data == b"PING": # Keepalive from quorum
-                    last_quorum_ping = time.time()
-                    with s_lock:
-                        try_send(s, b"PONG", addr)
-            elif addr == settings.STORE_ADDRPORT:
-                if data[:3] == b"ACK": # ACK from store
-                    section, version = struct.unpack_from("!ll", data[3:])
+        if batch:
+            metrics.observe("recv_batch_datagrams", len(batch))
+
+        start_batch()
+
+        for data, addr in batch:
+            try:
+                last_quorum_ping = handle_datagram(data, addr) or last_quorum_ping
+            except (struct.error, ValueError):
+                print("Malformed packet from", addr)
 
-                    with sections_lock:
-                        if section in sections and version in sections[section]["store_buffer"]:
-                            del sections[section]["store_buffer"][version]
-            else: # Other packets will be player messages
-                with sections_lock, players_lock:
-                    player = None
-
-                    for p in players:
-                        if players[p]["addr"] == addr and "send_buffer" in players[p]:
-                            player = players[p]
-                            break
-         
-                    if player:
-                        if data[:4] == b"PONG": # Player keepalive reply
-                            player["pingcount"] = 0
-                            rtt = time.time() - struct.unpack("!d", data[4:])[0]
-                            player["rtt"] = rtt
-                        elif data[:3] == b"ACK": # Player packet acknowledgement
-                            version = struct.unpack_from("!l", data[3:])[0]
-                            cur_version = sections[player["section"]]["version"]
-
-                            # Fast resend if received ack older than version
-                            if version < sections[player["section"]]["version"] and version + 1 in player["send_buffer"]:
-                                with s_lock:
-                                    try_send(s, player["send_buffer"][version + 1], addr)
-                            
-                            # Clean send_buffer based on consecutive acks received
-                            for seq in list(player["send_buffer"]):
-                                if seq <= version:
-                                    del player["send_buffer"][seq]
-                            
-                            # Update ack counter
-                            while player["last_recvd_ack"] < cur_version and player["last_recvd_ack"] not in player["send_buffer"]:
-                                player["last_recvd_ack"] += 1
-
-                        elif data[:4] == b"QUIT": # Player quit
-                            print("Player", player["id"], "quit")
-                            del players[player["id"]]
-                        else: # All else is player commands
-                            seq = struct.unpack_from("!l", data)[0]
-                            payload = data[4:]
-
-                            with s_lock: # ACK the command
-                                try_send(s, b"ACK" + struct.pack("!l", seq), addr)
-
-                            # Insert command to buffer
-                            if seq > player["last_sent_ack"] and seq not in player["recv_buffer"]:
-                                player["recv_buffer"][seq] = payload
-                            
-                            # Executive consecutive commands from buffer
-                            while player["last_sent_ack"]+1 in player["recv_buffer"]:
-                                player_command(player, payload)
-                                del player["recv_buffer"][player["last_sent_ack"]+1]
-                                player["last_sent_ack"] += 1
-                    else: # Unknown player, tell them to find another front
-                        with s_lock:
-                            try_send(s, b"FRONT!", addr)
-        except socket.timeout:
-            pass
-            
         # Quorum timeout
         if time.time() - last_quorum_ping > settings.FRONT_TIMEOUT:
             print("Quorum silent, dying")
             sys.exit(0)
 
-        next_timeout = 1
+        resend_due(time.time())
 
-        # Process resends from queue
-        try:
-            while True:
-                timestamp, (player, version) = resend_queue.get(False)
+        # Sleep until the next resend is due, but wake up often enough to notice a silent quorum
+        deadlines = [d for d in (resend_timers.next_deadline(), store_resend_timers.next_deadline()) if d is not None]
+        timeout = min(deadlines + [last_quorum_ping + settings.FRONT_TIMEOUT]) - time.time()
 
-                with players_lock:
-                    if player in players and "send_buffer" in players[player] and version > players[player]["last_recvd_ack"]:
-                        to_next_resend = timestamp + 2 * players[player]["rtt"] - time.time()
-
-                        if to_next_resend < 0 and version in players[player]["send_buffer"]:
-                            with s_lock:
-                                try_send(s, players[player]["send_buffer"][version], players[player]["addr"])
-                            timestamp = time.time()
-                            resend_queue.put((timestamp, (player, version)))
-                            next_timeout = min(2 * players[player]["rtt"], next_timeout)
-                        else:
-                            resend_queue.put((timestamp, (player, version)))
-                            next_timeout = min(to_next_resend, next_timeout)
-                            break
-        except queue.Empty:
-            pass
+        flush_batch()
+    
+# Run a simulation tick at simulation time now: move everything one section at a time and queue
+# the handoff steps and ghost resyncs that have come up
+# Takes section locks, caller must not hold any section locks
+def tick(now):
+    with sections_lock:
+        section_ids = list(sections)
+
+    for section in section_ids:
+        move_all_in_section(section, now)
+
+    for key in handoff_timers.expired(now):
+        handoff_queue.put(key)
+
+    # Neighbors we failed to send ghosts to get everything with the next tick
+    for section, key in ghost_timers.expired(now):
+        with locked_sections(section):
+            if section in sections:
+                ghosts.resync(sections[section], key)
+
+# Simulation thread: move everything at a fixed tick rate, one section at a time
+def front_ticker():
+    scheduler = ticker.Tick_scheduler()
+
+    print("Starting front ticker at", settings.TICK_RATE, "Hz")
+    while True:
+        time.sleep(scheduler.delay())
 
-        # Process store resends from queue
-        try:
-            while True:
-                timestamp, (section_id, version) = store_resend_queue.get(False)
+        tick(scheduler.start())
+        scheduler.end()
+        metrics.observe("tick_seconds", scheduler.last_duration)
 
-                with sections_lock:
-                    if section_id in sections and version in sections[section_id]["store_buffer"]:
-                        to_next_resend = timestamp + settings.STORE_RESEND_TIMEOUT - time.time()
-
-                        if to_next_resend < 0:
-                            with s_lock:
-                                try_send(s, sections[section_id]["store_buffer"][version], settings.STORE_ADDRPORT)
-                            timestamp = time.time()
-                            store_resend_queue.put((timestamp, (section_id, version)))
-                            next_timeout = min(settings.STORE_RESEND_TIMEOUT, next_timeout)
-                        else:
-                            store_resend_queue.put((timestamp, (section_id, version)))
-                            next_timeout = min(to_next_resend, next_timeout)
-                            break
-        except queue.Empty:
-            pass
+        if scheduler.last_duration > scheduler.interval:
+            print("Tick overran by", round((scheduler.last_duration - scheduler.interval) * 1000, 1), "ms")
+
+# Ping all players, each unanswered ping counts towards their timeout
+def ping_players():
+    with players_lock:
+        for player in players:
+            players[player].pingcount += 1
+
+            send(b"PING" + struct.pack("!dd", players[player].rtt.srtt or 0, time.time()), players[player].addr)
+
+# Remove players that have left five pings unanswered
+# Takes section locks, caller must not hold any section locks
+def drop_silent_players():
+    with players_lock:
+        timed_out = [player for player in players if players[player].pingcount >= 5]
+
+    for player in timed_out:
+        with locked_player(player) as section, players_lock:
+            if player in players and players[player].pingcount >= 5:
+                remove_player(player)
+                print("Player", player, "timed out")
 
-        # Try to move everything at least once a second
-        if time.time() - last_move > 1:
-            with sections_lock, players_lock:
-                for section in sections:
-                    move_all_in_section(section)
-            last_move = time.time()
-    
 # Front UDP sender thread (pinger)
 def front_sender():
-    global s, s_lock
-
     print("Starting front sender")
     while True:
-        # Ping all players
+        ping_players()
+        time.sleep(1)
+        drop_silent_players()
+
+# Handle a GET request made over HTTP or passed on by the dispatcher of a multi-process front
+# Returns status and response body
+def handle_get(query, vars):
+    if query.path == "/map": # Request for map data
+        if "player" in vars and "session" in vars:
+            player = int(vars["player"][0])
+            session = vars["session"][0]
+            data = None
+
+            with locked_player(player) as section:
+                if section in sections and players[player].session == session:
+                    print("Giving section", section, "to player", player)
+
+                    # The snapshot is consistent at the section's version, the player gets updates from there
+                    subscribe_player(player)
+                    view, data = section_snapshot(section, player)
+
+                    # The player starts with these states as baselines
+                    for obj in view["objects"]:
+                        players[player].baselines[obj] = (players[player].seq, view["objects"][obj])
+
+                    # A player that already has the whole section at this version needn't get it again
+                    if settings.AOI_RADIUS is None and vars.get("section") == [str(section)] and vars.get("version") == [str(sections[section]["view_version"])]:
+                        data = b""
+
+            if data is None:
+                return 404, b""
+            elif data:
+                return 200, data
+            else:
+                return 304, b""
+
+        return 400, b""
+    elif query.path == "/metrics": # Counters, histograms and gauges for monitoring
+        return 200, metrics.render()
+    elif query.path == "/players": # Round trip times and resends of connected players
         with players_lock:
-            for player in players:
-                players[player]["pingcount"] += 1
+            ids = list(players)
 
-                with s_lock:
-                    try_send(s, b"PING" + struct.pack("!dd", players[player]["rtt"], time.time()), players[player]["addr"])
+        stats = {}
 
-        time.sleep(1)
+        for player in ids:
+            with locked_player(player) as section:
+                if section is not None:
+                    stats[player] = players[player].rtt.stats()
 
-        # Check for timeouts
-        with players_lock:
-            for player in list(players):
-                if players[player]["pingcount"] >= 5:
-                    del players[player]
-                    print("Player", player, "timed out")
+        return 200, pickle.dumps(stats)
 
-# HTTP request handler
-class front_http_handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global s, s_lock
-        protocol_version = "HTTP/1.1"
+    return 404, b""
 
-        query = urlparse(self.path)
-        vars = parse_qs(query.query)
+# Handle a POST request made over HTTP or passed on by the dispatcher of a multi-process front
+# Returns status and response body
+def handle_post(query, body):
+    if query.path == "/player": # Request to initialize a player connection
+        player = pickle.loads(body)
+        id = next(iter(player))
+        player = frontplayer.Front_player.from_wire(player[id])
+        reset_player(player)
 
-        if query.path == "/map": # Request for map data
-            if "player" in vars and "session" in vars:
-                player = int(vars["player"][0])
-                session = vars["session"][0]
+        print("Adding player", player)
+        with locked_player(id, player.section), players_lock:
+            add_player(id, player)
 
-                with sections_lock, players_lock:
-                    if player in players and players[player]["session"] == session:
-                        section = players[player]["section"]
+        return 200, b""
+    elif query.path == "/map": # Request to fetch a map section
+        source, section, neighbors = pickle.loads(body)
 
-                        move_all_in_section(section)
+        print("Told to fetch section", section, "from", source)
 
-                        print("Giving section", section, "to player", player)
+        try:
+            status, data = connpool.request(source, "GET", "/map?section=" + str(section))
 
-                        self.send_response(200)
-                        self.end_headers()
-                        self.wfile.write(pickle.dumps(clean_section(sections[section])))
+            if status == 200:
+                new_section, new_players = pickle.loads(data)
+                now = time.time()
+                new_section["objects"] = { id: gameobject.from_wire(obj, now) for id, obj in new_section["objects"].items() }
+                for x in ("e-neighbor", "w-neighbor", "n-neighbor", "s-neighbor"):
+                    if x in neighbors:
+                        new_section[x] = neighbors[x]
 
-                        players[player]["send_buffer"] = {}
-                        players[player]["last_recvd_ack"] = sections[section]["version"]
-            else:
-                self.send_response(400)
-                self.end_headers()
+                # Neighbors get everything in their strips as ghosts with the first tick
+                new_section["ghost_resync"] = set(ghosts.NEIGHBORS)
 
-    def do_POST(self):
-        protocol_version = "HTTP/1.1"
-
-        query = urlparse(self.path)
-        content_len = int(self.headers.get('Content-Length'))
-        if content_len > 0:
-            body = self.rfile.read(content_len)
-
-        if query.path == "/player": # Request to initialize a player connection
-            player = pickle.loads(body)
-            id = next(iter(player))
-            player[id]["pingcount"] = 0
-            player[id]["rtt"] = settings.PLAYER_INITIAL_RTT
-            player[id]["last_sent_ack"] = -1 # last consecutively acked packet
-            player[id]["recv_buffer"] = {} # list of received packet id's after last_sent_ack
-
-            print("Adding player", player)
-            with sections_lock, players_lock:
-                players.update(player)
-            
-            self.send_response(200)
-            self.end_headers()
-        elif query.path == "/map": # Request to fetch a map section
-            source, section, neighbors = pickle.loads(body)
-
-            print("Told to fetch section", section, "from", source)
-
-            with sections_lock, players_lock:
-                conn = http.client.HTTPConnection(source[0], source[1])
-
-                try:
-                    conn.request("GET", "/map?section=" + str(section))
-
-                    response = conn.getresponse()
-                   
-                    conn.close()
-
-                    if response.status == 200:
-                        new_section, new_players = pickle.loads(response.read())
-                        for x in ("e-neighbor", "w-neighbor", "n-neighbor", "s-neighbor"):
-                            if x in neighbors:
-                                new_section[x] = neighbors[x]
-                        for player in new_players:
-                            players[player] = new_players[player]
-                            players[player]["pingcount"] = 0
-                            players[player]["rtt"] = settings.PLAYER_INITIAL_RTT
-                            players[player]["last_sent_ack"] = -1
-                            players[player]["recv_buffer"] = {}
+                # Players are numbered from a random point, so that a version they got from the
+                # section's previous front can't match ours by chance
+                new_section["view_version"] = random.randrange(2 ** 30)
+
+                with sections_lock:
+                    section_locks.setdefault(section, metrics.lock("section"))
+
+                with locked_sections(section):
+                    with sections_lock:
                         sections[section] = new_section
-                        store_section(section)
-
-                        self.send_response(200)
-                    else:
-                        self.send_response(503)
-                except OSError:
-                    self.send_response(503)
-            self.end_headers()
-        elif query.path == "/neighbors": # Request to update neighbors for section
-            section, neighbors = pickle.loads(body)
-
-            print("Updating neighbors for section", section, neighbors)
-            with sections_lock:
-                for n in neighbors:
-                    sections[section][n] = neighbors[n]
-            
-            self.send_response(200)
-            self.end_headers()
-        elif query.path == "/move": # Request to receive a player from another front
-            player, ship = pickle.loads(body)
-            id = player["id"]
-            section = player["section"]
-
-            print("Receiving player", id, "to section", section)
-
-            player["pingcount"] = 0
-            player["rtt"] = settings.PLAYER_INITIAL_RTT
-            player["last_sent_ack"] = -1
-            player["recv_buffer"] = {}
-            ship["last_move"] = time.time()
-
-            with sections_lock, players_lock:
-                if notify_quorum_of_move(id, (addrport, section)):
-                    sections[section]["objects"][id] = ship
-                    players[id] = player
-
-                    update_object(section, id)
-                    self.send_response(200)
-                    print("Received player", id)
-                else:
-                    self.send_response(503)
-            
-            self.end_headers()
-        else:
-            self.send_error(404)
-            self.end_headers()
+
+                    # Rebuilt for the new objects when next needed
+                    if section in interest_grids:
+                        del interest_grids[section]
+
+                    store_section(section)
+
+                for player in new_players:
+                    new_player = frontplayer.Front_player.from_wire(new_players[player])
+                    reset_player(new_player)
+
+                    with locked_player(player, section), players_lock:
+                        add_player(player, new_player)
+
+                return 200, b""
+        except OSError:
+            pass
+
+        return 503, b""
+    elif query.path == "/neighbors": # Request to update neighbors for section
+        section, neighbors = pickle.loads(body)
+
+        print("Updating neighbors for section", section, neighbors)
+        with locked_sections(section):
+            for n in neighbors:
+                if sections[section].get(n) != neighbors[n]: # A new neighbor needs all ghosts
+                    ghosts.resync(sections[section], n)
+
+                sections[section][n] = neighbors[n]
+
+            sections[section].pop("snapshots", None)
+
+        return 200, b""
+    elif query.path == "/ghosts": # Ghosts from the neighbor of one of our sections
+        source, target, key, full, states = pickle.loads(body)
+
+        if receive_ghosts(source, target, key, full, states):
+            return 200, b""
+
+        return 404, b""
+    elif query.path == "/move": # Request to receive a player from another front
+        player, ship = pickle.loads(body)
+        id = player["id"]
+        section = player["section"]
+
+        print("Receiving player", id, "to section", section)
+
+        player = frontplayer.Front_player.from_wire(player)
+        reset_player(player)
+        ship = gameobject.Game_object.from_wire(ship, time.time())
+
+        if notify_quorum_of_move(id, (addrport, section)):
+            with locked_player(id, section):
+                # Players here may already see the ship as a ghost, it now becomes ours
+                sections[section]["objects"][id] = ship
+                movement.invalidate(sections[section])
+
+                with players_lock:
+                    add_player(id, player)
+
+                update_object(section, id)
+
+            print("Received player", id)
+            return 200, b""
+
+        return 503, b""
+
+    return 404, b""
+
+# Handle a request, returns status and response body
+def handle_request(method, path, body=b""):
+    query = urlparse(path)
+
+    if method == "GET":
+        return handle_get(query, parse_qs(query.query))
+    elif method == "POST":
+        return handle_post(query, body)
+
+    return 400, b""
+
+# HTTP request handler
+class front_http_handler(httpserver.Http_handler):
+    def do_GET(self):
+        self.respond(b"")
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    # Send the response to a request with the body read
+    def respond(self, body):
+        status, data = handle_request(self.command, self.path, body)
+
+        self.reply(status, data, metrics.CONTENT_TYPE if urlparse(self.path).path == "/metrics" else None)
 
 # Front HTTP server thread
 def front_http_server():
-    httpd = HTTPServer(addrport, front_http_handler)
+    httpd = httpserver.Worker_http_server(addrport, front_http_handler)
 
     try:
         print("Starting HTTP server at", addrport)
@@ -602,26 +1362,60 @@ def front_http_server():
 
     httpd.server_close()
 
+# Gauges read when /metrics is scraped, without locks as they only need to be about right
+def register_metrics():
+    metrics.gauge("players", lambda: len(players), "Players connected")
+    metrics.gauge("sections", lambda: len(sections), "Sections handled")
+    metrics.gauge("send_buffer_updates", lambda: sum(len(p.send_buffer or ()) for p in list(players.values())),
+        "Updates sent to players and not yet acknowledged")
+    metrics.gauge("store_buffer_updates", lambda: sum(len(x.get("store_buffer", ())) for x in list(sections.values())),
+        "Update batches sent to store and not yet acknowledged")
+    metrics.gauge("pending_timers", lambda: { 'queue="player_resend"': len(resend_timers),
+        'queue="store_resend"': len(store_resend_timers), 'queue="handoff"': len(handoff_timers),
+        'queue="ghost_resync"': len(ghost_timers) }, "Scheduled resends, handoff retries and ghost resyncs")
+    metrics.gauge("ghosts", lambda: sum(len(strip) for x in list(sections.values()) for strip in list(x.get("ghosts", {}).values())),
+        "Ghosts of objects in neighbor sections")
+    metrics.describe("packets_in_total", "Datagrams received by type")
+    metrics.describe("packets_out_total", "Datagrams sent by type")
+    metrics.describe("packets_dropped_total", "Datagrams dropped by simulated packet loss")
+    metrics.describe("resends_total", "Datagrams resent for lack of acknowledgement")
+    metrics.describe("ack_latency_seconds", "Time from sending to acknowledgement, resent datagrams excluded")
+    metrics.describe("tick_seconds", "Time taken by a simulation tick")
+    metrics.describe("commands_rejected_total", "Player commands ignored for going over COMMAND_RATE")
+    metrics.describe("ghost_messages_total", "Ghost messages to neighbors by whether they were taken")
+
 def main():
-    global s, s_lock
+    global s, s_lock, FRONT, addrport
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<front #>")
+        exit()
+
+    FRONT = int(sys.argv[1])
+    addrport = settings.INITIAL_FRONTS[FRONT]["address"]
+
+    print("Starting front #", FRONT, addrport)
+    register_metrics()
 
     with s_lock:
         s.bind(addrport)
-        s.settimeout(settings.FRONT_TIMEOUT)
 
-    front_http_server_thread = threading.Thread(target=front_http_server)
-    front_http_server_thread.start()
+    for thread in start_threads():
+        thread.join()
+
+# Start the front's threads, a worker of a multi-process front serves no HTTP of its own
+def start_threads(http=True):
+    targets = [front_listener, front_sender, front_ticker, front_handoffs, front_ghosts]
 
-    front_listener_thread = threading.Thread(target=front_listener)
-    front_listener_thread.start()
+    if http:
+        targets.insert(0, front_http_server)
 
-    front_sender_thread = threading.Thread(target=front_sender)
-    front_sender_thread.start()
+    threads = [threading.Thread(target=target) for target in targets]
 
-    front_listener_thread.join()
-    front_sender_thread.join()
+    for thread in threads:
+        thread.start()
 
-    front_http_server_thread.join()
+    return threads
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,179 @@
+# Asyncio front: the front module's game logic driven from a single event loop
+# The event loop owns the game socket, the HTTP connections and the timers for ticks, resends and pings,
+# and calls the same functions front.py's threads do. Requests and handoff and ghost steps that wait
+# on other components run in the loop's executor threads, which front.py's locks keep safe.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import ticker
+import metrics
+import front
+
+import sys
+import struct
+import time
+import queue
+import asyncio
+import concurrent.futures
+from urllib.parse import urlparse
+
+HTTP_REASONS = { 200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable" }
+
+last_quorum_ping = 0
+running = set() # Background jobs running in the executor, each runs one at a time like front.py's threads
+
+# Run job in the executor unless it is already running, its exceptions go to the loop's handler
+def run_job(job):
+    def done(future):
+        running.discard(job)
+        future.result()
+
+    if job not in running:
+        running.add(job)
+        asyncio.get_running_loop().run_in_executor(None, job).add_done_callback(done)
+
+# Run the handoff steps started or come up for retry
+def run_handoffs():
+    while True:
+        try:
+            section, obj = front.handoff_queue.get_nowait()
+        except queue.Empty:
+            return
+
+        front.run_handoff(section, obj)
+
+# Send the ghost messages queued, messages queued meanwhile go out with the next round
+def run_ghosts():
+    front.send_ghost_messages(front.take_ghost_messages())
+
+# Datagram protocol for the game socket, replies are sent straight from front's send
+class front_protocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        global last_quorum_ping
+
+        try:
+            last_quorum_ping = front.handle_datagram(data, addr) or last_quorum_ping
+        except (struct.error, ValueError):
+            print("Malformed packet from", addr)
+
+# Simulation timer: run a tick at a fixed rate and hand the handoff and ghost steps it queued to the executor
+async def front_ticker():
+    scheduler = ticker.Tick_scheduler()
+
+    print("Starting front ticker at", settings.TICK_RATE, "Hz")
+    while True:
+        await asyncio.sleep(scheduler.delay())
+
+        front.tick(scheduler.start())
+        scheduler.end()
+        metrics.observe("tick_seconds", scheduler.last_duration)
+
+        if scheduler.last_duration > scheduler.interval:
+            print("Tick overran by", round((scheduler.last_duration - scheduler.interval) * 1000, 1), "ms")
+
+        if not front.handoff_queue.empty():
+            run_job(run_handoffs)
+
+        if front.ghost_outbox:
+            run_job(run_ghosts)
+
+# Resend timer: resend what is due once per slot of the timer wheels
+async def front_resender():
+    while True:
+        await asyncio.sleep(settings.TIMER_RESOLUTION)
+
+        front.resend_due(time.time())
+
+# Keepalive timer: ping all players, drop silent ones and die if quorum is silent
+async def front_pinger():
+    print("Starting front pinger")
+    while True:
+        front.ping_players()
+        await asyncio.sleep(1)
+        front.drop_silent_players()
+
+        if time.time() - last_quorum_ping > settings.FRONT_TIMEOUT:
+            print("Quorum silent, dying")
+            sys.exit(0)
+
+# Serve HTTP/1.1 requests on one connection until the client closes it
+# An idle connection only costs the loop a buffer, the requests themselves run in the executor
+async def http_connection(reader, writer):
+    loop = asyncio.get_running_loop()
+
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            method, path, version = request_line.decode().split()
+            headers = {}
+
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            query = urlparse(path)
+            start = time.time()
+
+            status, response = await loop.run_in_executor(None, front.handle_request, method, path, body)
+
+            print(writer.get_extra_info("peername")[0], "-", method, path, status, "%.1f ms" % ((time.time() - start) * 1000))
+            metrics.observe("http_request_seconds", time.time() - start, 'method="' + (method if method in ("GET", "POST") else "other") + '",' + metrics.path_label(query.path))
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            content_type = "Content-Type: " + metrics.CONTENT_TYPE + "\r\n" if query.path == "/metrics" else ""
+
+            writer.write(("HTTP/1.1 " + str(status) + " " + HTTP_REASONS.get(status, "") + "\r\nContent-Length: " + str(len(response)) + "\r\n" + content_type + ("" if keep_alive else "Connection: close\r\n") + "\r\n").encode() + response)
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve():
+    global last_quorum_ping
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(settings.HTTP_WORKERS))
+    last_quorum_ping = time.time()
+
+    with front.s_lock:
+        front.s.bind(front.addrport)
+
+    await loop.create_datagram_endpoint(front_protocol, sock=front.s)
+
+    httpd = await asyncio.start_server(http_connection, front.addrport[0], front.addrport[1])
+    print("Starting HTTP server at", front.addrport)
+
+    async with httpd:
+        await asyncio.gather(httpd.serve_forever(), front_ticker(), front_resender(), front_pinger())
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<front #>")
+        exit()
+
+    front.FRONT = int(sys.argv[1])
+    front.addrport = settings.INITIAL_FRONTS[front.FRONT]["address"]
+
+    print("Starting asyncio front #", front.FRONT, front.addrport)
+    front.register_metrics()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
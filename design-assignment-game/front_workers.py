@@ -0,0 +1,274 @@
+# Front workers module: runs a front as several processes so it isn't held to one core
+# Each worker process is a front of its own for a share of the sections. A dispatcher process owns
+# the front's address and passes datagrams and requests on to the worker of the section or player
+# they are for, so to the rest of the game it is one front. Workers send straight from the front's
+# socket they inherit and move players to each other's sections through the dispatcher.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import codec
+import channel
+import httpserver
+import metrics
+import front
+
+import os
+import sys
+import time
+import socket
+import pickle
+import threading
+import multiprocessing
+from urllib.parse import urlparse, parse_qs
+
+workers = [] # Channel, datagram socket and process of each worker
+
+# Routing: the worker of each section and of each connected player by id and address,
+# players are routed as their worker adds and removes them
+owners = {}
+player_workers = {}
+addr_workers = {}
+routes_lock = threading.Lock()
+
+# Worker process: run the front's threads for the sections the dispatcher gives us, until it goes away
+def worker_main(number, connection, datagrams):
+    print("Starting worker", number, "of front #", front.FRONT)
+
+    # Only the dispatcher may hold its ends of our and the other workers' pipes and sockets,
+    # so that we notice when it is gone
+    for worker in workers:
+        worker["channel"].connection.close()
+        worker["datagrams"].close()
+
+    front.inbox = datagrams
+    front.dispatcher = channel.Channel(connection, worker_request)
+    front.register_metrics()
+
+    front.dispatcher.start()
+    front.start_threads(http=False)
+    front.dispatcher.join()
+
+    print("Dispatcher gone, worker", number, "dying")
+    os._exit(0)
+
+# Serve a request from the dispatcher
+def worker_request(method, path, body):
+    if path == "/metrics/snapshot":
+        return 200, pickle.dumps(metrics.snapshot())
+
+    return front.handle_request(method, path, body)
+
+# Serve a request or notice from worker number
+def dispatcher_request(number, method, path, body):
+    if path in ("/route", "/unroute"): # Player added to or removed from the worker
+        id, addr = pickle.loads(body)
+
+        with routes_lock:
+            if path == "/route":
+                player_workers[id] = number
+                addr_workers[addr] = number
+            else:
+                if player_workers.get(id) == number:
+                    del player_workers[id]
+                if addr_workers.get(addr) == number:
+                    del addr_workers[addr]
+
+        return 200, b""
+
+    return dispatch(method, path, body) # A worker moving a player to the section of another
+
+# Worker with the fewest sections, for a new section
+# Caller must have routes_lock
+def least_loaded():
+    counts = [0] * len(workers)
+
+    for number in owners.values():
+        counts[number] += 1
+
+    return counts.index(min(counts))
+
+# Find the worker a request to the front is for, or None
+def find_worker(method, query, vars, body):
+    with routes_lock:
+        if method == "GET" and query.path == "/map":
+            if "player" in vars:
+                return player_workers.get(int(vars["player"][0]))
+            if "section" in vars:
+                return owners.get(int(vars["section"][0]))
+        elif method == "POST" and query.path == "/map": # A new section goes to the least loaded worker
+            source, section, neighbors = pickle.loads(body)
+
+            if section not in owners:
+                owners[section] = least_loaded()
+                print("Section", section, "to worker", owners[section])
+
+            return owners[section]
+        elif method == "POST" and query.path == "/neighbors":
+            section, neighbors = pickle.loads(body)
+            return owners.get(section)
+        elif method == "POST" and query.path == "/player":
+            player = pickle.loads(body)
+            return owners.get(next(iter(player.values()))["section"])
+        elif method == "POST" and query.path == "/move":
+            player, ship = pickle.loads(body)
+            return owners.get(player["section"])
+        elif method == "POST" and query.path == "/ghosts":
+            source, target, key, full, states = pickle.loads(body)
+            return owners.get(target)
+
+    return None
+
+# Handle a request to the front, from HTTP or a worker, returns status and response body
+def dispatch(method, path, body):
+    query = urlparse(path)
+
+    if method == "GET" and query.path == "/metrics": # Ours and those of every worker
+        snapshots = []
+
+        for number, worker in enumerate(workers):
+            try:
+                status, data = worker["channel"].request("GET", "/metrics/snapshot")
+                snapshots.append(('worker="' + str(number) + '"', pickle.loads(data)))
+            except OSError:
+                pass
+
+        return 200, metrics.render(snapshots)
+    elif method == "GET" and query.path == "/players": # Players of every worker
+        stats = {}
+
+        for worker in workers:
+            try:
+                status, data = worker["channel"].request("GET", "/players")
+                stats.update(pickle.loads(data))
+            except OSError:
+                pass
+
+        return 200, pickle.dumps(stats)
+
+    number = find_worker(method, query, parse_qs(query.query), body)
+
+    if number is None:
+        return 404, b""
+
+    try:
+        return workers[number]["channel"].request(method, path, body, timeout=2 * settings.HTTP_TIMEOUT)
+    except OSError:
+        return 503, b""
+
+# HTTP request handler of the dispatcher
+class dispatcher_http_handler(httpserver.Http_handler):
+    def do_GET(self):
+        self.respond(b"")
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    # Send the response to a request with the body read
+    def respond(self, body):
+        status, data = dispatch(self.command, self.path, body)
+
+        self.reply(status, data, metrics.CONTENT_TYPE if urlparse(self.path).path == "/metrics" else None)
+
+# Pass a datagram on to a worker, dropped if the worker is too far behind to take it
+def forward(number, data, addr):
+    try:
+        workers[number]["datagrams"].send(codec.encode_forwarded(addr, data))
+        metrics.count("forwarded_total", 'worker="' + str(number) + '"')
+    except OSError:
+        metrics.count("forward_dropped_total", 'worker="' + str(number) + '"')
+
+# UDP listener thread of the dispatcher: pass datagrams to the worker they are for
+def dispatcher_listener():
+    s = front.s
+
+    while True:
+        data, addr = s.recvfrom(settings.MAX_DATAGRAM)
+
+        if addr == settings.QUORUM_ADDRPORT: # Every worker keeps an eye on the quorum
+            for number in range(len(workers)):
+                forward(number, data, addr)
+            continue
+
+        number = None
+
+        if addr == settings.STORE_ADDRPORT:
+            if data[:3] == b"ACK": # The worker of the section the ACK is for
+                try:
+                    section, version = codec.decode_store_ack(data[3:])
+                except ValueError:
+                    print("Malformed ACK from store")
+                    continue
+
+                with routes_lock:
+                    number = owners.get(section)
+        else:
+            with routes_lock:
+                number = addr_workers.get(addr)
+
+            if number is None: # Unknown player, tell them to find another front
+                with front.s_lock:
+                    front.try_send(s, b"FRONT!", addr)
+
+        if number is not None:
+            forward(number, data, addr)
+
+# Dispatcher HTTP server thread
+def dispatcher_http_server():
+    httpd = httpserver.Worker_http_server(front.addrport, dispatcher_http_handler)
+
+    print("Starting HTTP server at", front.addrport)
+    httpd.serve_forever()
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<front #> [<workers>]")
+        exit()
+
+    front.FRONT = int(sys.argv[1])
+    front.addrport = settings.INITIAL_FRONTS[front.FRONT]["address"]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else settings.FRONT_WORKERS
+
+    print("Starting front #", front.FRONT, front.addrport, "with", count, "workers")
+
+    # Workers inherit the bound socket to send from, only we receive from it
+    front.s.bind(front.addrport)
+
+    # Fork the workers before starting any threads of our own
+    context = multiprocessing.get_context("fork")
+
+    for number in range(count):
+        ours, theirs = context.Pipe()
+        datagrams, inbox = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        workers.append({ "channel": channel.Channel(ours, lambda *request, number=number: dispatcher_request(number, *request)),
+            "datagrams": datagrams })
+
+        workers[number]["process"] = context.Process(target=worker_main, args=(number, theirs, inbox), daemon=True)
+        workers[number]["process"].start()
+
+        theirs.close()
+        inbox.close()
+        datagrams.setblocking(False)
+
+    for worker in workers:
+        worker["channel"].start()
+
+    metrics.gauge("workers", lambda: sum(worker["process"].is_alive() for worker in workers), "Worker processes alive")
+    metrics.gauge("routed_players", lambda: len(player_workers), "Players routed to a worker")
+    metrics.describe("forwarded_total", "Datagrams passed on to each worker")
+    metrics.describe("forward_dropped_total", "Datagrams dropped as the worker's socket was full")
+
+    threading.Thread(target=dispatcher_listener, daemon=True).start()
+    threading.Thread(target=dispatcher_http_server, daemon=True).start()
+
+    # A front missing a worker has lost sections, die so that the quorum moves them all elsewhere
+    while all(worker["process"].is_alive() for worker in workers):
+        time.sleep(1)
+
+    print("A worker died, front dying")
+
+    for worker in workers:
+        worker["process"].terminate()
+
+if __name__ == "__main__":
+    main()
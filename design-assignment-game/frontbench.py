@@ -0,0 +1,128 @@
+# Front benchmark module: compares front implementations under the same bot swarm
+# Starts a local cluster with each front implementation in turn, runs bots.py's swarm against it
+# and reports the datagrams the fronts handled per second, the CPU time the front processes we started
+# spent on each (the dispatcher alone for front_workers.py) and the swarm's command latencies.
+# A front given as script:args runs with those extra arguments, e.g. front_workers.py:2 for two workers.
+# The cluster is started with BOTS in settings.py, which must be at least the number of bots run.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import connpool
+import bots
+
+import os
+import sys
+import time
+import asyncio
+import subprocess
+
+FRONTS = ("front.py", "front_async.py", "front_workers.py") # Implementations to compare by default
+
+STARTUP_DELAY = 2 # Seconds given to the cluster's components to come up
+
+# Start the components of a cluster with the given front implementation, returns their processes
+def start_cluster(front):
+    here = os.path.dirname(os.path.abspath(__file__))
+    run = lambda *args: subprocess.Popen([sys.executable] + list(args), cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    script, _, args = front.partition(":")
+    processes = [run("store.py")] + [run(script, str(number), *args.split()) for number in settings.INITIAL_FRONTS]
+    time.sleep(STARTUP_DELAY / 2) # Quorum hands out sections as soon as it starts
+    processes += [run("quorum.py"), run("login.py")]
+    time.sleep(STARTUP_DELAY)
+
+    return processes
+
+# Stop the components of a cluster
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+
+    for process in processes:
+        try:
+            process.wait(settings.HTTP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+# CPU seconds used so far by the processes, not counting their children
+def cpu_seconds(processes):
+    total = 0
+
+    for process in processes:
+        with open("/proc/" + str(process.pid) + "/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime and stime
+
+    return total
+
+# Datagrams received and sent by all fronts so far, from their /metrics
+def front_packets():
+    received = sent = 0
+
+    for front in settings.INITIAL_FRONTS.values():
+        status, data = connpool.request(front["address"], "GET", "/metrics")
+
+        for line in data.decode().splitlines():
+            name, _, value = line.rpartition(" ")
+
+            if name.startswith("packets_in_total{"):
+                received += float(value)
+            elif name.startswith("packets_out_total{"):
+                sent += float(value)
+
+    return received, sent
+
+# Run the swarm against a cluster with the given front implementation, returns a result line
+def bench(front, count, seconds, pattern):
+    print("Benchmarking", front)
+    processes = start_cluster(front)
+    fronts = processes[1:1 + len(settings.INITIAL_FRONTS)]
+
+    try:
+        bots.clear_stats()
+        received, sent = front_packets()
+        cpu = cpu_seconds(fronts)
+        start = time.time()
+
+        asyncio.run(bots.swarm(count, seconds, pattern))
+
+        elapsed = time.time() - start
+        now_received, now_sent = front_packets()
+        cpu = cpu_seconds(fronts) - cpu
+    finally:
+        stop_cluster(processes)
+
+    latencies = [bots.percentile(bots.stats[name], p) for name in ("ack", "effect") for p in (50, 99)]
+
+    return "%-20s %9.0f %9.0f %9.1f" % (front, (now_received - received) / elapsed, (now_sent - sent) / elapsed, cpu / max(now_received - received, 1) * 1e6) + \
+        "".join(" %9.1f" % latency if latency is not None else " %9s" % "-" for latency in latencies)
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<bots> [<seconds> [<pattern> [<front script>[:<args>] ...]]]")
+        print("Patterns:", ", ".join(bots.PATTERNS))
+        exit()
+
+    count = int(sys.argv[1])
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    pattern = sys.argv[3] if len(sys.argv) > 3 else bots.PATTERNS[0]
+    fronts = sys.argv[4:] or FRONTS
+
+    if count > settings.BOTS:
+        print("The cluster only knows", settings.BOTS, "bots, raise BOTS in settings.py")
+        exit()
+
+    bots.raise_file_limit(count)
+    results = [bench(front, count, seconds, pattern) for front in fronts]
+
+    print()
+    print(count, "bots moving by pattern", pattern, "for", seconds, "s, latencies in ms")
+    print("%-20s %9s %9s %9s %9s %9s %9s %9s" % ("Front", "In/s", "Out/s", "CPU us/in", "ACK p50", "ACK p99", "UPD p50", "UPD p99"))
+
+    for line in results:
+        print(line)
+
+if __name__ == "__main__":
+    main()
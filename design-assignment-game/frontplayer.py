@@ -0,0 +1,97 @@
+# Front player module: compact state of the players connected to a front
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+# Player connected to a front
+# Other components get players as dicts of the wire fields name, id, front, section, addr and session,
+# the front keeps them in slots alongside the state of the connection, which stays with us.
+# The update state is only set while the player is subscribed to their section, None otherwise.
+class Front_player:
+    __slots__ = ("name", "id", "front", "section", "addr", "session",
+        "pingcount", "rtt", "last_sent_ack", "recv_buffer", "command_bucket",
+        "seq", "last_recvd_ack", "send_buffer", "sent_states", "baselines", "hole_resends", "send_times")
+
+    def __init__(self, name, id, front, section, addr=None, session=None):
+        self.name = name
+        self.id = id
+        self.front = front
+        self.section = section
+        self.addr = addr
+        self.session = session
+
+        # Connection, set by the front's reset_player
+        self.pingcount = 0
+        self.rtt = None
+        self.last_sent_ack = -1
+        self.recv_buffer = None
+        self.command_bucket = None
+
+        # Updates, set by the front's subscribe_player
+        self.seq = None
+        self.last_recvd_ack = None
+        self.send_buffer = None
+        self.sent_states = None
+        self.baselines = None
+        self.hole_resends = None
+        self.send_times = None
+
+    # Player from the dict they were sent as
+    @classmethod
+    def from_wire(cls, player):
+        return cls(player["name"], player["id"], player.get("front"), player["section"], player.get("addr"), player.get("session"))
+
+    # Dict of the wire fields for sending
+    def wire(self):
+        return { "name": self.name, "id": self.id, "front": self.front, "section": self.section, "addr": self.addr, "session": self.session }
+
+    def __repr__(self):
+        return "Front_player(" + repr(self.wire()) + ")"
+
+# Memory and field access cost of players kept as dicts and in slots
+def main():
+    import timeit
+    import tracemalloc
+
+    count = 10000
+    wire = { "name": "Player", "id": 1, "front": 1, "section": 1, "addr": ("127.0.0.1", 5000), "session": "ABCDEFGHIJ" }
+    state = { "pingcount": 0, "rtt": None, "last_sent_ack": -1, "recv_buffer": {}, "command_bucket": None, "seq": 0,
+        "last_recvd_ack": 0, "send_buffer": {}, "sent_states": {}, "baselines": {}, "hole_resends": {}, "send_times": {} }
+
+    def as_objects():
+        players = [Front_player.from_wire(wire) for i in range(count)]
+
+        for player in players:
+            for field, value in state.items():
+                setattr(player, field, type(value)() if isinstance(value, dict) else value)
+
+        return players
+
+    def as_dicts():
+        return [dict(wire, **{ field: type(value)() if isinstance(value, dict) else value for field, value in state.items() }) for i in range(count)]
+
+    # Fields read when handling an ACK
+    dict_ack = lambda player: (player["seq"], player["last_recvd_ack"], player["send_buffer"], player["hole_resends"], player["rtt"])
+    slots_ack = lambda player: (player.seq, player.last_recvd_ack, player.send_buffer, player.hole_resends, player.rtt)
+
+    # What sending a player dict took: copy it all and delete the connection state
+    def dict_send(player):
+        player = player.copy()
+
+        for x in state:
+            del player[x]
+
+        return player
+
+    for name, build, ack, send in (("dict", as_dicts, dict_ack, dict_send),
+            ("slots", as_objects, slots_ack, Front_player.wire)):
+        tracemalloc.start()
+        players = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        reads = min(timeit.repeat(lambda: [ack(player) for player in players], number=10, repeat=5)) / 10 / count
+        cost = min(timeit.repeat(lambda: [send(player) for player in players], number=10, repeat=5)) / 10 / count
+
+        print("%-6s %6.0f bytes per player, %4.0f ns to read an ACK's fields, %4.0f ns to send one" % (name + ":", size / count, reads * 1e9, cost * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Game object module: compact state of the objects a front simulates
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+# Object in a section simulated by a front
+# The store and players get objects as dicts of the wire fields name, loc, speed and direction,
+# the front keeps them in slots alongside last_move, the time the object was last moved to,
+# which stays with us. Sending an object builds the dict from the wire fields instead of
+# copying everything and deleting what is ours.
+class Game_object:
+    __slots__ = ("name", "loc", "speed", "direction", "last_move")
+
+    def __init__(self, name, loc, speed=0, direction=None, last_move=None):
+        self.name = name
+        self.loc = loc
+        self.speed = speed
+        self.direction = direction # None for objects without one, such as planets
+        self.last_move = last_move # None for objects that aren't moving
+
+    # Object from the dict it was sent as, one that moves is taken to have last moved at now
+    @classmethod
+    def from_wire(cls, obj, now=None):
+        return cls(obj["name"], obj["loc"], obj["speed"], obj.get("direction"), now if obj["speed"] > 0 else None)
+
+    # Dict of the wire fields for sending
+    def wire(self):
+        if self.direction is None:
+            return { "name": self.name, "loc": self.loc, "speed": self.speed }
+
+        return { "name": self.name, "loc": self.loc, "speed": self.speed, "direction": self.direction }
+
+    def __repr__(self):
+        return "Game_object(" + repr(self.wire()) + ")"
+
+# Object of the given wire dict or None for a removed object
+def from_wire(obj, now=None):
+    return None if obj is None else Game_object.from_wire(obj, now)
+
+# Memory and cost of sending of objects kept as dicts and in slots
+def main():
+    import time
+    import timeit
+    import tracemalloc
+
+    count = 100000
+    now = time.time()
+
+    def as_dicts():
+        return [{ "name": "Ship", "loc": (i / 1000, 0.5), "speed": 5, "direction": 90, "last_move": now } for i in range(count)]
+
+    def as_objects():
+        return [Game_object("Ship", (i / 1000, 0.5), 5, 90, now) for i in range(count)]
+
+    def dict_send(obj):
+        obj = obj.copy()
+        del obj["last_move"]
+        return obj
+
+    for name, build, send in (("dict", as_dicts, dict_send), ("slots", as_objects, Game_object.wire)):
+        tracemalloc.start()
+        objects = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        cost = timeit.timeit(lambda: [send(obj) for obj in objects], number=5) / 5 / count
+
+        print("%-6s %6.0f bytes per object, %4.0f ns to send one" % (name + ":", size / count, cost * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Ghosts module: read-only copies of the objects near the edges of neighbor sections
+# Each section sends the neighbor across each of its edges the objects in the GHOST_ZONE wide strip
+# along that edge, so players near an edge see past it and a ship crossing it is already known
+# on the other side. Ghosts are kept apart from the section's own objects and are never moved,
+# stored or handed off by us, they only change when the section they belong to tells us.
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import movement
+import gameobject
+
+NEIGHBORS = tuple(key for key, shift in movement.EDGES)
+
+# Shift of a location into the coordinates of the neighbor across each edge
+SHIFTS = dict(movement.EDGES)
+
+# Neighbor across the same edge seen from the other side
+OPPOSITE = { "e-neighbor": "w-neighbor", "w-neighbor": "e-neighbor", "n-neighbor": "s-neighbor", "s-neighbor": "n-neighbor" }
+
+# Axis and direction of the edge facing each neighbor
+STRIPS = { "e-neighbor": (0, 1), "w-neighbor": (0, -1), "n-neighbor": (1, 1), "s-neighbor": (1, -1) }
+
+# Whether a location is in the strip along the edge facing a neighbor, or past that edge
+def in_strip(key, loc):
+    axis, sign = STRIPS[key]
+    half = (settings.SECTION_XSIZE if axis == 0 else settings.SECTION_YSIZE) / 2
+
+    return loc[axis] * sign >= half - settings.GHOST_ZONE
+
+# Wire state of an object as the neighbor across an edge sees it, in the neighbor's coordinates
+def ghost_state(key, obj):
+    xshift, yshift = SHIFTS[key]
+    state = obj.wire()
+    state["loc"] = (round(obj.loc[0] + xshift, 3), round(obj.loc[1] + yshift, 3))
+
+    return state
+
+# Ghost messages for the neighbors of a section after the objects in changed have changed
+# Neighbors in the section's ghost_resync get everything in their strip, the others the changed
+# objects that are in their strip or have left it. Neighbors we are waiting to resync get nothing.
+# Returns messages as (key, neighbor, full, states), states are wire states by object id with
+# None for objects that left the strip
+# Caller must have the section's lock
+def publish(section, changed):
+    ghosted = section.setdefault("ghosted", {}) # Objects each neighbor has as ghosts
+    resync = section.pop("ghost_resync", set())
+    objects = section["objects"]
+    messages = []
+
+    for key in NEIGHBORS:
+        if key not in section:
+            continue
+
+        if key in resync:
+            states = { id: ghost_state(key, obj) for id, obj in objects.items() if obj is not None and in_strip(key, obj.loc) }
+            ghosted[key] = set(states)
+            messages.append((key, section[key], True, states))
+        elif key in ghosted:
+            sent = ghosted[key]
+            states = {}
+
+            for id in changed:
+                obj = objects.get(id)
+
+                if obj is not None and in_strip(key, obj.loc):
+                    states[id] = ghost_state(key, obj)
+                    sent.add(id)
+                elif id in sent:
+                    states[id] = None
+                    sent.discard(id)
+
+            if states:
+                messages.append((key, section[key], False, states))
+
+    return messages
+
+# Send everything in the strip facing a neighbor on the next publish, after the neighbor changed or
+# lost messages
+# Caller must have the section's lock
+def resync(section, key):
+    section.get("ghosted", {}).pop(key, None)
+    section.setdefault("ghost_resync", set()).add(key)
+
+# Apply a ghost message from source, the section whose key neighbor this section is
+# Returns ids of the ghosts that changed, or None if source is not that neighbor of ours
+# Caller must have the section's lock
+def apply(section, source, key, full, states):
+    if section.get(OPPOSITE[key], (None, None))[1] != source:
+        return None
+
+    strip = section.setdefault("ghosts", {}).setdefault(source, {}) # Ghosts by the section they belong to
+    changed = set(states)
+
+    if full:
+        changed.update(strip)
+        strip.clear()
+
+    for id, state in states.items():
+        if state is None:
+            strip.pop(id, None)
+        else:
+            strip[id] = gameobject.Game_object.from_wire(state)
+
+    return changed
+
+# Keep an object we just let go to a neighbor section as a ghost of that section, so players here
+# don't see it disappear before the neighbor's first message about it arrives
+# Caller must have the section's lock
+def hand_over(section, neighbor_section, id, obj):
+    if settings.GHOST_ZONE is not None:
+        ghost = gameobject.Game_object(obj.name, obj.loc, obj.speed, obj.direction)
+        section.setdefault("ghosts", {}).setdefault(neighbor_section, {}).setdefault(id, ghost)
+
+# Ghost of an object, None if no neighbor has sent us one
+# Caller must have the section's lock
+def find(section, id):
+    for strip in section.get("ghosts", {}).values():
+        if id in strip:
+            return strip[id]
+
+    return None
+
+# Object players of a section see by id: our own, otherwise a ghost, None if there is neither
+# Caller must have the section's lock
+def visible_object(section, id):
+    obj = section["objects"].get(id)
+
+    return obj if obj is not None else find(section, id)
+
+# Ghosts players of a section see, those of objects that aren't ours
+# Caller must have the section's lock
+def visible_ghosts(section):
+    objects = section["objects"]
+
+    return { id: obj for strip in section.get("ghosts", {}).values() for id, obj in strip.items() if objects.get(id) is None }
+
+# Ghost messages waiting to be sent, at most one for each edge of each section
+# A message queued while an earlier one for the same edge still waits is merged into it, so a slow
+# neighbor costs one message each time we get to send rather than a growing queue. A full message
+# replaces whatever was waiting as it carries everything.
+# Not thread safe, callers guard it with a lock of their own
+class Ghost_outbox:
+    def __init__(self):
+        self.messages = {} # Neighbor, full and states by section id and key
+
+    def __len__(self):
+        return len(self.messages)
+
+    # Queue a message from publish
+    def put(self, section_id, key, neighbor, full, states):
+        waiting = self.messages.get((section_id, key))
+
+        if waiting is None or full or waiting[0] != neighbor:
+            self.messages[(section_id, key)] = (neighbor, full, dict(states))
+        else:
+            waiting[2].update(states)
+
+    # Take all waiting messages as (section id, key, neighbor, full, states)
+    def take(self):
+        messages = [(section_id, key, neighbor, full, states) for (section_id, key), (neighbor, full, states) in self.messages.items()]
+        self.messages = {}
+
+        return messages
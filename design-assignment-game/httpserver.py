@@ -0,0 +1,185 @@
+# HTTP server module: concurrent keep-alive HTTP serving for front, store and quorum
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+import metrics
+
+import time
+import queue
+import socket
+import selectors
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Sent to connections turned away because all workers are busy and the queue is full
+OVERLOADED = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+# HTTP server handing connections to a fixed number of worker threads
+# Connections with a request wait in a queue for a free worker, when too many are waiting new requests
+# get 503 right away so an overloaded component pushes back on its callers instead of piling up work.
+# Between requests a keep-alive connection waits in the idler thread, so idle connections hold no worker.
+class Worker_http_server(HTTPServer):
+    def __init__(self, addrport, handler, workers=None, backlog=None):
+        super().__init__(addrport, handler)
+
+        workers = workers or settings.HTTP_WORKERS
+
+        self.connections = queue.Queue() # Accepted connections waiting for a worker
+        self.slots = threading.Semaphore(workers + (backlog or settings.HTTP_BACKLOG)) # Connections being served or waiting
+        self.rejected = 0 # Connections turned away with 503
+
+        self.parked = queue.Queue() # Idle keep-alive connections for the idler to watch
+        self.wakeup, self.waker = socket.socketpair() # Tells the idler there are connections in parked
+
+        for x in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+        threading.Thread(target=self.idler, daemon=True).start()
+
+    # Queue an accepted connection for the workers, called by serve_forever
+    def process_request(self, request, client_address):
+        self.dispatch(request, client_address)
+
+    # Queue a connection with a request waiting for the workers, or turn it away if too many are waiting
+    def dispatch(self, request, client_address):
+        if self.slots.acquire(blocking=False):
+            self.connections.put((request, client_address))
+        else:
+            self.rejected += 1
+            metrics.count("http_rejected_total")
+
+            try:
+                request.sendall(OVERLOADED)
+            except OSError:
+                pass
+
+            self.shutdown_request(request)
+
+    # Worker thread serving queued connections, each until it has no request waiting
+    # Connections kept alive are then parked with the idler, others are closed
+    def worker(self):
+        while True:
+            request, client_address = self.connections.get()
+            keep_alive = False
+
+            try:
+                keep_alive = not self.RequestHandlerClass(request, client_address, self).close_connection
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.slots.release()
+
+            if keep_alive:
+                self.parked.put((request, client_address))
+                self.waker.send(b"\0")
+            else:
+                self.shutdown_request(request)
+
+    # Idler thread: watch idle keep-alive connections without holding workers
+    # A connection goes back to the workers when its next request arrives, or its client closes it,
+    # and is closed if it stays idle for HTTP_KEEPALIVE_TIMEOUT
+    def idler(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup, selectors.EVENT_READ)
+        idle = {} # Deadline of each idle connection, in the order they were parked
+
+        while True:
+            timeout = idle[next(iter(idle))] - time.monotonic() if idle else None
+
+            for key, events in selector.select(timeout):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+
+                    while not self.parked.empty():
+                        request, client_address = self.parked.get()
+                        selector.register(request, selectors.EVENT_READ, client_address)
+                        idle[request] = time.monotonic() + settings.HTTP_KEEPALIVE_TIMEOUT
+                else:
+                    selector.unregister(key.fileobj)
+                    del idle[key.fileobj]
+                    self.dispatch(key.fileobj, key.data)
+
+            now = time.monotonic()
+
+            while idle and idle[next(iter(idle))] <= now:
+                request = next(iter(idle))
+                selector.unregister(request)
+                del idle[request]
+                self.shutdown_request(request)
+
+# Base for our HTTP request handlers, speaks HTTP/1.1 so connections are kept alive
+# Every response must have Content-Length for the client to find its end, use reply
+class Http_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = settings.HTTP_TIMEOUT # A request that has started arriving must be complete by this
+    disable_nagle_algorithm = True # Headers and body are written separately, don't hold the body back
+
+    # Serve the requests the client has sent, close_connection tells the server whether to keep the
+    # connection open for more
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+        while not self.close_connection and self.request_waiting():
+            self.handle_one_request()
+
+    # Whether the next request has already arrived, without waiting for it
+    def request_waiting(self):
+        self.connection.settimeout(0)
+
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    # Send a complete response
+    def reply(self, status, data=b"", content_type=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Send this process's metrics
+    def reply_metrics(self):
+        self.reply(200, metrics.render(), metrics.CONTENT_TYPE)
+
+    # Called for each request once its request line is read, start timing it
+    def parse_request(self):
+        self.started = time.perf_counter()
+
+        return super().parse_request()
+
+    # Called as the response starts, record how long the request took to handle by its path
+    def log_request(self, code="-", size="-"):
+        if hasattr(self, "started"):
+            method = self.command if self.command in ("GET", "POST") else "other"
+            metrics.observe("http_request_seconds", time.perf_counter() - self.started, 'method="' + method + '",' + metrics.path_label(getattr(self, "path", "")))
+            del self.started
+
+        super().log_request(code, size)
+
+    # Slow clients timing out are routine, don't log them
+    def log_error(self, format, *args):
+        if not format.startswith("Request timed out"):
+            super().log_error(format, *args)
+
+# Handler for processes without an HTTP server of their own, serves only /metrics
+class Metrics_handler(Http_handler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.reply_metrics()
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics at addrport in a thread of its own
+def serve_metrics(addrport):
+    httpd = Worker_http_server(addrport, Metrics_handler, workers=2)
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
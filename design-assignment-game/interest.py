@@ -0,0 +1,91 @@
+# Interest module: area of interest management for map sections
+# Objects are kept in a uniform grid over the section and each player watches the cells
+# within AOI_RADIUS of their ship, so updates only go to players near the object
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import math
+
+# Grid of objects and watching players for one section
+class Interest_grid:
+    def __init__(self, cell_size=None, radius=None):
+        self.cell_size = cell_size or settings.AOI_CELL_SIZE
+        self.radius = radius if radius is not None else settings.AOI_RADIUS
+
+        self.cells = {} # Object ids in each cell
+        self.object_cells = {} # Cell of each object
+        self.watchers = {} # Players watching each cell
+        self.player_cells = {} # Cells watched by each player
+
+    # Cell containing a location
+    def cell_of(self, loc):
+        return (math.floor(loc[0] / self.cell_size), math.floor(loc[1] / self.cell_size))
+
+    # Cells within radius of a location
+    def cells_around(self, loc):
+        xmin, ymin = self.cell_of((loc[0] - self.radius, loc[1] - self.radius))
+        xmax, ymax = self.cell_of((loc[0] + self.radius, loc[1] + self.radius))
+
+        return { (x, y) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1) }
+
+    # Put an object at a location, None removes it
+    # Returns the object's old and new cell
+    def place(self, id, loc):
+        old_cell = self.object_cells.get(id)
+        new_cell = self.cell_of(loc) if loc is not None else None
+
+        if old_cell != new_cell:
+            if old_cell is not None:
+                self.cells[old_cell].discard(id)
+                if not self.cells[old_cell]:
+                    del self.cells[old_cell]
+                del self.object_cells[id]
+
+            if new_cell is not None:
+                self.cells.setdefault(new_cell, set()).add(id)
+                self.object_cells[id] = new_cell
+
+        return old_cell, new_cell
+
+    # Make a player watch the cells around a location
+    # Returns cells the player started and stopped watching
+    def watch(self, player, loc):
+        old_cells = self.player_cells.get(player, set())
+        new_cells = self.cells_around(loc)
+
+        for cell in old_cells - new_cells:
+            self.watchers[cell].discard(player)
+            if not self.watchers[cell]:
+                del self.watchers[cell]
+
+        for cell in new_cells - old_cells:
+            self.watchers.setdefault(cell, set()).add(player)
+
+        self.player_cells[player] = new_cells
+
+        return new_cells - old_cells, old_cells - new_cells
+
+    # Stop a player watching anything
+    def unwatch(self, player):
+        for cell in self.player_cells.pop(player, ()):
+            self.watchers[cell].discard(player)
+            if not self.watchers[cell]:
+                del self.watchers[cell]
+
+    # Players watching a cell
+    def watchers_of(self, cell):
+        return self.watchers.get(cell, frozenset())
+
+    # Objects in any of the given cells
+    def objects_in(self, cells):
+        objects = set()
+
+        for cell in cells:
+            objects |= self.cells.get(cell, set())
+
+        return objects
+
+    # Objects a player currently sees
+    def visible_to(self, player):
+        return self.objects_in(self.player_cells.get(player, ()))
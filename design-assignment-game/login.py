@@ -2,23 +2,38 @@
 # Jarkko Kovala <jarkko.kovala@iki.fi>
 
 import settings
+import codec
+import connpool
+import httpserver
+import metrics
 
 import sys
 import socket
 import pickle
 import threading
-import http.client
+import time
 
 def main():
+    metrics.describe("packets_in_total", "Datagrams received by type")
+    metrics.describe("packets_out_total", "Datagrams sent by type")
+    metrics.describe("quorum_request_seconds", "Time taken by the quorum to find a front for a player")
+    httpserver.serve_metrics(settings.LOGIN_METRICS_ADDRPORT)
+
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         s.bind(settings.LOGIN_ADDRPORT)
 
         # Listen for UDP forever
         while True:
             data, addr = s.recvfrom(1024)
+            metrics.count_packet("in", codec.message_type(data) or "other")
 
             if data[:6] == b"FRONT?":
-                client = pickle.loads(data[6:])
+                try:
+                    client = codec.decode_front_request(data[6:])
+                except ValueError:
+                    print("Malformed front request from", addr)
+                    continue
+
                 client["addr"] = addr
 
                 # TODO (after real player login has been implemented)
@@ -31,13 +46,13 @@ def main():
 
                     # Get front from quorum
                     addrport = settings.QUORUM_ADDRPORT
-                    quorum_conn = http.client.HTTPConnection(addrport[0], addrport[1])
-                    quorum_conn.request("POST", "/front", pickle.dumps(client))
-                    response = quorum_conn.getresponse()
-                    quorum_conn.close()
+                    start = time.perf_counter()
+                    status, data = connpool.request(addrport, "POST", "/front", pickle.dumps(client))
+                    metrics.observe("quorum_request_seconds", time.perf_counter() - start, 'status="' + str(status) + '"')
 
-                    if response.status == 200: # If OK, send to player
-                        s.sendto(b"FRONT:" + response.read(), addr)
+                    if status == 200: # If OK, send to player
+                        s.sendto(b"FRONT:" + codec.encode_address(pickle.loads(data)), addr)
+                        metrics.count_packet("out", "FRONT:")
 
                 except OSError:
                     pass
@@ -0,0 +1,238 @@
+# Metrics module: counters, histograms and gauges served as Prometheus text on /metrics
+# Counters and histograms are kept separately by each thread and only added up when scraped,
+# so counting on hot paths takes no locks
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+from time import perf_counter
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4" # Prometheus text exposition format
+
+# Upper bounds of histogram buckets in seconds, from lock waits to slow HTTP calls
+BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Paths the components serve, requests to any other path are labeled path="other" so that clients
+# can't create histogram series at will
+ROUTES = frozenset(("/front", "/move", "/player", "/map", "/neighbors", "/ghosts", "/players", "/metrics"))
+
+local = threading.local() # The calling thread's counters and histograms
+shards = [] # Counters and histograms of every thread that has counted something
+shards_lock = threading.Lock()
+
+enabled = settings.METRICS # Read once, hot paths check this instead of settings
+
+gauges = {} # Functions giving the current value of each gauge
+bounds = {} # Bucket upper bounds of histograms that don't measure seconds
+descriptions = {} # Help text of each metric
+
+# Counters and histograms of the calling thread
+def shard():
+    try:
+        return local.shard
+    except AttributeError:
+        local.shard = ({}, {})
+
+        with shards_lock:
+            shards.append(local.shard)
+
+        return local.shard
+
+# Add to a counter, labels are given in Prometheus form such as 'type="ACK"'
+def count(name, labels="", amount=1):
+    if enabled:
+        counters = shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+# Count a datagram sent, received or dropped by its message type in packets_<direction>_total
+def count_packet(direction, kind):
+    count("packets_" + direction + "_total", 'type="' + kind + '"')
+
+# Label of a request path for the HTTP request histograms
+def path_label(path):
+    path = path.split("?")[0]
+
+    return 'path="' + (path if path in ROUTES else "other") + '"'
+
+# Record a value in a histogram, in seconds unless the histogram was given buckets of its own
+def observe(name, value, labels=""):
+    if enabled:
+        histograms = shard()[1]
+        key = (name, labels)
+        upper = bounds.get(name, BUCKETS)
+
+        try:
+            buckets = histograms[key]
+        except KeyError: # Count in each bucket, then the count above all of them and the sum
+            buckets = histograms[key] = [0] * (len(upper) + 1) + [0.0]
+
+        buckets[bisect_left(upper, value)] += 1
+        buckets[-1] += value
+
+# Give a histogram buckets of its own, done when a module is imported so that a process rendering
+# the histograms of another knows them too
+def histogram(name, upper, description=None):
+    bounds[name] = tuple(upper)
+
+    if description:
+        descriptions[name] = description
+
+# Register a gauge read when scraped, value gives a number or a dict of numbers by labels
+# Gauges cost nothing until scraped, so buffer sizes and such are best given this way
+def gauge(name, value, description=None, kind="gauge"):
+    gauges[name] = (value, kind)
+
+    if description:
+        descriptions[name] = description
+
+# Give help text for a counter or histogram
+def describe(name, description):
+    descriptions[name] = description
+
+# Lock that records how long it is waited for and held in lock_wait_seconds and lock_hold_seconds
+class Timed_lock:
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.labels = 'lock="' + name + '"'
+        self.acquired = 0 # Time the lock was acquired, only written by the holder
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = perf_counter()
+
+        if not self.lock.acquire(blocking, timeout):
+            return False
+
+        self.acquired = perf_counter()
+        observe("lock_wait_seconds", self.acquired - start, self.labels)
+
+        return True
+
+    def release(self):
+        held = perf_counter() - self.acquired
+        self.lock.release()
+
+        observe("lock_hold_seconds", held, self.labels)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+# Lock for a component, timed when metrics are on
+def lock(name):
+    return Timed_lock(name) if enabled else threading.Lock()
+
+# Format a sample line
+def sample(name, labels, value):
+    return name + ("{" + labels + "}" if labels else "") + " " + repr(value) + "\n"
+
+# Add up all threads' counters and histograms and read the gauges
+# Returns plain dicts, with the help texts, that can be pickled and rendered in another process
+def snapshot():
+    with shards_lock:
+        current = list(shards)
+
+    counters = {}
+    histograms = {}
+    values = {} # Kind and values by labels of each gauge
+
+    for thread_counters, thread_histograms in current:
+        for key, value in dict(thread_counters).items():
+            counters[key] = counters.get(key, 0) + value
+
+        for key, buckets in dict(thread_histograms).items():
+            total = histograms.setdefault(key, [0] * len(buckets))
+
+            for i, value in enumerate(list(buckets)):
+                total[i] += value
+
+    for name, (value, kind) in gauges.items():
+        try:
+            value = value()
+        except Exception: # A broken gauge shouldn't take the others down
+            continue
+
+        values[name] = (kind, value if isinstance(value, dict) else { "": value })
+
+    return counters, histograms, values, dict(descriptions)
+
+# Labels of a sample from another process
+def add_labels(extra, labels):
+    return extra + "," + labels if extra and labels else extra or labels
+
+# Render our metrics as the exposition in bytes, others are (labels, snapshot) pairs from other
+# processes whose samples are included with the labels added
+def render(others=()):
+    families = {} # Lines of each metric and its type
+    helps = {}
+    out = []
+
+    for extra, (counters, histograms, values, texts) in [("", snapshot())] + list(others):
+        helps.update(texts)
+
+        for (name, labels), value in sorted(counters.items()):
+            families.setdefault(name, ("counter", []))[1].append(sample(name, add_labels(extra, labels), value))
+
+        for (name, labels), buckets in sorted(histograms.items()):
+            lines = families.setdefault(name, ("histogram", []))[1]
+            labels = add_labels(extra, labels)
+            cumulative = 0
+            prefix = labels + "," if labels else ""
+
+            for bound, value in zip(bounds.get(name, BUCKETS) + ("+Inf",), buckets):
+                cumulative += value
+                lines.append(sample(name + "_bucket", prefix + 'le="' + str(bound) + '"', cumulative))
+
+            lines.append(sample(name + "_sum", labels, buckets[-1]))
+            lines.append(sample(name + "_count", labels, cumulative))
+
+        for name, (kind, value) in sorted(values.items()):
+            lines = families.setdefault(name, (kind, []))[1]
+
+            for labels, v in sorted(value.items()):
+                lines.append(sample(name, add_labels(extra, labels), v))
+
+    for name, (kind, lines) in families.items():
+        if name in helps:
+            out.append("# HELP " + name + " " + helps[name] + "\n")
+
+        out.append("# TYPE " + name + " " + kind + "\n")
+        out.extend(lines)
+
+    return "".join(out).encode()
+
+# Cost of counting and timing on the hot path
+def main():
+    import timeit
+
+    rounds = 1000000
+    lock = Timed_lock("bench")
+    plain = threading.Lock()
+
+    def timed_lock():
+        with lock:
+            pass
+
+    def plain_lock():
+        with plain:
+            pass
+
+    for name, function in (("count", lambda: count("packets_out_total", 'type="UPDATE"')),
+            ("observe", lambda: observe("tick_seconds", 0.003)),
+            ("plain lock", plain_lock),
+            ("timed lock", timed_lock)):
+        print("%-12s %6.0f ns" % (name + ":", timeit.timeit(function, number=rounds) / rounds * 1e9))
+
+    print()
+    print(render().decode()[:400])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# Movement module: advances moving objects of a map section
+# Uses NumPy to move all objects of a crowded section in one vectorized step if it is available,
+# keeping their state as arrays in the section between ticks
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Edges in the order they are checked, with the neighbor key and the shift into the neighbor's coordinates
+EDGES = (
+        ("e-neighbor", (-settings.SECTION_XSIZE, 0)),
+        ("w-neighbor", (settings.SECTION_XSIZE, 0)),
+        ("n-neighbor", (0, -settings.SECTION_YSIZE)),
+        ("s-neighbor", (0, settings.SECTION_YSIZE))
+    )
+
+# Update object location based, direction, speed, and time since last update
+def move_object(obj, now):
+    dir = math.radians(obj.direction)
+    cur_loc = obj.loc
+
+    # Objects moved by a command after the tick's time was set don't move backwards
+    interval = max(now - obj.last_move, 0)
+
+    xloc = round(cur_loc[0] + interval * obj.speed * math.cos(dir), 3)
+    yloc = round(cur_loc[1] + interval * obj.speed * math.sin(dir), 3)
+
+    obj.loc = (xloc, yloc)
+    obj.last_move = max(obj.last_move, now)
+
+# Find the edge an object at location has crossed, as an index to EDGES or None
+def crossed_edge(xloc, yloc):
+    if xloc > settings.SECTION_XSIZE/2:
+        return 0
+    elif xloc < -settings.SECTION_XSIZE/2:
+        return 1
+    elif yloc > settings.SECTION_YSIZE/2:
+        return 2
+    elif yloc < -settings.SECTION_YSIZE/2:
+        return 3
+
+    return None
+
+# Handle an object that crossed an edge: clamp it to the edge if there is no neighbor,
+# otherwise return (object id, neighbor, location in neighbor)
+def cross_edge(section, id, obj, edge):
+    key, (xshift, yshift) = EDGES[edge]
+    xloc, yloc = obj.loc
+
+    if key in section:
+        return (id, section[key], (round(xloc + xshift, 3), round(yloc + yshift, 3)))
+
+    if edge == 0:
+        obj.loc = (settings.SECTION_XSIZE/2, yloc)
+    elif edge == 1:
+        obj.loc = (-settings.SECTION_XSIZE/2, yloc)
+    elif edge == 2:
+        obj.loc = (xloc, settings.SECTION_YSIZE/2)
+    else:
+        obj.loc = (xloc, -settings.SECTION_YSIZE/2)
+
+    return None
+
+# Move an object past an edge back onto the edge
+def clamp(obj):
+    xloc, yloc = obj.loc
+
+    obj.loc = (min(max(xloc, -settings.SECTION_XSIZE/2), settings.SECTION_XSIZE/2),
+            min(max(yloc, -settings.SECTION_YSIZE/2), settings.SECTION_YSIZE/2))
+
+# Move objects one at a time
+def move_objects_scalar(section, moving, now):
+    crossings = []
+
+    for id, obj in moving:
+        move_object(obj, now)
+
+        edge = crossed_edge(*obj.loc)
+
+        if edge is not None:
+            crossing = cross_edge(section, id, obj, edge)
+
+            if crossing:
+                crossings.append(crossing)
+
+    return crossings
+
+# Drop cached arrays of a section, must be called whenever objects are added or removed
+# or their location, speed or direction is changed outside move_section
+def invalidate(section):
+    if "movement" in section:
+        del section["movement"]
+
+# Build struct-of-arrays state for moving objects of a section
+def gather(moving):
+    count = len(moving)
+    objects = [obj for id, obj in moving]
+    locs = [obj.loc for obj in objects]
+
+    return {
+        "moving": moving,
+        "x": numpy.fromiter([loc[0] for loc in locs], float, count),
+        "y": numpy.fromiter([loc[1] for loc in locs], float, count),
+        "speed": numpy.fromiter([obj.speed for obj in objects], float, count),
+        "direction": numpy.radians(numpy.fromiter([obj.direction for obj in objects], float, count)),
+        "last_move": numpy.fromiter([obj.last_move for obj in objects], float, count)
+    }
+
+# Move all objects in one step over the section's cached arrays, only objects past an edge are visited again
+def move_objects_vector(section, now):
+    state = section["movement"]
+    moving = state["moving"]
+
+    distance = numpy.maximum(now - state["last_move"], 0) * state["speed"]
+
+    xloc = state["x"] = numpy.round(state["x"] + distance * numpy.cos(state["direction"]), 3)
+    yloc = state["y"] = numpy.round(state["y"] + distance * numpy.sin(state["direction"]), 3)
+    last_move = state["last_move"] = numpy.maximum(state["last_move"], now)
+
+    for (id, obj), x, y, moved in zip(moving, xloc.tolist(), yloc.tolist(), last_move.tolist()):
+        obj.loc = (x, y)
+        obj.last_move = moved
+
+    # Masks of objects past each edge, an object only counts for the first edge it is past
+    east = xloc > settings.SECTION_XSIZE/2
+    west = xloc < -settings.SECTION_XSIZE/2
+    north = (yloc > settings.SECTION_YSIZE/2) & ~east & ~west
+    south = (yloc < -settings.SECTION_YSIZE/2) & ~east & ~west
+
+    crossings = []
+
+    for edge, mask in enumerate((east, west, north, south)):
+        for i in numpy.flatnonzero(mask).tolist():
+            id, obj = moving[i]
+            crossing = cross_edge(section, id, obj, edge)
+
+            if crossing:
+                crossings.append(crossing)
+            else: # Clamped to the edge
+                xloc[i], yloc[i] = obj.loc
+
+    return crossings
+
+# Move all moving objects in a section to time now and clamp them at edges without a neighbor
+# Objects being handed off to a neighbor stay frozen where they crossed
+# Returns ids of moved objects and crossings as (object id, neighbor, location in neighbor)
+def move_section(section, now):
+    if "movement" not in section:
+        frozen = section.get("handoffs", ())
+        moving = [(id, obj) for id, obj in section["objects"].items() if obj is not None and obj.speed > 0 and id not in frozen]
+
+        if numpy is None or not settings.VECTOR_MOVEMENT or len(moving) < settings.VECTOR_MIN_OBJECTS:
+            return [id for id, obj in moving], move_objects_scalar(section, moving, now)
+
+        section["movement"] = gather(moving)
+
+    return [id for id, obj in section["movement"]["moving"]], move_objects_vector(section, now)
+
+# Compare scalar and vectorized movement of a crowded section
+def main():
+    import gameobject
+    import random
+    import time
+    import timeit
+
+    count = 10000
+    rounds = 20
+    section = { "objects": {}, "e-neighbor": (("127.0.0.1", 10102), 2) }
+
+    for id in range(count):
+        section["objects"][id] = gameobject.Game_object("Ship", (random.uniform(-50, 50), random.uniform(-50, 50)), random.randint(1, 10), random.randint(0, 360), time.time())
+
+    moving = list(section["objects"].items())
+
+    scalar = timeit.timeit(lambda: move_objects_scalar(section, moving, time.time()), number=rounds) / rounds
+
+    if numpy:
+        section["movement"] = gather(moving)
+        vector = timeit.timeit(lambda: move_objects_vector(section, time.time()), number=rounds) / rounds
+    else:
+        vector = None
+
+    print("Objects:", count)
+    print("Scalar tick: %.2f ms" % (scalar * 1000))
+
+    if vector is not None:
+        print("Vector tick: %.2f ms" % (vector * 1000))
+    else:
+        print("NumPy not available")
+
+if __name__ == "__main__":
+    main()
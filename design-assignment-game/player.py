@@ -2,6 +2,9 @@
 # Jarkko Kovala <jarkko.kovala@iki.fi>
 
 import settings
+import codec
+import rtt
+import connpool
 
 import sys
 import time
@@ -12,7 +15,6 @@ import pickle
 import struct
 import threading
 import queue
-import http.client
 
 if len(sys.argv) < 2:
     print("Usage:", sys.argv[0], "<player #>")
@@ -36,18 +38,18 @@ def try_send(s, packet, addr):
 def get_front(s, session):
     global front_seq
 
-    packet = pickle.dumps({"id" : PLAYER, "session": session})
+    packet = codec.encode_front_request(PLAYER, session)
     try_send(s, b"FRONT?" + packet, settings.LOGIN_ADDRPORT)
 
     try:
         s.settimeout(settings.PLAYER_TIMEOUT)
-        data, addr = s.recvfrom(1024)
+        data, addr = s.recvfrom(settings.MAX_DATAGRAM)
     except socket.timeout:
         print("Timed out waiting for a front")
         return None
 
     if data[:6] == b"FRONT:":
-        front = pickle.loads(data[6:])
+        front = codec.decode_address(data[6:])
 
         print("Got new front", front)
 
@@ -55,19 +57,33 @@ def get_front(s, session):
     else:
         return None
 
-# Fetch a section for us
+# What we know of our section for fetching it again: section id, version and the section
+# Our copy only matches the front's at that version if we have every update up to it and none after it
+def known_section(section, version, recvd_updates):
+    if section is not None and "id" in section and not recvd_updates:
+        return (section["id"], version, section)
+
+    return None
+
+# Fetch a section for us, only if it has changed from the one we know
 # Caller must have front_lock
-def get_section(front, session):
-    front_conn = http.client.HTTPConnection(front[0], front[1])
+def get_section(front, session, known=None):
+    path = "/map?player=" + str(PLAYER) + "&session=" + session
+
+    if known is not None:
+        path += "&section=" + str(known[0]) + "&version=" + str(known[1])
 
     try:
-        front_conn.request("GET", "/map?player=" + str(PLAYER) + "&session=" + session)
+        status, data = connpool.fetch(front, "GET", path)
 
-        response = front_conn.getresponse()
-        front_conn.close()
+        if status == 304: # We have it already
+            section = known[2]
+            section["version"] = known[1]
+            print("Section unchanged.")
 
-        if response.status == 200:
-            section = pickle.loads(response.read())
+            return section
+        elif status == 200:
+            section = pickle.loads(data)
             print("Got new section.")
 
             for o in section["objects"]:
@@ -80,7 +96,7 @@ def get_section(front, session):
         return None
 
 # Retrieve all commands from queue and put in outbound and resend
-def flush_commands(cmd_queue, outbound_cmds, resend_queue):
+def flush_commands(cmd_queue, outbound_cmds, resend_queue, send_times):
     try:
         while True:
             seq, packet, timestamp = cmd_queue.get(False)
@@ -90,6 +106,7 @@ def flush_commands(cmd_queue, outbound_cmds, resend_queue):
                     return False
 
                 outbound_cmds[seq] = packet
+                send_times[seq] = { "time": timestamp, "resent": None }
                 resend_queue.put((timestamp, seq))
             else:
                 break
@@ -117,6 +134,19 @@ def display_object(objects, o):
     else:
         print(", moving at speed", obj["speed"])
 
+# Apply an object update to our section if it is newer than what we have
+def apply_update(section, version, obj, state):
+    if obj not in section["objects"] or section["objects"][obj]["version"] < version:
+        if state == None:
+            # Object is gone
+            if obj in section["objects"]:
+                print(section["objects"][obj]["name"], "[#" + str(obj) + "] left the section")
+                del section["objects"][obj]
+        else:
+            section["objects"][obj] = dict(state, version=version)
+
+            display_object(section["objects"], obj)
+
 # UI for displaying map section
 def display_map(section):
     print("You are in", section["name"])
@@ -124,6 +154,37 @@ def display_map(section):
     for o in section["objects"]:
         display_object(section["objects"], o)
 
+# Remember a received object state as a possible baseline for deltas, keeping the latest few
+def record_state(history, version, obj, state):
+    states = history.setdefault(obj, {})
+    states[version] = state
+
+    if len(states) > settings.DELTA_HISTORY:
+        del states[min(states)]
+
+# Turn deltas in received updates into full states using recorded baselines
+# Returns None if a baseline is missing, the front resends the update with full states
+def resolve_deltas(history, updates):
+    resolved = []
+
+    for version, obj, state in updates:
+        if state is not None and "base" in state:
+            base = history.get(obj, {}).get(state["base"])
+
+            if base is None:
+                print("Missing baseline", state["base"], "for object", obj)
+                return None
+
+            # The front won't use older baselines for this object anymore
+            for old in [v for v in history[obj] if v < state["base"]]:
+                del history[obj][old]
+
+            state = codec.apply_delta(base, state)
+
+        resolved.append((version, obj, state))
+
+    return resolved
+
 # Player UDP listener thread
 def player_listener(s, s_lock, cmd_queue):
     global front, front_seq
@@ -132,11 +193,15 @@ def player_listener(s, s_lock, cmd_queue):
     last_ack = -1 # Last ACK consecutively received
     last_front_msg = 0 # Last time front spoke to us
     outbound_cmds = {} # Commands still to be acked by front
+    hole_resends = {} # Time of the last resend of each command the front reported missing
+    send_times = {} # Send and resend times of each command still to be acked
     resend_queue = queue.PriorityQueue() # Resend queue to front
     recvd_updates = [] # Receive buffer from front
+    history = {} # Recent states of each object for decoding deltas
     last_acked_version = -1 # Last ACK consecutively sent
-    current_rtt = settings.PLAYER_INITIAL_RTT
-    next_listen_timeout = current_rtt
+    known = None # Section we had before changing fronts, see known_section
+    estimator = rtt.Rtt_estimator() # Round trip time to front from command ACKs
+    next_listen_timeout = estimator.rto
 
     while True:
         with front_lock:
@@ -150,18 +215,29 @@ def player_listener(s, s_lock, cmd_queue):
                     last_front_msg = time.time()
                 
                 if front:
+                    known = known_section(section, last_acked_version, recvd_updates) or known
                     front_seq = 0
                     last_ack = -1
                     outbound_cmds = {}
+                    hole_resends = {}
+                    send_times = {}
                     resend_queue = queue.PriorityQueue()
-                    recv_updates = []
+                    recvd_updates = []
                     section = None
 
             # Get section if we don't have it
             while not section:
-                section = get_section(front, session)
+                section = get_section(front, session, known)
                 if section:
+                    known = None
                     last_acked_version = section["version"]
+                    history = {}
+
+                    for o in section["objects"]:
+                        state = section["objects"][o].copy()
+                        del state["version"]
+                        record_state(history, section["version"], o, state)
+
                     display_map(section)
         
         try:
@@ -169,7 +245,7 @@ def player_listener(s, s_lock, cmd_queue):
             with s_lock:
                 s.settimeout(next_listen_timeout)
 
-            data, addr = s.recvfrom(1024)
+            data, addr = s.recvfrom(settings.MAX_DATAGRAM)
 
             if data == b"FRONT!": # We're talking to the wrong front
                 with front_lock:
@@ -183,64 +259,89 @@ def player_listener(s, s_lock, cmd_queue):
                 last_front_msg = time.time()
 
                 if data[:4] == b"PING": # Front keepalive
-                    current_rtt, timestamp = struct.unpack("!dd", data[4:])
+                    front_rtt, timestamp = struct.unpack("!dd", data[4:])
+
+                    # Go by the front's estimate until we have measured our own, it is 0 if the front has none yet
+                    if estimator.samples == 0 and front_rtt > 0:
+                        estimator.sample(front_rtt)
 
                     with s_lock:
                         try_send(s, b"PONG" + struct.pack("!d", timestamp), addr)
                 elif data[:3] == b"ACK": # Front ack
-                    seq = struct.unpack_from("!l", data[3:])[0]
+                    seq, sacked = codec.decode_ack(data[3:])
 
                     # Flush commands from queue
-                    if not flush_commands(cmd_queue, outbound_cmds, resend_queue):
+                    if not flush_commands(cmd_queue, outbound_cmds, resend_queue, send_times):
                         break # Command is to quit
 
-                    # Remove acked command from outbound buffer
-                    if seq in outbound_cmds:
-                        del outbound_cmds[seq]
-                    else:
-                        print("Duplicate ACK", seq)
-                    
-                    # Calculate last consecutively received ack
                     with front_lock:
-                        if seq < front_seq:
-                            while last_ack < seq and last_ack not in outbound_cmds:
-                                last_ack += 1
+                        seq = min(seq, front_seq - 1)
+
+                    # Remove acked commands from outbound buffer, each once as the consecutive ack moves past it
+                    for acked in list(range(last_ack + 1, seq + 1)) + sacked:
+                        hole_resends.pop(acked, None)
+
+                        if outbound_cmds.pop(acked, None) is not None:
+                            sent = send_times.pop(acked)
+
+                            # Only commands sent once give RTT samples (Karn's rule)
+                            if sent["resent"] is None:
+                                estimator.sample(time.time() - sent["time"])
+                            else:
+                                estimator.resend_acked(time.time() - sent["resent"])
+
+                    last_ack = max(last_ack, seq)
+
+                    # Resend commands the front is missing below the highest one it got, once per RTT
+                    if sacked:
+                        for hole in range(last_ack + 1, max(sacked)):
+                            if hole in outbound_cmds and time.time() - hole_resends.get(hole, 0) > estimator.rtt():
+                                hole_resends[hole] = time.time()
+                                send_times[hole]["resent"] = time.time()
+                                estimator.fast_resend()
+
+                                with s_lock:
+                                    try_send(s, outbound_cmds[hole], addr)
                 elif data[:6] == b"FRONT:": # Command to change fronts
-                    front = pickle.loads(data[6:])
+                    front = codec.decode_address(data[6:])
+                    known = known_section(section, last_acked_version, recvd_updates)
 
                     last_front_msg = time.time()
                     front_seq = 0
                     last_ack = -1
                     outbound_cmds = {}
+                    hole_resends = {}
+                    send_times = {}
                     resend_queue = queue.PriorityQueue()
-                    recv_updates = []
+                    recvd_updates = []
                     section = None
-                elif data[:6] == b"UPDATE": # Update from front
-                    version, obj, data = pickle.loads(data[6:])
+                elif data[:6] == b"UPDATE": # Update or batch of updates from front
+                    first, last, entries = codec.decode_updates(data)
+                    updates = resolve_deltas(history, [(version, obj, state) for version, (obj, state) in enumerate(entries, first)])
+
+                    if updates is None: # Can't use it, repeating our last ACK gets it resent with full states
+                        updates = []
+
+                    for version, obj, state in updates:
+                        if state is not None:
+                            record_state(history, version, obj, state)
 
                     # Add to receive buffer if a new update
-                    if version > last_acked_version:
-                        if version not in recvd_updates:
+                    for version, obj, state in updates:
+                        if version > last_acked_version and version not in recvd_updates:
                             recvd_updates.append(version)
-                        # Update last consecutive ack counter and clean buffer
-                        while last_acked_version + 1 in recvd_updates:
-                            recvd_updates.remove(version)
-                            last_acked_version += 1
-
-                    with s_lock: # Acknowledge the update
-                        try_send(s, b"ACK" + struct.pack("!l", last_acked_version), addr)
-
-                    # Process the update
-                    if obj not in section["objects"] or section["objects"][obj]["version"] < version:
-                        if data == None:
-                            # Object is gone
-                            print(section["objects"][obj]["name"], "[#" + str(obj) + "] left the section")
-                            del section["objects"][obj]
-                        else:
-                            section["objects"][obj] = data
-                            section["objects"][obj]["version"] = version
-
-                            display_object(section["objects"], obj)
+
+                    # Update last consecutive ack counter and clean buffer
+                    while last_acked_version + 1 in recvd_updates:
+                        recvd_updates.remove(last_acked_version + 1)
+                        last_acked_version += 1
+
+                    with s_lock: # Acknowledge the updates received in order and those after a gap
+                        try_send(s, b"ACK" + codec.encode_ack(last_acked_version, recvd_updates), addr)
+
+                    # Process the updates
+                    for version, obj, state in updates:
+                        apply_update(section, version, obj, state)
 
         except socket.timeout:
             if time.time() - last_front_msg > settings.FRONT_TIMEOUT:
@@ -251,17 +352,17 @@ def player_listener(s, s_lock, cmd_queue):
         except Exception:
             pass
 
-        if not flush_commands(cmd_queue, outbound_cmds, resend_queue):
+        if not flush_commands(cmd_queue, outbound_cmds, resend_queue, send_times):
             break # Command was to quit
 
-        next_listen_timeout = current_rtt
+        next_listen_timeout = estimator.rto
 
         # Process resend queue
         try:
             timestamp, seq = resend_queue.get(False)
 
             if seq in outbound_cmds:
-                to_next_resend = timestamp + 2 * current_rtt - time.time()
+                to_next_resend = timestamp + estimator.rto - time.time()
 
                 if to_next_resend <= 0:
                     with front_lock, s_lock:
@@ -269,7 +370,9 @@ def player_listener(s, s_lock, cmd_queue):
                             print("Resend", seq, "at", time.time())
                             try_send(s, outbound_cmds[seq], front)
                     timestamp = time.time()
-                    next_listen_timeout = min(2 * current_rtt, next_listen_timeout)
+                    send_times[seq]["resent"] = timestamp
+                    estimator.backoff()
+                    next_listen_timeout = min(estimator.rto, next_listen_timeout)
                 else:
                     next_listen_timeout = min(to_next_resend, next_listen_timeout)
 
@@ -277,6 +380,8 @@ def player_listener(s, s_lock, cmd_queue):
         except queue.Empty:
             pass
 
+    print("Commands resent", estimator.resends, "times,", estimator.spurious, "spuriously, RTO", round(estimator.rto, 3), "s")
+
 # Class for sending player commands
 class Command_sender:
     def __init__(self, s, s_lock, cmd_queue):
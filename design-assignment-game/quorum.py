@@ -3,6 +3,9 @@
 # Jarkko Kovala <jarkko.kovala@iki.fi>
 
 import settings
+import connpool
+import httpserver
+import metrics
 
 import sys
 import socket
@@ -10,38 +13,33 @@ import pickle
 import time
 import threading
 import urllib
-import http.client
-from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse
 
 fronts = settings.INITIAL_FRONTS # Dict of fronts we have
 for id in fronts:
     fronts[id]["pingcount"] = 0
     fronts[id]["failed"] = False
-fronts_lock = threading.Lock()
+fronts_lock = metrics.lock("fronts")
 
 section_neighbors = {} # Neighbors for map sections
-section_neighbors_lock = threading.Lock()
+section_neighbors_lock = metrics.lock("section_neighbors")
 
 players = settings.INITIAL_PLAYERS # List of all players
-players_lock = threading.Lock()
+players_lock = metrics.lock("players")
 
 # Request a front to accept a player connection
-# caller must have fronts_lock and players_lock
+# Takes copies of the front and player made under fronts_lock and players_lock, so the locks
+# need not be held while waiting for the front
 def request_front_for_player(front, player):
     if not front["failed"]:
         addrport = front["address"]
 
-        front_conn = http.client.HTTPConnection(addrport[0], addrport[1])
         try:
             print("Requesting front", addrport, "for player", next(iter(player.values()))["name"])
 
-            front_conn.request("POST", "/player", pickle.dumps(player))
+            status, data = connpool.request(addrport, "POST", "/player", pickle.dumps(player))
 
-            response = front_conn.getresponse()
-            front_conn.close()
-
-            if response.status == 200:
+            if status == 200:
                 return True
         except OSError:
             pass
@@ -54,17 +52,12 @@ def request_front_for_section(front, source, section, neighbors):
     if not fronts[front]["failed"]:
         addrport = fronts[front]["address"]
 
-        front_conn = http.client.HTTPConnection(addrport[0], addrport[1])
-
         try:
             print("Requesting front", addrport, "for section", section, "neighbors", neighbors)
 
-            front_conn.request("POST", "/map", pickle.dumps((source, section, neighbors)))
+            status, data = connpool.request(addrport, "POST", "/map", pickle.dumps((source, section, neighbors)))
 
-            response = front_conn.getresponse()
-            front_conn.close()
-            
-            if response.status == 200:
+            if status == 200:
                 return True
         except OSError:
             pass
@@ -72,17 +65,12 @@ def request_front_for_section(front, source, section, neighbors):
 
 # Update a front's neighbor information
 def update_front_with_neighbors(front, section, neighbors):
-    front_conn = http.client.HTTPConnection(fronts[front]["address"][0], fronts[front]["address"][1])
-
     try:
         print("Updating neighbors for section", section, "in front", front, neighbors)
 
-        front_conn.request("POST", "/neighbors", pickle.dumps((section, neighbors)))
+        status, data = connpool.request(fronts[front]["address"], "POST", "/neighbors", pickle.dumps((section, neighbors)))
 
-        response = front_conn.getresponse()
-        front_conn.close()
-
-        if response.status == 200:
+        if status == 200:
             return True
     except OSError:
         pass
@@ -187,10 +175,14 @@ def fail_front(id):
         print("Could not find an available front")
 
 # HTTP request handler for quorum
-class quorum_http_handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        protocol_version = "HTTP/1.1"
+class quorum_http_handler(httpserver.Http_handler):
+    def do_GET(self):
+        if urlparse(self.path).path == "/metrics": # Counters, histograms and gauges for monitoring
+            self.reply_metrics()
+        else:
+            self.send_error(404)
 
+    def do_POST(self):
         query = urlparse(self.path)
         content_len = int(self.headers.get('Content-Length'))
         if content_len > 0:
@@ -204,21 +196,21 @@ class quorum_http_handler(BaseHTTPRequestHandler):
                 player["addr"] = client["addr"]
                 player["session"] = client["session"]
 
-                front = fronts[player["front"]]
+                front = fronts[player["front"]].copy()
+                player = player.copy()
 
-                if request_front_for_player(front, { client["id"]: player } ):
-                    print("Giving front", front, "to", player["name"], "at", client["addr"])
+            # Other logins and moves go on while the front answers
+            if request_front_for_player(front, { client["id"]: player } ):
+                print("Giving front", front, "to", player["name"], "at", client["addr"])
 
-                    self.send_response(200)
-                    self.end_headers()
-                    self.wfile.write(pickle.dumps(front["address"]))
-                else:
-                    self.send_error(503)
-                    self.end_headers()
+                self.reply(200, pickle.dumps(front["address"]))
+            else:
+                self.send_error(503)
         elif query.path == "/move": # Request to move player to another front or section
             player, (front, section) = pickle.loads(body)
 
-            new_front = find_front_by_addrport(front)
+            with fronts_lock:
+                new_front = find_front_by_addrport(front)
 
             with players_lock:
                 players[player]["front"] = new_front
@@ -226,15 +218,13 @@ class quorum_http_handler(BaseHTTPRequestHandler):
 
             print("Player", player, "moved to front", new_front, "section", section)
 
-            self.send_response(200)
-            self.end_headers()
+            self.reply(200)
         else:
             self.send_error(404)
-            self.end_headers()
 
 # Quorum HTTP server thread
 def quorum_http_server():
-    httpd = HTTPServer(settings.QUORUM_ADDRPORT, quorum_http_handler)
+    httpd = httpserver.Worker_http_server(settings.QUORUM_ADDRPORT, quorum_http_handler)
 
     try:
         print("Starting HTTP server at", settings.QUORUM_ADDRPORT)
@@ -257,6 +247,7 @@ def front_pinger(s):
                         fail_front(id)
 
                 s.sendto(b"PING", front["address"])
+                metrics.count_packet("out", "PING")
 
                 front["pingcount"] += 1
         time.sleep(1)
@@ -265,6 +256,8 @@ def front_pinger(s):
 def front_pong_listener(s):
     while True:
         data, addr = s.recvfrom(1024)
+        metrics.count_packet("in", "PONG" if data == b"PONG" else "other")
+
         if data == b"PONG":
             with fronts_lock:
                 for id in fronts:
@@ -277,7 +270,17 @@ def front_pong_listener(s):
                             front["failed"] = False
                             print("Front", id, "back alive")
 
+# Gauges read when /metrics is scraped, without locks as they only need to be about right
+def register_metrics():
+    metrics.gauge("fronts", lambda: { 'state="alive"': sum(not f["failed"] for f in list(fronts.values())),
+        'state="failed"': sum(bool(f["failed"]) for f in list(fronts.values())) }, "Fronts known by whether they answer pings")
+    metrics.gauge("players", lambda: len(players), "Players known")
+    metrics.describe("packets_in_total", "Datagrams received by type")
+    metrics.describe("packets_out_total", "Datagrams sent by type")
+
 def main():
+    register_metrics()
+
     # Get initial front/section info from settings and tell fronts to fetch the data
     for front in settings.INITIAL_SECTIONS_FOR_FRONTS:
         fronts[front]["sections"] = set()
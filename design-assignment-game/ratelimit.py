@@ -0,0 +1,48 @@
+# Rate limit module: token bucket limiting how fast a player's commands are carried out
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import time
+
+# Token bucket refilled at rate tokens per second up to burst tokens, each command takes one
+# A player sending steadily below the rate is never limited, a flood gets burst commands through
+# and then rate per second
+class Token_bucket:
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate or settings.COMMAND_RATE
+        self.burst = burst or settings.COMMAND_BURST
+        self.tokens = self.burst
+        self.last = time.time()
+
+        self.rejected = 0 # Commands turned away
+
+    # Take a token if there is one, returns whether the command may be carried out
+    def take(self, now=None):
+        now = now or time.time()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        self.rejected += 1
+        return False
+
+# Commands let through from a flood and from a player within the rate
+def main():
+    flood = Token_bucket()
+    steady = Token_bucket()
+    start = flood.last
+
+    # One second of commands every millisecond and every tenth of a second
+    flooded = sum(flood.take(start + i / 1000) for i in range(1000))
+    paced = sum(steady.take(start + i / 10) for i in range(10))
+
+    print("Flood of 1000 commands in 1 s:", flooded, "carried out,", flood.rejected, "rejected")
+    print("10 commands in 1 s:", paced, "carried out,", steady.rejected, "rejected")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# RTT module: round trip time estimation and retransmission timeouts as in RFC 6298
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import time
+
+# Smoothed round trip time and retransmission timeout for one peer
+# Only samples from messages that were never resent may be given to sample (Karn's rule),
+# as the ACK of a resent message can't be matched to the transmission that caused it
+class Rtt_estimator:
+    ALPHA = 1/8 # Gain of the smoothed RTT
+    BETA = 1/4 # Gain of the RTT variation
+    K = 4 # RTT variations added to the smoothed RTT for the timeout
+
+    def __init__(self, initial_rto=None):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = None
+        self.rto = initial_rto or settings.PLAYER_INITIAL_RTT
+
+        self.samples = 0 # RTT samples taken
+        self.resends = 0 # Messages resent
+        self.timeouts = 0 # Resends because the timeout ran out, each one backs off the timeout
+        self.spurious = 0 # Resends acknowledged too soon after being sent for the resend to have been needed
+        self.backed_off = 0 # Time the timeout was last doubled
+
+    # Take a round trip time sample, which also cancels any backoff
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        self.min_rtt = min(rtt, self.min_rtt if self.min_rtt is not None else rtt)
+
+        self.rto = min(max(self.srtt + max(settings.TIMER_RESOLUTION, self.K * self.rttvar), settings.RTO_MIN), settings.RTO_MAX)
+        self.samples += 1
+
+    # The retransmission timeout of a message ran out: count the resend and double the timeout
+    # Messages sent together time out together, the timeout is doubled once for them
+    def backoff(self):
+        self.resends += 1
+        self.timeouts += 1
+
+        if time.time() - self.backed_off >= self.rto:
+            self.backed_off = time.time()
+            self.rto = min(self.rto * 2, settings.RTO_MAX)
+
+    # A message was resent before its timeout because the peer reported it missing
+    def fast_resend(self):
+        self.resends += 1
+
+    # A resent message was acknowledged at time since_resend after the resend
+    # An ACK arriving faster than any round trip we have seen must be for the original message,
+    # so the resend was spurious
+    def resend_acked(self, since_resend):
+        if self.min_rtt is not None and since_resend < self.min_rtt:
+            self.spurious += 1
+
+    # Smoothed RTT, or the timeout before we have any samples
+    def rtt(self):
+        return self.srtt if self.srtt is not None else self.rto
+
+    # Estimator state for reporting
+    def stats(self):
+        return { "srtt": self.srtt, "rttvar": self.rttvar, "min_rtt": self.min_rtt, "rto": self.rto, "samples": self.samples,
+                "resends": self.resends, "timeouts": self.timeouts, "spurious": self.spurious }
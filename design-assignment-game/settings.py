@@ -18,6 +18,20 @@ INITIAL_FRONTS = {
     }
 FRONT_TIMEOUT = 5
 
+FRONT_WORKERS = 4 # Worker processes of a front run with front_workers.py, each simulating a share of its sections
+
+HTTP_TIMEOUT = 5 # Seconds to wait on a connection or response between components
+
+POOL_SIZE = 4 # Idle keep-alive connections kept for each address
+
+POOL_IDLE_TIMEOUT = 10 # Seconds an idle connection is kept before it is closed instead of reused, below HTTP_KEEPALIVE_TIMEOUT
+
+HTTP_WORKERS = 32 # Threads serving HTTP connections in front, store and quorum
+
+HTTP_BACKLOG = 64 # Connections with a request waiting for a free worker before more are turned away with 503
+
+HTTP_KEEPALIVE_TIMEOUT = 15 # Seconds the server keeps an idle keep-alive connection open, it holds no worker meanwhile
+
 INITIAL_SECTIONS_FOR_FRONTS = { 
         1 : {   
                 1 : { "version": 0, 
@@ -65,10 +79,78 @@ INITIAL_PLAYERS = {
         2 : { "name": "Player #2", "id": 2, "front": 2, "section": 2 }
     }
 
-PLAYER_INITIAL_RTT = 1
+BOTS = 0 # Bot players of the load generator bots.py, the cluster must be started with at least as many as bots.py runs
+
+BOT_FIRST_ID = 1000 # Player and ship id of the first bot
+
+BOT_COMMAND_INTERVAL = 1 # Seconds between the commands each bot sends
+
+BOT_LOGIN_RATE = 200 # Bots bots.py starts logging in per second
+
+# Add the bots to the initial players with their ships spread evenly over the initial sections
+def add_bots():
+    sections = [(front, section) for front in INITIAL_SECTIONS_FOR_FRONTS for section in INITIAL_SECTIONS_FOR_FRONTS[front]]
+
+    for bot in range(BOTS):
+        id = BOT_FIRST_ID + bot
+        front, section = sections[bot % len(sections)]
+        loc = (round(bot * 0.618034 % 1 * 90 - 45, 3), round(bot * 0.754878 % 1 * 90 - 45, 3))
+
+        INITIAL_PLAYERS[id] = { "name": "Bot #" + str(id), "id": id, "front": front, "section": section }
+        INITIAL_SECTIONS_FOR_FRONTS[front][section]["objects"][id] = { "name": "Bot #" + str(id) + " ship", "loc": loc, "speed": 0, "direction": 0 }
+
+add_bots()
+
+PLAYER_INITIAL_RTT = 1 # Also the retransmission timeout before the first RTT sample
+
+RTO_MIN = 0.2 # Lower bound of the retransmission timeout between front and player
+
+RTO_MAX = 10 # Upper bound of the retransmission timeout after backoff
 
 PLAYER_TIMEOUT = 1
 
+COMMAND_RATE = 20 # Commands per second a player's commands are carried out at most, those over it are acknowledged but ignored
+
+COMMAND_BURST = 10 # Commands a player can send at once before COMMAND_RATE limits them
+
 STORE_RESEND_TIMEOUT = 1
 
+TIMER_RESOLUTION = 0.01 # Seconds per slot of the resend timer wheels
+
+HANDOFF_RETRY = 0.5 # Seconds before a failed step of handing a ship to a neighbor is tried again
+
+HANDOFF_TIMEOUT = 10 # Seconds before a handoff that keeps failing is given up and the ship let go at the edge
+
+GHOST_ZONE = 10 # Width of the strip along each edge whose objects the neighbor across it gets as ghosts, None for no ghosts
+
+GHOST_RETRY = 1 # Seconds before a neighbor we failed to send ghosts to is sent all of them again
+
+BATCH_UPDATES = True # Pack object updates made during one tick into shared datagrams
+
+UPDATE_MTU = 1200 # Largest batched update datagram we build
+
+MAX_DATAGRAM = 65535 # Receive buffer size for datagrams
+
+RECV_BATCH = 64 # Most datagrams the front reads in one go before handling them and sending its replies
+
+TICK_RATE = 10 # Simulation ticks per second
+
+MAX_CATCHUP_TICKS = 10 # Ticks run back to back to catch up after a stall before skipping the rest
+
+VECTOR_MOVEMENT = True # Move objects of crowded sections with NumPy when it is installed
+
+VECTOR_MIN_OBJECTS = 256 # Moving objects needed in a section before vectorized movement pays off
+
+AOI_RADIUS = None # Players only get updates for objects within this distance of their ship, None for the whole section
+
+AOI_CELL_SIZE = 10 # Size of the grid cells used to find objects near a player
+
+DELTA_UPDATES = True # Send players only the fields changed since a state they have acknowledged
+
+DELTA_HISTORY = 16 # Recent states of each object a player keeps as baselines for deltas
+
+METRICS = True # Count packets and time locks, ticks and HTTP requests for /metrics
+
+LOGIN_METRICS_ADDRPORT = ( "127.0.0.1", 10011 ) # Login has no HTTP server of its own, it serves /metrics here
+
 PACKET_LOSS = 0
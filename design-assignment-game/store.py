@@ -2,10 +2,12 @@
 # Jarkko Kovala <jarkko.kovala@iki.fi>
 
 import settings
+import codec
+import httpserver
+import metrics
 
 import sys
 import socket
-import struct
 import time
 import threading
 import random
@@ -13,67 +15,89 @@ import queue
 import pickle
 import urllib
 from urllib.parse import urlparse, parse_qs
-from http.server import BaseHTTPRequestHandler, HTTPServer
 
 sections = {} # The map sections
-sections_lock = threading.Lock()
+sections_lock = metrics.lock("sections")
 
 fronts = {} # The fronts
-fronts_lock = threading.Lock()
+fronts_lock = metrics.lock("fronts")
 
 addrport = settings.STORE_ADDRPORT
 
 # Attempt to send, generate packet loss for testing
 def try_send(s, packet, addr):
+    kind = codec.message_type(packet) or "other"
+
     if(random.randint(1, 100) > settings.PACKET_LOSS):
         s.sendto(packet, addr)
+        metrics.count_packet("out", kind)
+    else:
+        metrics.count_packet("dropped", kind)
 
 # Update an object
 def update_object(section, version, obj_id, obj):
     section["version"] = version
+    section.pop("snapshot", None)
 
-    if obj == None: # Object was removed
-        print("Removing object", obj_id, "from section", section["name"], "ver", version)
-        del section["objects"][obj_id]
+    if obj == None: # Object was removed, or is a ghost of a neighbor's object which we don't keep
+        if section["objects"].pop(obj_id, None) is not None:
+            print("Removing object", obj_id, "from section", section["name"], "ver", version)
     else:
         print("Updating object", obj_id, "in section", section["name"], "ver", version)
+
+        if "name" not in obj: # Sent as a name reference, the front sends the name first
+            obj["name"] = section["objects"].get(obj_id, {}).get("name", "")
+
         section["objects"][obj_id] = obj
 
 # Clean internal data from map section for sending
 def clean_section(section):
     section = section.copy()
 
-    for x in ("recv_buffer", "last_ack", "front"):
+    for x in ("recv_buffer", "last_ack", "front", "snapshot"):
         if x in section:
             del section[x]
 
     return section
 
 # HTTP request handler for store
-class store_http_handler(BaseHTTPRequestHandler):
+class store_http_handler(httpserver.Http_handler):
     def do_GET(self):
-        protocol_version = "HTTP/1.1"
-
         query = urlparse(self.path)
         vars = parse_qs(query.query)
 
-        if query.path == "/map": # Request to retrieve a map section
+        if query.path == "/metrics": # Counters, histograms and gauges for monitoring
+            self.reply_metrics()
+        elif query.path == "/map": # Request to retrieve a map section
             section = int(vars["section"][0])
 
             with sections_lock:
                 if section in sections:
                     print("Section", section, "requested, sending")
-                    self.send_response(200)
-                    self.end_headers()
-                    self.wfile.write(pickle.dumps((clean_section(sections[section]), {})))
+
+                    # Pickled once for each version
+                    if "snapshot" not in sections[section]:
+                        sections[section]["snapshot"] = pickle.dumps((clean_section(sections[section]), {}))
+
+                    data = sections[section]["snapshot"]
+
+                    # The client already has this version
+                    if vars.get("version") == [str(sections[section]["version"])]:
+                        data = b""
                 else:
                     print("Section", section, "requested but we don't have it")
-                    self.send_response(404)
-                    self.end_headers()
+                    data = None
 
-    def do_POST(self):
-        protocol_version = "HTTP/1.1"
+            if data is None:
+                self.reply(404)
+            elif data:
+                self.reply(200, data)
+            else:
+                self.reply(304)
+        else:
+            self.send_error(404)
 
+    def do_POST(self):
         query = urlparse(self.path)
         content_len = int(self.headers.get('Content-Length'))
         if content_len > 0:
@@ -91,8 +115,9 @@ class store_http_handler(BaseHTTPRequestHandler):
                 sections[section_id]["last_ack"] = section["version"]
                 fronts[front_id] = front
             
-            self.send_response(200)
-            self.end_headers()
+            self.reply(200)
+        else:
+            self.send_error(404)
 
 # UDP listener thread for store
 def store_listener():
@@ -100,19 +125,25 @@ def store_listener():
         s.bind(settings.STORE_ADDRPORT)
 
         while True:
-            data, addr = s.recvfrom(1024)
+            data, addr = s.recvfrom(settings.MAX_DATAGRAM)
+            metrics.count_packet("in", codec.message_type(data) or "other")
 
-            if data[:6] == b"UPDATE": # Update for an object
-                with sections_lock, fronts_lock:
-                    section, version, obj_id, obj = pickle.loads(data[6:])
+            if data[:6] == b"UPDATE": # Update or batch of updates for objects
+                try:
+                    section, first, last, entries = codec.decode_store_updates(data)
+                except ValueError:
+                    print("Malformed update from", addr)
+                    continue
 
-                    if fronts[sections[section]["front"]] == addr: # Check if it was the correct front
-                        # If we haven't received this then store in buffer
-                        if version > sections[section]["last_ack"] and version not in sections[section]["recv_buffer"]:
-                            sections[section]["recv_buffer"][version] = (obj_id, obj)
+                ack = None
 
-                        # Acknowledge the update
-                        try_send(s, b"ACK" + struct.pack("!ll", section, version), addr)
+                # The whole batch is applied under one acquisition of the locks
+                with sections_lock, fronts_lock:
+                    if section in sections and fronts[sections[section]["front"]] == addr: # Check if it was the correct front
+                        # If we haven't received these then store in buffer
+                        for version, entry in enumerate(entries, first):
+                            if version > sections[section]["last_ack"] and version not in sections[section]["recv_buffer"]:
+                                sections[section]["recv_buffer"][version] = entry
                     
                         # Process received updates consecutively
                         while sections[section]["last_ack"] + 1 in sections[section]["recv_buffer"]:
@@ -121,9 +152,15 @@ def store_listener():
                             update_object(sections[section], seq, obj_id, obj)
                             sections[section]["last_ack"] += 1
 
+                        ack = sections[section]["last_ack"]
+
+                # Acknowledge everything applied so far, which also covers earlier batches whose ACK was lost
+                if ack is not None:
+                    try_send(s, b"ACK" + codec.encode_store_ack(section, ack), addr)
+
 # HTTP server thread for store                    
 def store_http_server():
-    httpd = HTTPServer(addrport, store_http_handler)
+    httpd = httpserver.Worker_http_server(addrport, store_http_handler)
 
     try:
         print("Starting HTTP server at", addrport)
@@ -133,6 +170,15 @@ def store_http_server():
 
     httpd.server_close()
 
+# Gauges read when /metrics is scraped, without locks as they only need to be about right
+def register_metrics():
+    metrics.gauge("sections", lambda: len(sections), "Sections stored")
+    metrics.gauge("recv_buffer_updates", lambda: sum(len(x.get("recv_buffer", ())) for x in list(sections.values())),
+        "Updates received out of order and waiting for earlier ones")
+    metrics.describe("packets_in_total", "Datagrams received by type")
+    metrics.describe("packets_out_total", "Datagrams sent by type")
+    metrics.describe("packets_dropped_total", "Datagrams dropped by simulated packet loss")
+
 def main():
     # First store initial section data from settings
     for front in settings.INITIAL_SECTIONS_FOR_FRONTS:
@@ -141,6 +187,8 @@ def main():
             sections[section] = settings.INITIAL_SECTIONS_FOR_FRONTS[front][section]
             print(sections[section])
 
+    register_metrics()
+
     store_http_server_thread = threading.Thread(target=store_http_server)
     store_http_server_thread.start()
 
@@ -0,0 +1,52 @@
+# Ticker module: fixed timestep schedule for the simulation
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import time
+
+# Schedule of simulation ticks at a fixed rate
+# Each tick has a simulation time that advances exactly one interval per tick, so ticks
+# run late after a stall are caught up with the same timestamps they would have had
+class Tick_scheduler:
+    def __init__(self, rate=None, max_catchup=None):
+        self.interval = 1 / (rate or settings.TICK_RATE)
+        self.max_catchup = max_catchup if max_catchup is not None else settings.MAX_CATCHUP_TICKS
+        self.next_tick = time.time()
+
+        self.ticks = 0 # Ticks run
+        self.overruns = 0 # Ticks that took longer than the interval
+        self.skipped = 0 # Ticks dropped because we were too far behind to catch up
+        self.last_duration = 0
+        self.max_duration = 0
+
+    # Seconds until the next tick is due
+    def delay(self):
+        return max(self.next_tick - time.time(), 0)
+
+    # Start the next due tick and return its simulation time
+    # Ticks beyond max_catchup behind the wall clock are skipped
+    def start(self):
+        behind = int((time.time() - self.next_tick) / self.interval)
+
+        if behind > self.max_catchup:
+            skip = behind - self.max_catchup
+            print("Simulation", round(behind * self.interval, 3), "s behind, skipping", skip, "ticks")
+
+            self.skipped += skip
+            self.next_tick += skip * self.interval
+
+        self.started = time.time()
+
+        return self.next_tick
+
+    # Finish the tick started last and schedule the next one
+    def end(self):
+        self.last_duration = time.time() - self.started
+        self.max_duration = max(self.max_duration, self.last_duration)
+        self.ticks += 1
+
+        if self.last_duration > self.interval:
+            self.overruns += 1
+
+        self.next_tick += self.interval
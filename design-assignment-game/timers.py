@@ -0,0 +1,216 @@
+# Timers module: hierarchical timer wheel for resend timeouts
+# Timers are keyed so they can be cancelled in constant time when the matching ACK arrives
+# Jarkko Kovala <jarkko.kovala@iki.fi>
+
+import settings
+
+import math
+import threading
+
+# Hierarchical timer wheel
+# Level 0 has a slot for each tick of resolution seconds, each higher level has slots covering
+# a whole turn of the level below. Timers far away sit in higher levels and are moved down when
+# their slot comes up, so scheduling, cancelling and firing a timer are all constant time.
+class Timer_wheel:
+    def __init__(self, resolution=None, slots=64, levels=4):
+        self.resolution = resolution or settings.TIMER_RESOLUTION
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)] # Ticks covered by a slot on each level
+        self.lock = threading.Lock() # Protects everything below
+
+        self.wheels = [[{} for slot in range(slots)] for level in range(levels)] # Timer ticks by key in each slot
+        self.where = {} # Level and slot of each timer, level None for timers already due
+        self.due = {} # Timers due at the next call to expired
+        self.current = self.tick_of(0) # Last tick processed
+
+    # Tick a deadline falls on, rounded up so timers never fire early
+    def tick_of(self, deadline):
+        return math.ceil(deadline / self.resolution)
+
+    # Put a timer on the wheel at tick, which must not be before the current tick
+    # Caller must have lock
+    def place(self, key, tick):
+        # Timers further away than the top level covers without wrapping onto itself fire at its far end
+        top = self.spans[self.levels - 1]
+        tick = min(tick, (self.current // top + self.slots) * top - 1)
+
+        # Lowest level where the timer is within the same turn of the level above as the current tick
+        level = 0
+        while level < self.levels - 1 and tick // self.spans[level + 1] != self.current // self.spans[level + 1]:
+            level += 1
+
+        slot = tick // self.spans[level] % self.slots
+        self.wheels[level][slot][key] = tick
+        self.where[key] = (level, slot)
+
+    # Remove a timer
+    # Caller must have lock
+    def remove(self, key):
+        level, slot = self.where.pop(key)
+
+        if level is None:
+            del self.due[key]
+        else:
+            del self.wheels[level][slot][key]
+
+    # Schedule a timer at deadline, replacing any timer with the same key
+    def schedule(self, key, deadline):
+        with self.lock:
+            if key in self.where:
+                self.remove(key)
+
+            tick = math.ceil(deadline / self.resolution)
+
+            if tick <= self.current:
+                self.due[key] = tick
+                self.where[key] = (None, None)
+            else:
+                self.place(key, tick)
+
+    # Cancel a timer if it is scheduled
+    def cancel(self, key):
+        with self.lock:
+            if key in self.where:
+                self.remove(key)
+
+    # Advance the wheel to time now and return keys of all timers that are due
+    # Fired timers are removed, schedule them again to repeat
+    def expired(self, now):
+        with self.lock:
+            fired = list(self.due)
+            self.due = {}
+            target = self.tick_of(now)
+
+            while self.current < target:
+                if len(self.where) == len(fired): # Nothing left on the wheel, skip straight to now
+                    self.current = target
+                    break
+
+                self.current += 1
+
+                # Move timers down from higher level slots starting at this tick, highest first
+                # so they can move down more than one level
+                if self.current % self.slots == 0:
+                    for level in reversed(range(1, self.levels)):
+                        if self.current % self.spans[level] == 0:
+                            slot = self.current // self.spans[level] % self.slots
+                            timers = self.wheels[level][slot]
+                            self.wheels[level][slot] = {}
+
+                            for key, tick in timers.items():
+                                self.place(key, tick)
+
+                slot = self.current % self.slots
+
+                if self.wheels[0][slot]:
+                    fired.extend(self.wheels[0][slot])
+                    self.wheels[0][slot] = {}
+
+            for key in fired:
+                del self.where[key]
+
+            return fired
+
+    # Time of the next tick something happens on the wheel, None if there are no timers
+    # Timers in higher levels report the tick they are moved down, which may be before they are due
+    def next_deadline(self):
+        with self.lock:
+            if self.due:
+                return self.current * self.resolution
+
+            for level in range(self.levels):
+                base = self.current // self.spans[level]
+
+                for ahead in range(1, self.slots):
+                    if self.wheels[level][(base + ahead) % self.slots]:
+                        return (base + ahead) * self.spans[level] * self.resolution
+
+            return None
+
+    # Number of scheduled timers
+    def __len__(self):
+        return len(self.where)
+
+# Compare the timer wheel against the priority queues it replaces, simulating a front that
+# schedules a resend for every update and gets most of them acknowledged before they are due
+def main():
+    import heapq
+    import random
+    import time
+
+    rate = 100 # Listener wakeups per second
+    per_step = 500 # Resends scheduled per wakeup
+    seconds = 10
+    timeout = 0.2
+    acked_share = 0.9
+
+    random.seed(1)
+    steps = [[(random.random() < acked_share, random.uniform(0.01, 0.1)) for x in range(per_step)] for step in range(rate * seconds)]
+
+    # Priority queue: acked entries stay until they surface, entries not due are popped and pushed back
+    def heap_run():
+        heap = []
+        acks = []
+        acked = set()
+        peak = fired = key = 0
+
+        for step, timers in enumerate(steps):
+            now = step / rate
+
+            for is_acked, delay in timers:
+                heapq.heappush(heap, (now + timeout, key))
+                if is_acked:
+                    heapq.heappush(acks, (now + delay, key))
+                key += 1
+
+            while acks and acks[0][0] <= now:
+                acked.add(heapq.heappop(acks)[1])
+
+            while heap:
+                deadline, k = heapq.heappop(heap)
+                if k in acked:
+                    acked.discard(k)
+                elif deadline > now:
+                    heapq.heappush(heap, (deadline, k))
+                    break
+                else:
+                    fired += 1
+
+            peak = max(peak, len(heap))
+
+        return fired, peak
+
+    # Timer wheel: acked timers are cancelled right away
+    def wheel_run():
+        wheel = Timer_wheel(resolution=0.01)
+        wheel.current = 0
+        acks = []
+        peak = fired = key = 0
+
+        for step, timers in enumerate(steps):
+            now = step / rate
+
+            for is_acked, delay in timers:
+                wheel.schedule(key, now + timeout)
+                if is_acked:
+                    heapq.heappush(acks, (now + delay, key))
+                key += 1
+
+            while acks and acks[0][0] <= now:
+                wheel.cancel(heapq.heappop(acks)[1])
+
+            fired += len(wheel.expired(now))
+            peak = max(peak, len(wheel))
+
+        return fired, peak
+
+    print("Timers:", rate * seconds * per_step, "of which acked: %d%%" % (acked_share * 100))
+
+    for name, run in (("Priority queue", heap_run), ("Timer wheel", wheel_run)):
+        start = time.time()
+        fired, peak = run()
+        print("%-15s %7.1f ms, %d fired, at most %d entries held" % (name + ":", (time.time() - start) * 1000, fired, peak))
+
+if __name__ == "__main__":
+    main()